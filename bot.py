@@ -14,6 +14,8 @@ from telegram import Update
 
 import db
 import handlers
+import metrics
+import tracing
 
 # Версия бота
 BOT_VERSION = "1.2.1 - AD PLACEMENT FIX"  # КРИТИЧНО: Исправлена маршрутизация рекламы в ADMIN_MENU
@@ -66,7 +68,8 @@ def get_bot_token() -> str:
     raise RuntimeError("BOT_TOKEN не установлен")
 
 
-def main():
+def run_migrations():
+    """Инициализирует пул соединений, схему БД и применяет все миграции"""
     # Инициализация connection pool (для PostgreSQL)
     db.init_connection_pool()
 
@@ -82,6 +85,7 @@ def main():
     db.migrate_add_regions_to_clients()  # Добавляем поле regions в таблицу clients
     db.migrate_add_videos_to_orders()  # Добавляем поле videos в таблицу orders
     db.migrate_add_chat_system()  # Создаём таблицы для чата между клиентом и мастером
+    db.migrate_add_chat_read_markers()  # НОВОЕ: Отметки прочтения сообщений вместо UPDATE каждой строки
     db.migrate_add_transactions()  # Создаём таблицу для истории транзакций
     db.migrate_add_notification_settings()  # Добавляем настройки уведомлений для мастеров
     db.migrate_normalize_categories()  # ИСПРАВЛЕНИЕ: Нормализация категорий мастеров (точный поиск вместо LIKE)
@@ -91,23 +95,46 @@ def main():
     db.migrate_add_worker_cities()  # Добавляем таблицу для множественного выбора городов мастером
     db.migrate_add_chat_message_notifications()  # Добавляем таблицу для агрегированных уведомлений о сообщениях в чате
     db.migrate_fix_portfolio_photos_size()  # ИСПРАВЛЕНИЕ: Увеличиваем размер portfolio_photos с VARCHAR(1000) на TEXT
+    db.migrate_add_worker_order_counters()  # НОВОЕ: Счётчики доступных заказов мастеров
+    db.migrate_add_user_search_index()  # НОВОЕ: pg_trgm/FTS5 индексы поиска пользователей в админке
+    db.migrate_add_order_search_index()  # НОВОЕ: Полнотекстовый поиск по описаниям заказов
+    db.migrate_add_rating_aggregates()  # НОВОЕ: Агрегаты рейтинга (rating_sum) для записи отзыва одной транзакцией
+    db.migrate_add_rating_histograms()  # НОВОЕ: Гистограммы оценок и индекс ленты отзывов
+    db.migrate_add_worker_portfolio_photos()  # НОВОЕ: Портфолио построчно - навигация читает одно фото
+    db.migrate_add_worker_profile_version()  # НОВОЕ: Версия профиля мастера для кэша карточек
+    db.migrate_add_worker_ranking_score()  # НОВОЕ: Счёт ранжирования мастеров для top-K просмотра
     db.create_indexes()  # Создаем индексы для оптимизации производительности
 
-    # Добавляем супер-админа
-    SUPER_ADMIN_TELEGRAM_ID = 641830790  # Ваш telegram_id
-    db.add_admin_user(SUPER_ADMIN_TELEGRAM_ID, role='super_admin')
 
-    token = get_bot_token()
+async def flush_buffers_on_shutdown(application):
+    """НОВОЕ: Дописывает в БД буферизованные события рекламы при остановке бота"""
+    try:
+        flushed = db.flush_ad_events()
+        logger.info(f"💾 При остановке записано событий рекламы: {flushed}")
+    except Exception as e:
+        logger.error(f"❌ Ошибка записи событий рекламы при остановке: {e}", exc_info=True)
 
-    logger.info("=" * 80)
-    logger.info(f"🚀 ЗАПУСК БОТА - ВЕРСИЯ: {BOT_VERSION}")
-    logger.info("✅ ВКЛЮЧЕНЫ ИСПРАВЛЕНИЯ:")
-    logger.info("   - Обработчики admin_ad_placement и admin_ad_confirm в ADMIN_MENU")
-    logger.info("   - Прямая маршрутизация для broadcast, suggestions, ads")
-    logger.info("   - Автоматическая отметка предложений как 'viewed'")
-    logger.info("=" * 80)
 
-    application = ApplicationBuilder().token(token).build()
+def build_application(token, request=None):
+    """
+    Создаёт Application со всеми обработчиками бота.
+
+    Args:
+        token: Токен бота
+        request: BaseRequest для вызовов Bot API (по умолчанию TracedRequest).
+                 Нагрузочный тест (loadtest.py) подставляет сюда фейковый транспорт.
+    """
+    # НОВОЕ: BotContext добавляет context.loader - кэш чтений БД на время апдейта
+    # НОВОЕ: TracedApplication/TracedRequest - трассировка времени БД и Bot API по апдейтам
+    application = (
+        ApplicationBuilder()
+        .token(token)
+        .application_class(tracing.TracedApplication)
+        .request(request or tracing.TracedRequest())
+        .context_types(ContextTypes(context=handlers.BotContext))
+        .post_shutdown(flush_buffers_on_shutdown)
+        .build()
+    )
 
     # --- Команда /start (ОТДЕЛЬНО от ConversationHandler) ---
     application.add_handler(CommandHandler("start", handlers.start_command))
@@ -301,7 +328,10 @@ def main():
                 MessageHandler(filters.VIDEO, handlers.create_order_photo_upload),
                 CommandHandler("done", handlers.create_order_done_uploading),
                 CallbackQueryHandler(handlers.create_order_skip_photos, pattern="^order_skip_photos$"),
-                CallbackQueryHandler(handlers.create_order_publish, pattern="^order_publish$"),
+                CallbackQueryHandler(handlers.create_order_ask_deadline, pattern="^order_publish$"),
+            ],
+            handlers.CREATE_ORDER_DEADLINE: [
+                CallbackQueryHandler(handlers.create_order_deadline_select, pattern="^order_deadline_"),
             ],
         },
         fallbacks=[
@@ -402,6 +432,25 @@ def main():
     
     application.add_handler(bid_conv_handler)
 
+    # --- НОВОЕ: Поиск заказов мастером по словам из описания ---
+    order_search_handler = ConversationHandler(
+        entry_points=[
+            CallbackQueryHandler(handlers.worker_search_orders_start, pattern="^worker_search_orders$")
+        ],
+        states={
+            handlers.WORKER_ORDER_SEARCH: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, handlers.worker_search_orders_execute),
+            ],
+        },
+        fallbacks=[
+            CallbackQueryHandler(handlers.cancel_order_search, pattern="^cancel_order_search$"),
+            CommandHandler("cancel", handlers.cancel_from_command),
+        ],
+        allow_reentry=True,
+    )
+
+    application.add_handler(order_search_handler)
+
     # --- Обработчик "Мои заказы" (НЕ в ConversationHandler) ---
     application.add_handler(
         CallbackQueryHandler(
@@ -986,6 +1035,16 @@ def main():
         CommandHandler("check_expired_chats", handlers.check_expired_chats_command)
     )
 
+    # Команда для отчёта о медленных SQL-запросах (только для администратора)
+    application.add_handler(
+        CommandHandler("slow_queries", handlers.slow_queries_command)
+    )
+
+    # Команда для пересчёта рейтингов по отзывам (только для администратора)
+    application.add_handler(
+        CommandHandler("rebuild_ratings", handlers.rebuild_ratings_command)
+    )
+
     # --- ConversationHandler для админ-панели ---
     admin_conv_handler = ConversationHandler(
         entry_points=[
@@ -1209,70 +1268,110 @@ def main():
     # Регистрируем обработчик ошибок
     application.add_error_handler(error_handler)
 
-    # --- ФОНОВАЯ ЗАДАЧА: Проверка просроченных заказов ---
-    async def check_deadlines_job(context):
+    # Трассировка: имена обработчиков для span апдейта (после регистрации всех обработчиков)
+    tracing.instrument_application(application)
+
+    return application
+
+
+def start_background_jobs(application):
+    """Регистрирует фоновые задачи JobQueue (дедлайны, сверка счётчиков, очистка чатов)"""
+    # --- ФОНОВАЯ ЗАДАЧА: Истечение заказов по дедлайну ---
+    # НОВОЕ: Планировщик на куче срабатывает в момент дедлайна вместо ежечасного сканирования
+    job_queue = application.job_queue
+    if job_queue is not None:
+        pending_deadlines = handlers.deadline_scheduler.start(job_queue)
+        logger.info(f"⏰ Планировщик дедлайнов активирован (заказов с дедлайном: {pending_deadlines})")
+    else:
+        logger.warning("⚠️ JobQueue не доступен. Проверка дедлайнов отключена.")
+
+    # --- ФОНОВАЯ ЗАДАЧА: Сверка счётчиков доступных заказов ---
+    @metrics.timed_job("reconcile_counters")
+    async def reconcile_counters_job(context):
         """
-        Периодическая проверка просроченных заказов.
-        Запускается каждый час.
+        Периодическая сверка счётчиков доступных заказов мастеров.
+        Исправляет дрейф после смены городов/категорий мастера.
         """
-        logger.info("🔍 Запуск проверки просроченных заказов...")
-
-        expired_orders = db.check_expired_orders()
-
-        if not expired_orders:
-            logger.debug("Просроченных заказов не найдено")
-            return
-
-        logger.info(f"📋 Найдено просроченных заказов: {len(expired_orders)}")
-
-        # Отправляем уведомления
-        for order_data in expired_orders:
-            order_id = order_data['order_id']
-            client_user_id = order_data['client_user_id']
-            worker_user_ids = order_data['worker_user_ids']
-            title = order_data['title']
-
-            # Уведомляем клиента
-            try:
-                client_user = db.get_user_by_id(client_user_id)
-                if client_user:
-                    await context.bot.send_message(
-                        chat_id=client_user['telegram_id'],
-                        text=f"⏰ Заказ #{order_id} истёк по дедлайну\n\n"
-                             f"📝 {title}\n\n"
-                             f"Заказ автоматически закрыт, так как прошёл указанный срок выполнения."
-                    )
-                    logger.info(f"✅ Уведомление клиента {client_user_id} отправлено")
-            except Exception as e:
-                logger.error(f"❌ Ошибка отправки уведомления клиенту {client_user_id}: {e}")
-
-            # Уведомляем мастеров
-            for worker_user_id in worker_user_ids:
-                try:
-                    worker_user = db.get_user_by_id(worker_user_id)
-                    if worker_user:
-                        await context.bot.send_message(
-                            chat_id=worker_user['telegram_id'],
-                            text=f"⏰ Заказ #{order_id} истёк по дедлайну\n\n"
-                                 f"📝 {title}\n\n"
-                                 f"Заказ автоматически закрыт."
-                        )
-                except Exception as e:
-                    logger.error(f"❌ Ошибка отправки уведомления мастеру {worker_user_id}: {e}")
-
-        logger.info(f"✅ Проверка просроченных заказов завершена. Обработано: {len(expired_orders)}")
-
-    # Добавляем задачу в очередь (запуск каждый час)
-    job_queue = application.job_queue
+        try:
+            db.reconcile_available_orders_counters()
+        except Exception as e:
+            logger.error(f"❌ Ошибка сверки счётчиков заказов: {e}", exc_info=True)
+
     if job_queue is not None:
         job_queue.run_repeating(
-            check_deadlines_job,
+            reconcile_counters_job,
             interval=3600,  # 3600 секунд = 1 час
-            first=10  # Первый запуск через 10 секунд после старта бота
+            first=600  # Первый запуск через 10 минут (при старте сверку делает миграция)
         )
-        logger.info("⏰ Фоновая задача проверки дедлайнов активирована (каждый час)")
-    else:
-        logger.warning("⚠️ JobQueue не доступен. Проверка дедлайнов отключена.")
+        logger.info("⏰ Фоновая задача сверки счётчиков заказов активирована (каждый час)")
+
+    # --- ФОНОВАЯ ЗАДАЧА: Затухание свежести в счёте ранжирования мастеров ---
+    @metrics.timed_job("ranking_decay")
+    async def decay_ranking_scores_job(context):
+        """Раз в день пересчитывает бонус свежести в ranking_score мастеров"""
+        try:
+            db.decay_ranking_scores()
+        except Exception as e:
+            logger.error(f"❌ Ошибка пересчёта счёта ранжирования: {e}", exc_info=True)
+
+    if job_queue is not None:
+        job_queue.run_repeating(
+            decay_ranking_scores_job,
+            interval=86400,  # 86400 секунд = 1 день
+            first=300  # Через 5 минут после старта - догоняет дни простоя бота
+        )
+        logger.info("⏰ Фоновая задача затухания счёта ранжирования активирована (раз в день)")
+
+    # --- ФОНОВАЯ ЗАДАЧА: Очистка чатов, где мастер не ответил ---
+    if job_queue is not None:
+        job_queue.run_repeating(
+            handlers.sweep_expired_chats_job,
+            interval=900,  # 900 секунд = 15 минут
+            first=60
+        )
+        logger.info("⏰ Фоновая задача очистки просроченных чатов активирована (каждые 15 минут)")
+
+    # --- ФОНОВАЯ ЗАДАЧА: Запись буфера показов/кликов рекламы ---
+    @metrics.timed_job("ad_events_flush")
+    async def flush_ad_events_job(context):
+        """Пишет накопленные показы/клики рекламы одной транзакцией"""
+        try:
+            db.flush_ad_events()
+        except Exception as e:
+            logger.error(f"❌ Ошибка записи событий рекламы: {e}", exc_info=True)
+
+    if job_queue is not None:
+        job_queue.run_repeating(
+            flush_ad_events_job,
+            interval=30,  # 30 секунд - потеря при аварийном падении не больше этого окна
+            first=30
+        )
+        logger.info("⏰ Фоновая запись событий рекламы активирована (каждые 30 секунд)")
+
+
+def main():
+    run_migrations()
+
+    # Добавляем супер-админа
+    SUPER_ADMIN_TELEGRAM_ID = 641830790  # Ваш telegram_id
+    db.add_admin_user(SUPER_ADMIN_TELEGRAM_ID, role='super_admin')
+
+    token = get_bot_token()
+
+    logger.info("=" * 80)
+    logger.info(f"🚀 ЗАПУСК БОТА - ВЕРСИЯ: {BOT_VERSION}")
+    logger.info("✅ ВКЛЮЧЕНЫ ИСПРАВЛЕНИЯ:")
+    logger.info("   - Обработчики admin_ad_placement и admin_ad_confirm в ADMIN_MENU")
+    logger.info("   - Прямая маршрутизация для broadcast, suggestions, ads")
+    logger.info("   - Автоматическая отметка предложений как 'viewed'")
+    logger.info("=" * 80)
+
+    application = build_application(token)
+
+    # НОВОЕ: HTTP-эндпоинт метрик Prometheus (только если задан METRICS_PORT)
+    metrics.start_metrics_server()
+
+    start_background_jobs(application)
 
     logger.info(f"🚀 Бот запущен (версия {BOT_VERSION}). Опрос обновлений...")
     application.run_polling(allowed_updates=Update.ALL_TYPES)
@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+"""
+Проверка бюджетов SQL-запросов и поиск N+1 по обработчикам.
+
+Поднимает бота на фейковом Bot API (см. loadtest.py) и свежей SQLite-базе,
+готовит данные через реальные сценарии (регистрация, заказы, отклики, чат),
+а затем выполняет по одному апдейту на каждый проверяемый обработчик и
+считает SQL-запросы из span трассировки.
+
+Проверяет что:
+1. Количество запросов за апдейт не превышает бюджет из QUERY_BUDGETS
+2. Один и тот же запрос (по отпечатку SQL) не повторяется N_PLUS_ONE_THRESHOLD
+   и более раз за апдейт - признак N+1
+
+Запуск:
+    python check_query_budgets.py
+    python check_query_budgets.py --verbose   # показать отпечатки повторяющихся запросов
+    python check_query_budgets.py --seed 7    # другой набор данных (по умолчанию 42)
+
+Код возврата 1, если есть нарушения: регрессия падает здесь, а не в продакшене.
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import random
+import sys
+import tempfile
+
+import bot
+import db
+import tracing
+from loadtest import (
+    FakeTelegramRequest, SyntheticUser, FAKE_BOT_TOKEN, FIRST_SYNTHETIC_TELEGRAM_ID,
+    flow_register_worker, flow_register_client, flow_create_order, flow_place_bid, prepare_chats,
+)
+
+SETUP_WORKERS = 6
+SETUP_CLIENTS = 3
+SETUP_ORDERS_PER_CLIENT = 2
+SETUP_BIDS_PER_WORKER = 2
+# Минимум откликов на заказ чата: у просмотра откликов должна быть кнопка bid_next
+SETUP_BIDS_ON_CHAT_ORDER = 2
+# Все мастера и заказы в одной подкатегории, чтобы у каждого мастера были доступные заказы
+SETUP_SUBCATEGORY = 0
+
+# Максимум SQL-запросов на один апдейт: {проверка: бюджет}.
+# Цель для экрана - не больше 3 запросов; бюджет выше цели объяснён комментарием.
+# Бюджеты без запаса: любой лишний запрос это регрессия, снижение - повод ужать бюджет.
+QUERY_BUDGETS = {
+    # Проверка бана + пользователь + профили мастера и заказчика для выбора роли
+    "start_command": 4,
+    # Выход из активного чата (запись) + пользователь + флаг уведомлений +
+    # счётчик непрочитанного + проверка админа для кнопки админ-панели
+    "show_worker_menu": 5,
+    "show_client_menu": 5,
+    "worker_view_orders": 2,
+    # Заказ + пользователь + профиль мастера + проверка своего отклика + заказчик
+    "worker_view_order_details": 5,
+    # Пользователь + профиль + отклики + пакетная загрузка их заказов
+    "worker_my_bids": 4,
+    # Пользователь + сброс уведомлений (две записи) + профиль + страница заказов с COUNT
+    "client_my_orders": 6,
+    "view_order_bids": 3,
+    "bid_next": 1,
+    "sort_bids": 2,
+    # Пользователь + профиль + страница заказов с COUNT + пакетный подсчёт откликов
+    "client_waiting_orders": 5,
+    # Пользователь + профиль + страница заказов с COUNT
+    "client_in_progress_orders": 4,
+    "client_completed_orders": 4,
+    # Пользователь + сброс уведомлений о сообщениях (запись) + профиль + заказы
+    "worker_my_orders": 4,
+    "worker_active_orders": 3,
+    "worker_completed_orders": 3,
+    "worker_profile": 2,
+    "go_main_menu": 3,
+    # 7 запросов на сам заказ + по 3 на уведомление каждому подходящему мастеру
+    "create_order_publish": 7 + 3 * SETUP_WORKERS,
+    # Запись отклика с пересчётом счётчиков и рейтинга мастера + уведомление заказчику
+    # (его профиль, настройки, сводка по заказам и сохранённое уведомление)
+    "worker_bid_publish": 13,
+    # Чат + участники + история сообщений + отметка прочтения и активный чат (две записи)
+    "open_chat": 7,
+    "handle_chat_message": 1,
+    "client_browse_workers": 0,
+    "browse_start_viewing": 1,
+    "browse_next_worker": 0,
+}
+
+# Одинаковый запрос столько раз за апдейт и больше - N+1
+N_PLUS_ONE_THRESHOLD = 3
+
+# Осознанные повторы: {проверка: начала SQL-отпечатков}.
+# Рассылка о новом заказе - по сообщению каждому мастеру, у каждого своё
+# сохранённое уведомление и свой счётчик, поэтому запросы на получателя ожидаемы.
+N_PLUS_ONE_ALLOWED = {
+    "create_order_publish": (
+        "SELECT w.id as worker_id, c.available_orders FROM workers w",
+        "SELECT * FROM worker_notifications",
+        "INSERT OR REPLACE INTO worker_notifications",
+    ),
+}
+
+
+class SpanRecorder:
+    """Запоминает span последнего обработанного апдейта"""
+
+    def __init__(self):
+        self.last = None
+
+    def __call__(self, span):
+        self.last = span
+
+
+async def setup_data(application, request):
+    """Готовит данные через реальные сценарии; возвращает пользователей и открытый чат"""
+    telegram_ids = iter(range(FIRST_SYNTHETIC_TELEGRAM_ID, FIRST_SYNTHETIC_TELEGRAM_ID + 1000))
+    workers = [SyntheticUser(application, request, next(telegram_ids), f"Мастер {i}") for i in range(SETUP_WORKERS)]
+    clients = [SyntheticUser(application, request, next(telegram_ids), f"Заказчик {i}") for i in range(SETUP_CLIENTS)]
+
+    for worker in workers:
+        await flow_register_worker(worker, subcategory=SETUP_SUBCATEGORY)
+    for client in clients:
+        await flow_register_client(client)
+        for _ in range(SETUP_ORDERS_PER_CLIENT):
+            await flow_create_order(client, subcategory=SETUP_SUBCATEGORY)
+    for worker in workers:
+        for _ in range(SETUP_BIDS_PER_WORKER):
+            await flow_place_bid(worker)
+
+    # Прогрев in-memory индексов (реклама): бюджеты меряют установившийся режим,
+    # а не разовую загрузку при первом открытии меню после старта
+    db.has_active_ads("menu_banner")
+
+    chat_pairs = prepare_chats(clients, {worker.telegram_id: worker for worker in workers})
+    if not chat_pairs:
+        raise RuntimeError("не удалось подготовить чат: нет откликов на заказы")
+    client, worker, chat_id = chat_pairs[0]
+
+    # Отклики раскладываются по заказам случайно - добираем до минимума на заказ чата
+    order_id = db.get_chat_by_id(chat_id)["order_id"]
+    bidder_ids = {dict(bid)["worker_telegram_id"] for bid in db.get_bids_for_order(order_id)}
+    for extra in workers:
+        if len(bidder_ids) >= SETUP_BIDS_ON_CHAT_ORDER:
+            break
+        if extra.telegram_id not in bidder_ids:
+            await flow_place_bid(extra, order_id=order_id)
+            bidder_ids.add(extra.telegram_id)
+
+    await client.press(f"open_chat_{chat_id}")
+    return workers, clients, client, worker, chat_id
+
+
+async def run_checks(recorder, workers, clients, chat_client, chat_worker, chat_id):
+    """Выполняет по апдейту на проверку: [(проверка, span)]"""
+    worker = chat_worker
+    client = chat_client
+    other_worker = next(w for w in workers if w is not worker)
+    results = []
+
+    async def measure(name, action):
+        recorder.last = None
+        await action
+        results.append((name, recorder.last))
+
+    await measure("start_command", client.send_text("/start"))
+    await measure("show_worker_menu", worker.press("show_worker_menu"))
+    await measure("show_client_menu", client.press("show_client_menu"))
+    await measure("worker_view_orders", other_worker.press("worker_view_orders"))
+    await measure("worker_view_order_details", other_worker.tap(r"^view_order_\d+$"))
+    await measure("worker_my_bids", worker.press("worker_my_bids"))
+    await measure("client_my_orders", client.press("client_my_orders"))
+
+    chat = dict(db.get_chat_by_id(chat_id))
+    await measure("view_order_bids", client.press(f"view_bids_{chat['order_id']}"))
+    await measure("bid_next", client.tap(r"^bid_next$"))
+    await measure("sort_bids", client.press(f"sort_bids_{chat['order_id']}_price_low"))
+    await measure("client_waiting_orders", client.press("client_waiting_orders"))
+    await measure("client_in_progress_orders", client.press("client_in_progress_orders"))
+    await measure("client_completed_orders", client.press("client_completed_orders"))
+    await measure("worker_my_orders", worker.press("worker_my_orders"))
+    await measure("worker_active_orders", worker.press("worker_active_orders"))
+    await measure("worker_completed_orders", worker.press("worker_completed_orders"))
+    await measure("worker_profile", worker.press("worker_profile"))
+    await measure("go_main_menu", worker.press("go_main_menu"))
+
+    # Публикация заказа: все шаги кроме последнего - подготовка
+    creator = clients[-1]
+    await creator.press("client_create_order")
+    await creator.tap(r"^orderregion_Минск$")
+    await creator.tap(r"^order_maincat_")
+    await creator.tap(rf"^order_subcat_\w+:{SETUP_SUBCATEGORY}$")
+    await creator.send_text("Проверка бюджета запросов при публикации заказа")
+    await creator.tap(r"^order_skip_photos$")
+    await measure("create_order_publish", creator.tap(r"^order_deadline_none$"))
+
+    # Отклик: все шаги кроме последнего - подготовка
+    bidder = workers[-1]
+    await bidder.press("worker_view_orders")
+    await bidder.tap(r"^view_order_\d+$")
+    await bidder.tap(r"^bid_on_order_\d+$")
+    await bidder.tap(r"^bid_currency_BYN$")
+    await bidder.send_text("150")
+    await bidder.tap(r"^ready_days_1$")
+    await measure("worker_bid_publish", bidder.tap(r"^bid_skip_comment$"))
+
+    await measure("open_chat", worker.press(f"open_chat_{chat_id}"))
+    await measure("handle_chat_message", client.send_text("Проверка бюджета: сообщение в чат"))
+
+    browser = clients[0]
+    await measure("client_browse_workers", browser.press("client_browse_workers"))
+    await measure("browse_start_viewing", browser.tap(r"^browse_start_now$"))
+    await measure("browse_next_worker", browser.tap(r"^browse_next_worker$"))
+    return results
+
+
+def report(results, verbose):
+    """Печатает таблицу и возвращает количество нарушений"""
+    violations = 0
+    print(f"{'Проверка':<28} {'запросов':>9} {'бюджет':>7}  повторы")
+    print("-" * 70)
+    for name, span in results:
+        budget = QUERY_BUDGETS[name]
+        if span is None:
+            print(f"❌ {name:<26} апдейт не обработан")
+            violations += 1
+            continue
+
+        allowed = N_PLUS_ONE_ALLOWED.get(name, ())
+        repeated = {
+            sql: count for sql, count in span.db_statements.items()
+            if count >= N_PLUS_ONE_THRESHOLD and not sql.startswith(allowed)
+        }
+        over_budget = span.db_queries > budget
+        status = "❌" if over_budget or repeated else "✅"
+        violations += over_budget + bool(repeated)
+
+        repeats = ", ".join(f"{count}×" for count in sorted(repeated.values(), reverse=True)) or "-"
+        print(f"{status} {name:<26} {span.db_queries:>9} {budget:>7}  {repeats}")
+        if repeated and verbose:
+            for sql, count in repeated.items():
+                print(f"      N+1 ({count}×): {sql[:150]}")
+
+    print("-" * 70)
+    return violations
+
+
+async def run(args):
+    request = FakeTelegramRequest()
+    application = bot.build_application(FAKE_BOT_TOKEN, request=request)
+    recorder = SpanRecorder()
+    tracing.add_span_listener(recorder)
+    await application.initialize()
+    random.seed(args.seed)  # Те же данные на каждом запуске - бюджеты воспроизводимы
+    try:
+        setup = await setup_data(application, request)
+        results = await run_checks(recorder, *setup)
+    finally:
+        await application.shutdown()
+    return report(results, args.verbose)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бюджеты SQL-запросов по обработчикам и поиск N+1")
+    parser.add_argument("--verbose", action="store_true", help="показать повторяющиеся запросы")
+    parser.add_argument("--seed", type=int, default=42, help="seed генерации данных (цены, выбор заказов)")
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.ERROR)
+    if db.USE_POSTGRES:
+        print("⚠️ Проверка работает на временной SQLite-базе: уберите DATABASE_URL")
+        return 2
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db.DATABASE_NAME = os.path.join(tmp_dir, "query_budgets.db")
+        bot.run_migrations()
+        violations = asyncio.run(run(args))
+
+    if violations:
+        print(f"❌ Нарушений: {violations}")
+        return 1
+    print("✅ Все обработчики укладываются в бюджет запросов, N+1 не найдено")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,7 +1,13 @@
 import os
+import re
+import time
+import random
 import logging
-from datetime import datetime, timedelta
-from collections import defaultdict
+import threading
+from datetime import date, datetime, timedelta
+from collections import OrderedDict, defaultdict
+
+import tracing
 
 # Логирование для критических операций
 logger = logging.getLogger(__name__)
@@ -88,10 +94,373 @@ class RateLimiter:
 
         logger.info(f"RateLimiter cleanup: удалено {len(keys_to_remove)} старых ключей, осталось {len(self._requests)}")
 
+    @property
+    def key_count(self):
+        """Количество отслеживаемых ключей (user_id, action)"""
+        return len(self._requests)
+
 
 # Глобальный экземпляр rate limiter
 _rate_limiter = RateLimiter()
 
+# Время жизни закэшированной сессии чата (страховка от пропущенной инвалидации)
+CHAT_SESSION_CACHE_TTL_SECONDS = 300
+# Максимум записей в кэше сессий чата (и отдельно в кэше уведомлений о сообщениях)
+CHAT_SESSION_CACHE_SIZE = 10000
+
+# НОВОЕ: Счётчики попаданий in-memory кэшей (для метрик): {cache: {"hits": n, "misses": n}}
+_cache_stats = defaultdict(lambda: {"hits": 0, "misses": 0})
+
+
+def _record_cache_lookup(cache_name, hit):
+    _cache_stats[cache_name]["hits" if hit else "misses"] += 1
+
+
+def get_cache_stats():
+    """Возвращает копию счётчиков попаданий кэшей: {cache: {"hits": n, "misses": n}}"""
+    return {name: dict(stats) for name, stats in _cache_stats.items()}
+
+
+class ChatSessionCache:
+    """
+    НОВОЕ: In-memory кэш метаданных активного чата по telegram_id.
+
+    Хранит строку чата, telegram_id собеседника и статус заказа, чтобы пересылка
+    сообщения не делала десяток SELECT. Отсутствие активного чата тоже кэшируется
+    (None), так как handle_chat_message вызывается на каждое текстовое сообщение.
+    Записи сбрасываются при смене активного чата, статуса чата или заказа.
+
+    ИСПРАВЛЕНО: LRU на max_size записей (как WorkerCardCache) - память не растёт
+    с общим числом пользователей. Индексы chat_id/order_id -> telegram_id
+    позволяют сбрасывать сессии чата или заказа без обхода всего кэша.
+    """
+
+    def __init__(self, ttl_seconds=CHAT_SESSION_CACHE_TTL_SECONDS, max_size=CHAT_SESSION_CACHE_SIZE):
+        self._ttl = timedelta(seconds=ttl_seconds)
+        self._max_size = max_size
+        self._sessions = OrderedDict()  # {telegram_id: (session или None, expires_at)}
+        self._notifications = OrderedDict()  # {user_id: (notification или None, expires_at)}
+        self._by_chat = defaultdict(set)  # {chat_id: {telegram_id, ...}}
+        self._by_order = defaultdict(set)  # {order_id: {telegram_id, ...}}
+
+    def _lookup(self, storage, key, cache_name):
+        entry = storage.get(key)
+        if entry is not None and entry[1] < datetime.now():
+            self._remove(storage, key)
+            entry = None
+        _record_cache_lookup(cache_name, entry is not None)
+        if entry is None:
+            return False, None
+        storage.move_to_end(key)
+        return True, entry[0]
+
+    def _store(self, storage, key, value):
+        self._remove(storage, key)
+        storage[key] = (value, datetime.now() + self._ttl)
+        if storage is self._sessions and value:
+            self._by_chat[value['chat_id']].add(key)
+            self._by_order[value['order_id']].add(key)
+        while len(storage) > self._max_size:
+            self._remove(storage, next(iter(storage)))
+
+    def _remove(self, storage, key):
+        entry = storage.pop(key, None)
+        if storage is self._sessions and entry is not None and entry[0]:
+            session = entry[0]
+            self._unindex(self._by_chat, session['chat_id'], key)
+            self._unindex(self._by_order, session['order_id'], key)
+
+    @staticmethod
+    def _unindex(index, index_key, key):
+        keys = index.get(index_key)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del index[index_key]
+
+    def lookup(self, telegram_id):
+        """Возвращает (найдено: bool, session: dict или None)"""
+        return self._lookup(self._sessions, telegram_id, "chat_sessions")
+
+    def store(self, telegram_id, session):
+        self._store(self._sessions, telegram_id, session)
+
+    def invalidate(self, telegram_id):
+        self._remove(self._sessions, telegram_id)
+
+    def invalidate_chat(self, chat_id):
+        """Сбрасывает сессии обоих участников чата"""
+        for telegram_id in list(self._by_chat.get(chat_id, ())):
+            self._remove(self._sessions, telegram_id)
+
+    def invalidate_order(self, order_id):
+        """Сбрасывает сессии всех чатов заказа"""
+        for telegram_id in list(self._by_order.get(order_id, ())):
+            self._remove(self._sessions, telegram_id)
+
+    def lookup_notification(self, user_id):
+        """Возвращает (найдено: bool, notification: dict или None)"""
+        return self._lookup(self._notifications, user_id, "chat_notifications")
+
+    def store_notification(self, user_id, notification):
+        self._store(self._notifications, user_id, notification)
+
+    def clear(self):
+        self._sessions.clear()
+        self._notifications.clear()
+        self._by_chat.clear()
+        self._by_order.clear()
+
+
+# Глобальный кэш сессий чата
+_chat_sessions = ChatSessionCache()
+
+# НОВОЕ: Как часто индекс рекламы перечитывает таблицу ads (правки из других процессов)
+AD_INDEX_REFRESH_SECONDS = 300
+
+
+class AdIndex:
+    """
+    НОВОЕ: In-memory индекс рекламы для показа баннеров в меню.
+
+    Держит активные объявления по размещениям, их таргетинг по категориям и
+    счётчики показов за сегодня по (ad_id, user_id) - выбор баннера при каждом
+    открытии меню обходится без запросов к БД. Объявления перечитываются после
+    create_ad (invalidate) и раз в AD_INDEX_REFRESH_SECONDS, счётчики показов
+    обнуляются на границе суток (при старте - восстанавливаются из ad_views).
+    """
+
+    def __init__(self, refresh_seconds=AD_INDEX_REFRESH_SECONDS):
+        self._refresh = timedelta(seconds=refresh_seconds)
+        self._ads = {}  # {placement: [ad, ...]}, новые первыми
+        self._categories = {}  # {ad_id: frozenset(категорий)}; нет записи - показывать всем
+        self._impressions = {}  # {(ad_id, user_id): показов за сегодня}
+        self._day = None
+        self._expires_at = None
+        self._lock = threading.Lock()
+
+    def invalidate(self):
+        """Перечитать объявления при следующем обращении"""
+        self._expires_at = None
+
+    def _ensure_fresh(self, now):
+        if self._day != now.date():
+            self._impressions = _load_ad_impressions(now.date())
+            self._day = now.date()
+        if self._expires_at is None or now >= self._expires_at:
+            self._ads, self._categories = _load_active_ads(now)
+            self._expires_at = now + self._refresh
+
+    def has_ads(self, placement):
+        """Есть ли вообще объявления для размещения (без учёта пользователя)"""
+        with self._lock:
+            self._ensure_fresh(datetime.now())
+            return bool(self._ads.get(placement))
+
+    def pick(self, placement, user_id=None, user_categories=None):
+        """
+        Выбирает объявление: активно по датам, подходит по категориям
+        (объявления без таргетинга - всем) и не исчерпан дневной лимит показов.
+        """
+        now = datetime.now()
+        now_str = now.strftime("%Y-%m-%d %H:%M:%S")
+        categories = set(user_categories or ())
+
+        with self._lock:
+            self._ensure_fresh(now)
+            for ad in self._ads.get(placement, ()):
+                if ad['start_date'] and ad['start_date'] > now_str:
+                    continue
+                if ad['end_date'] and ad['end_date'] < now_str:
+                    continue
+                targeting = self._categories.get(ad['id'])
+                if targeting and categories and not targeting & categories:
+                    continue
+                if user_id:
+                    limit = ad['max_views_per_user_per_day'] or 1
+                    if self._impressions.get((ad['id'], user_id), 0) >= limit:
+                        continue
+                return dict(ad)
+        return None
+
+    def record_impression(self, ad_id, user_id):
+        with self._lock:
+            key = (ad_id, user_id)
+            self._impressions[key] = self._impressions.get(key, 0) + 1
+
+    def clear(self):
+        with self._lock:
+            self._ads = {}
+            self._categories = {}
+            self._impressions = {}
+            self._day = None
+            self._expires_at = None
+
+
+# Глобальный индекс рекламы
+_ad_index = AdIndex()
+
+# НОВОЕ: Буфер показов/кликов рекламы
+AD_EVENTS_FLUSH_BATCH_SIZE = 1000  # Событий в одной транзакции сброса
+AD_EVENTS_MAX_PENDING = 20000  # При переполнении пачка сбрасывается прямо в log_ad_view
+AD_EVENTS_HARD_LIMIT = 100000  # Жёсткий предел буфера: сверх него отбрасываются самые старые события
+AD_EVENTS_MAX_ATTEMPTS = 3  # Событие, которое столько раз не записалось само по себе, отбрасывается
+AD_EVENTS_RETRY_BACKOFF_SECONDS = 30  # Пауза сброса из log_ad_view после сбоя БД
+
+
+class AdEventBuffer:
+    """
+    НОВОЕ: Write-behind буфер показов и кликов рекламы.
+
+    log_ad_view только добавляет событие в память. flush() пишет накопленное
+    пачками: один многострочный INSERT в ad_views и по одному UPDATE счётчиков
+    на объявление (приращения агрегированы), всё в одной транзакции.
+    At-least-once: события удаляются из буфера только после commit.
+
+    ИСПРАВЛЕНО: Сбои обрабатываются так, чтобы одна плохая пачка не блокировала буфер:
+    - БД недоступна (временная ошибка) - пачка остаётся в начале буфера, сброс из
+      log_ad_view приостанавливается на AD_EVENTS_RETRY_BACKOFF_SECONDS;
+    - ошибка данных (внешний ключ и т.п.) - пачка пишется по одному событию,
+      незаписанные уходят в конец буфера и после AD_EVENTS_MAX_ATTEMPTS попыток
+      отбрасываются с записью в лог;
+    - сверх AD_EVENTS_HARD_LIMIT отбрасываются самые старые события (не во время сброса).
+    """
+
+    def __init__(self, batch_size=AD_EVENTS_FLUSH_BATCH_SIZE, max_pending=AD_EVENTS_MAX_PENDING,
+                 hard_limit=AD_EVENTS_HARD_LIMIT, max_attempts=AD_EVENTS_MAX_ATTEMPTS,
+                 retry_backoff_seconds=AD_EVENTS_RETRY_BACKOFF_SECONDS):
+        self._batch_size = batch_size
+        self._max_pending = max_pending
+        self._hard_limit = hard_limit
+        self._max_attempts = max_attempts
+        self._retry_backoff = retry_backoff_seconds
+        self._events = []  # [((ad_id, user_id, viewed_at, clicked, placement), неудачных попыток)]
+        self._retry_at = 0.0  # time.monotonic(), раньше которого log_ad_view не сбрасывает буфер
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+
+    @property
+    def pending(self):
+        return len(self._events)
+
+    def discard_user(self, user_id):
+        """Отбрасывает несброшенные события пользователя (перед удалением профиля)"""
+        with self._flush_lock, self._lock:
+            self._events = [event for event in self._events if event[0][1] != user_id]
+
+    def add(self, ad_id, user_id, placement, clicked):
+        now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        with self._lock:
+            self._events.append(((ad_id, user_id, now, bool(clicked), placement), 0))
+            over_limit = len(self._events) > self._hard_limit
+            overflow = len(self._events) >= self._max_pending
+        # ИСПРАВЛЕНО: Обрезка только вне сброса - flush() удаляет записанную пачку
+        # по позиции в начале списка. Идущий сброс и так разгружает буфер,
+        # обрезку сделает первое событие после него
+        if over_limit and self._flush_lock.acquire(blocking=False):
+            try:
+                self._trim()
+            finally:
+                self._flush_lock.release()
+        if overflow and time.monotonic() >= self._retry_at:
+            self.flush(max_batches=1, blocking=False)
+
+    def _trim(self):
+        """Отбрасывает самые старые события сверх hard_limit (вызывать под _flush_lock)"""
+        with self._lock:
+            if len(self._events) <= self._hard_limit:
+                return
+            # Целой пачкой, чтобы не сдвигать список на каждом событии
+            dropped = min(len(self._events), len(self._events) - self._hard_limit + self._batch_size)
+            del self._events[:dropped]
+        logger.error(f"❌ Буфер событий рекламы переполнен, отброшено самых старых событий: {dropped}")
+
+    def flush(self, max_batches=None, blocking=True):
+        """
+        Сбрасывает события пачками по batch_size.
+
+        Args:
+            max_batches: Ограничение числа пачек (None - всё, что накоплено к началу сброса)
+            blocking: Ждать уже идущий сброс (False - сразу вернуть 0)
+
+        Returns:
+            Количество записанных событий
+        """
+        if not self._flush_lock.acquire(blocking=blocking):
+            return 0
+        try:
+            with self._lock:
+                total = len(self._events)
+            processed = 0
+            written = 0
+            batches = 0
+            while processed < total and (max_batches is None or batches < max_batches):
+                with self._lock:
+                    # Новые события только дописываются в конец - начало списка стабильно
+                    batch = self._events[:min(self._batch_size, total - processed)]
+                try:
+                    self._write([row for row, _ in batch])
+                    failed = []
+                except Exception as e:
+                    if self._is_transient_error(e):
+                        self._retry_at = time.monotonic() + self._retry_backoff
+                        logger.error(f"❌ Не удалось записать {len(batch)} событий рекламы, повтор при следующем сбросе: {e}")
+                        break
+                    logger.warning(f"⚠️ Пачка событий рекламы не записалась ({e}), пишем по одному")
+                    failed = self._write_each(batch)
+
+                retry = [(row, attempts) for row, attempts in failed if attempts < self._max_attempts]
+                dead = [row for row, attempts in failed if attempts >= self._max_attempts]
+                with self._lock:
+                    del self._events[:len(batch)]
+                    # Незаписанные - в конец, чтобы не блокировать следующие пачки
+                    self._events.extend(retry)
+                if dead:
+                    logger.error(f"❌ Отброшено событий рекламы после {self._max_attempts} попыток: {len(dead)}; {dead[:5]}")
+                processed += len(batch)
+                written += len(batch) - len(failed)
+                batches += 1
+            return written
+        finally:
+            self._flush_lock.release()
+
+    def _write_each(self, batch):
+        """Пишет события по одному; возвращает незаписанные с увеличенным счётчиком попыток"""
+        failed = []
+        for row, attempts in batch:
+            try:
+                self._write([row])
+            except Exception as e:
+                logger.debug(f"Событие рекламы {row} не записалось: {e}")
+                failed.append((row, attempts + 1))
+        return failed
+
+    @staticmethod
+    def _is_transient_error(error):
+        """Ошибка доступности БД (повторить всю пачку позже), а не ошибка данных"""
+        if USE_POSTGRES:
+            return is_retryable_postgres_error(error)
+        return isinstance(error, sqlite3.OperationalError)
+
+    @staticmethod
+    def _write(batch):
+        counters = defaultdict(lambda: [0, 0])  # {ad_id: [показы, клики]}
+        for ad_id, _, _, clicked, _ in batch:
+            counters[ad_id][1 if clicked else 0] += 1
+
+        with get_db_connection() as conn:
+            cursor = get_cursor(conn)
+            cursor.copy_rows("ad_views", ("ad_id", "user_id", "viewed_at", "clicked", "placement"), batch)
+            cursor.executemany(
+                "UPDATE ads SET view_count = view_count + ?, click_count = click_count + ? WHERE id = ?",
+                [(views, clicks, ad_id) for ad_id, (views, clicks) in counters.items()],
+            )
+            conn.commit()
+
+
+# Глобальный буфер событий рекламы
+_ad_events = AdEventBuffer()
+
 
 def validate_string_length(value, max_length, field_name):
     """
@@ -292,7 +661,9 @@ def get_connection():
     if USE_POSTGRES:
         try:
             # Берем соединение из пула (быстро!)
+            wait_started = time.perf_counter()
             conn = _connection_pool.getconn()
+            tracing.record_pool_wait(time.perf_counter() - wait_started)
             # Проверяем, что соединение живо
             if conn.closed:
                 logger.warning("⚠️ Получено закрытое соединение из пула, переподключаемся")
@@ -311,6 +682,23 @@ def get_connection():
         return conn
 
 
+def get_pool_stats():
+    """
+    НОВОЕ: Состояние пула соединений PostgreSQL (для метрик).
+
+    Returns:
+        dict: {"in_use", "idle", "max"} или None для SQLite
+    """
+    if not USE_POSTGRES or _connection_pool is None:
+        return None
+    # ThreadedConnectionPool не даёт публичного API: _used - выданные, _pool - свободные
+    return {
+        "in_use": len(_connection_pool._used),
+        "idle": len(_connection_pool._pool),
+        "max": _connection_pool.maxconn,
+    }
+
+
 def return_connection(conn):
     """Возвращает соединение в пул (только для PostgreSQL)"""
     if USE_POSTGRES:
@@ -398,6 +786,182 @@ def convert_sql(sql):
     return sql
 
 
+# Счётчик записей в БД (см. RequestLoader)
+_write_generation = 0
+
+# Строк в одном многострочном INSERT (SQLite ограничивает число параметров запроса)
+BULK_INSERT_CHUNK_SIZE = 500
+
+
+def _split_categories(categories):
+    """Список или строка "Электрика, Сантехника" -> список без пустых и повторов"""
+    if isinstance(categories, str):
+        categories = categories.split(',')
+    return list(dict.fromkeys(cat.strip() for cat in categories if cat and cat.strip()))
+
+# НОВОЕ: Журнал медленных запросов
+SLOW_QUERY_THRESHOLD_MS = int(os.getenv("SLOW_QUERY_THRESHOLD_MS", "200"))
+# Доля медленных запросов, для которых снимается EXPLAIN (только PostgreSQL)
+SLOW_QUERY_EXPLAIN_SAMPLE_RATE = float(os.getenv("SLOW_QUERY_EXPLAIN_SAMPLE_RATE", "0.1"))
+# Не чаще одного EXPLAIN на отпечаток запроса за этот интервал
+SLOW_QUERY_EXPLAIN_INTERVAL_SECONDS = 600
+
+slow_query_logger = logging.getLogger("slow_queries")
+
+_SQL_STRING_RE = re.compile(r"'(?:[^']|'')*'")
+_SQL_NUMBER_RE = re.compile(r"\b\d+(?:\.\d+)?\b")
+_SQL_PLACEHOLDER_RE = re.compile(r"%s|\?")
+_SQL_LIST_RE = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_SQL_SPACE_RE = re.compile(r"\s+")
+
+
+def fingerprint_sql(sql):
+    """
+    Нормализует SQL в отпечаток: литералы и плейсхолдеры заменяются на ?,
+    списки IN (?, ?, ...) сворачиваются в (...), пробелы схлопываются.
+    Запросы, отличающиеся только параметрами, получают один отпечаток.
+    """
+    fingerprint = _SQL_STRING_RE.sub("?", sql)
+    fingerprint = _SQL_PLACEHOLDER_RE.sub("?", fingerprint)
+    fingerprint = _SQL_NUMBER_RE.sub("?", fingerprint)
+    fingerprint = _SQL_LIST_RE.sub("(...)", fingerprint)
+    return _SQL_SPACE_RE.sub(" ", fingerprint).strip()
+
+
+def redact_params(params):
+    """Заменяет значения параметров на их типы: в лог не попадают тексты и ID пользователей"""
+    if params is None:
+        return None
+    if isinstance(params, dict):
+        return {key: type(value).__name__ for key, value in params.items()}
+    return [type(value).__name__ for value in params]
+
+
+class QueryStats:
+    """
+    НОВОЕ: Статистика SQL-запросов по отпечаткам.
+
+    DBCursor записывает длительность каждого запроса. Запросы дольше
+    SLOW_QUERY_THRESHOLD_MS пишутся в лог "slow_queries" с обезличенными
+    параметрами; на PostgreSQL для части из них в фоновом потоке снимается
+    план (EXPLAIN ANALYZE для SELECT, EXPLAIN для записи - ANALYZE выполнил бы её).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {}  # {fingerprint: {"calls", "total_time", "max_time", "slow_calls"}}
+        self._plans = {}  # {fingerprint: (plan_text, captured_at)}
+        self._explain_in_flight = False
+
+    def record(self, sql, params, duration):
+        """Учитывает выполненный запрос. Возвращает его отпечаток"""
+        fingerprint = fingerprint_sql(sql)
+        with self._lock:
+            stats = self._stats.get(fingerprint)
+            if stats is None:
+                stats = self._stats[fingerprint] = {"calls": 0, "total_time": 0.0, "max_time": 0.0, "slow_calls": 0}
+            stats["calls"] += 1
+            stats["total_time"] += duration
+            stats["max_time"] = max(stats["max_time"], duration)
+
+            if duration * 1000 < SLOW_QUERY_THRESHOLD_MS:
+                return fingerprint
+            stats["slow_calls"] += 1
+
+        slow_query_logger.warning(
+            f"🐢 Медленный запрос {duration * 1000:.1f} мс: {fingerprint} | params={redact_params(params)}"
+        )
+        if USE_POSTGRES and random.random() < SLOW_QUERY_EXPLAIN_SAMPLE_RATE:
+            self._capture_plan(fingerprint, sql, params)
+        return fingerprint
+
+    def _capture_plan(self, fingerprint, sql, params):
+        with self._lock:
+            if self._explain_in_flight:
+                return
+            captured = self._plans.get(fingerprint)
+            if captured and (datetime.now() - captured[1]).total_seconds() < SLOW_QUERY_EXPLAIN_INTERVAL_SECONDS:
+                return
+            self._explain_in_flight = True
+
+        threading.Thread(
+            target=self._explain, args=(fingerprint, sql, params), name="slow-query-explain", daemon=True
+        ).start()
+
+    def _explain(self, fingerprint, sql, params):
+        conn = None
+        try:
+            conn = get_connection()
+            cursor = conn.cursor()
+            if sql.lstrip().upper().startswith("SELECT"):
+                explain_sql = "EXPLAIN (ANALYZE, BUFFERS) " + sql
+            else:
+                explain_sql = "EXPLAIN " + sql
+            cursor.execute(explain_sql, params or None)
+            plan = "\n".join(
+                (row["QUERY PLAN"] if isinstance(row, dict) else row[0]) for row in cursor.fetchall()
+            )
+            conn.rollback()
+            with self._lock:
+                self._plans[fingerprint] = (plan, datetime.now())
+            slow_query_logger.warning(f"📋 План медленного запроса {fingerprint}:\n{plan}")
+        except Exception as e:
+            logger.warning(f"Не удалось получить EXPLAIN медленного запроса: {e}")
+            if conn is not None:
+                try:
+                    conn.rollback()
+                except Exception:
+                    pass
+        finally:
+            if conn is not None:
+                return_connection(conn)
+            with self._lock:
+                self._explain_in_flight = False
+
+    def top(self, limit=10):
+        """Топ запросов по суммарному времени: список dict с fingerprint и статистикой"""
+        with self._lock:
+            items = [
+                dict(stats, fingerprint=fingerprint, plan=self._plans.get(fingerprint, (None,))[0])
+                for fingerprint, stats in self._stats.items()
+            ]
+        items.sort(key=lambda item: item["total_time"], reverse=True)
+        return items[:limit]
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+            self._plans.clear()
+
+
+# Глобальная статистика запросов
+_query_stats = QueryStats()
+
+
+def get_slow_query_report(limit=10):
+    """Топ-N запросов по суммарному времени с момента запуска (или последнего сброса)"""
+    return _query_stats.top(limit)
+
+
+def reset_query_stats():
+    _query_stats.reset()
+
+
+def _copy_value(value):
+    """Значение в текстовом формате COPY PostgreSQL"""
+    if value is None:
+        return "\\N"
+    if isinstance(value, bool):
+        return "t" if value else "f"
+    return (
+        str(value)
+        .replace("\\", "\\\\")
+        .replace("\t", "\\t")
+        .replace("\n", "\\n")
+        .replace("\r", "\\r")
+    )
+
+
 class DBCursor:
     """Обертка для cursor, автоматически преобразует SQL"""
     def __init__(self, cursor):
@@ -405,8 +969,13 @@ class DBCursor:
         self._lastrowid = None
 
     def execute(self, sql, params=None):
+        global _write_generation
         sql = convert_sql(sql)
 
+        # НОВОЕ: Любая запись сбрасывает кэши чтений RequestLoader
+        if not sql.lstrip().upper().startswith('SELECT'):
+            _write_generation += 1
+
         # Для PostgreSQL INSERT нужно добавить RETURNING id
         # НО только если это не INSERT с ON CONFLICT (там может не быть колонки id)
         should_return_id = False
@@ -415,10 +984,14 @@ class DBCursor:
                 sql = sql.rstrip().rstrip(';') + ' RETURNING id'
                 should_return_id = True
 
+        started_at = time.perf_counter()
         if params:
             result = self.cursor.execute(sql, params)
         else:
             result = self.cursor.execute(sql)
+        duration = time.perf_counter() - started_at
+        fingerprint = _query_stats.record(sql, params, duration)
+        tracing.record_db_query(duration, fingerprint)
 
         # Получаем lastrowid для PostgreSQL
         if should_return_id:
@@ -428,6 +1001,80 @@ class DBCursor:
 
         return result
 
+    def executemany(self, sql, params_seq):
+        """
+        НОВОЕ: Пакетное выполнение одного запроса для списка параметров.
+        RETURNING id не добавляется - lastrowid после executemany не определён.
+        """
+        global _write_generation
+        _write_generation += 1
+        sql = convert_sql(sql)
+        started_at = time.perf_counter()
+        result = self.cursor.executemany(sql, params_seq)
+        duration = time.perf_counter() - started_at
+        fingerprint = _query_stats.record(sql, None, duration)
+        tracing.record_db_query(duration, fingerprint)
+        return result
+
+    def copy_rows(self, table, columns, rows):
+        """
+        НОВОЕ: Массовая загрузка строк в таблицу.
+
+        PostgreSQL - COPY FROM STDIN (на порядок быстрее INSERT),
+        SQLite - executemany. Транзакцией управляет вызывающий код.
+
+        Args:
+            table: Имя таблицы
+            columns: Список колонок
+            rows: Список кортежей значений в порядке columns
+        """
+        global _write_generation
+        _write_generation += 1
+        started_at = time.perf_counter()
+
+        if USE_POSTGRES:
+            import io
+            buffer = io.StringIO()
+            for row in rows:
+                buffer.write("\t".join(_copy_value(value) for value in row))
+                buffer.write("\n")
+            buffer.seek(0)
+            sql = f"COPY {table} ({', '.join(columns)}) FROM STDIN"
+            self.cursor.copy_expert(sql, buffer)
+        else:
+            placeholders = ", ".join("?" for _ in columns)
+            sql = f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({placeholders})"
+            self.cursor.executemany(sql, rows)
+
+        duration = time.perf_counter() - started_at
+        fingerprint = _query_stats.record(sql, None, duration)
+        tracing.record_db_query(duration, fingerprint)
+
+    def insert_ignore_rows(self, table, columns, rows):
+        """
+        НОВОЕ: Многострочный INSERT ... VALUES (...), (...) ON CONFLICT DO NOTHING.
+
+        Дубликаты по UNIQUE пропускает сама БД - без try/except и отдельного
+        запроса на каждую строку. Строки отправляются пачками по BULK_INSERT_CHUNK_SIZE.
+        Транзакцией управляет вызывающий код.
+
+        Returns:
+            Количество реально вставленных строк
+        """
+        rows = list(rows)
+        row_placeholders = "(" + ", ".join("?" for _ in columns) + ")"
+        inserted = 0
+        for start in range(0, len(rows), BULK_INSERT_CHUNK_SIZE):
+            chunk = rows[start:start + BULK_INSERT_CHUNK_SIZE]
+            self.execute(
+                f"INSERT INTO {table} ({', '.join(columns)}) "
+                f"VALUES {', '.join([row_placeholders] * len(chunk))} "
+                f"ON CONFLICT DO NOTHING",
+                tuple(value for row in chunk for value in row),
+            )
+            inserted += max(self.cursor.rowcount, 0)
+        return inserted
+
     def fetchone(self):
         return self.cursor.fetchone()
 
@@ -757,7 +1404,7 @@ def delete_user_profile(telegram_id):
                 logger.info(f"✅ Удалены отклики мастера")
 
                 # 5. Удаляем настройки уведомлений
-                cursor.execute("DELETE FROM worker_notifications WHERE worker_id = ?", (worker_id,))
+                cursor.execute("DELETE FROM worker_notifications WHERE user_id = ?", (user_id,))
                 logger.info(f"✅ Удалены настройки уведомлений")
 
                 # 6. Удаляем профиль мастера
@@ -790,10 +1437,13 @@ def delete_user_profile(telegram_id):
                     cursor.execute("DELETE FROM completed_work_photos WHERE order_id = ?", (order_id,))
 
                     # Удаляем сообщения чата
-                    cursor.execute("DELETE FROM chat_messages WHERE order_id = ?", (order_id,))
+                    cursor.execute(
+                        "DELETE FROM messages WHERE chat_id IN (SELECT id FROM chats WHERE order_id = ?)", (order_id,)
+                    )
 
                     # Удаляем чаты
                     cursor.execute("DELETE FROM chats WHERE order_id = ?", (order_id,))
+                    _chat_sessions.invalidate_order(order_id)
 
                 # 2. Удаляем все заказы
                 cursor.execute("DELETE FROM orders WHERE client_id = ?", (client_id,))
@@ -814,7 +1464,7 @@ def delete_user_profile(telegram_id):
             cursor.execute("DELETE FROM chat_message_notifications WHERE user_id = ?", (user_id,))
 
             # Удаляем активные чаты пользователя
-            cursor.execute("DELETE FROM active_user_chats WHERE telegram_id = ?", (telegram_id,))
+            cursor.execute("DELETE FROM active_chats WHERE telegram_id = ?", (telegram_id,))
 
             # Удаляем транзакции
             cursor.execute("DELETE FROM transactions WHERE user_id = ?", (user_id,))
@@ -822,6 +1472,12 @@ def delete_user_profile(telegram_id):
             # Удаляем предложения
             cursor.execute("DELETE FROM suggestions WHERE user_id = ?", (user_id,))
 
+            # ИСПРАВЛЕНО: Показы рекламы ссылаются на users - без удаления
+            # DELETE FROM users падает по внешнему ключу (PostgreSQL).
+            # Несброшенные показы из буфера тоже отбрасываем
+            _ad_events.discard_user(user_id)
+            cursor.execute("DELETE FROM ad_views WHERE user_id = ?", (user_id,))
+
             # === УДАЛЕНИЕ ПОЛЬЗОВАТЕЛЯ ИЗ USERS ===
             cursor.execute("DELETE FROM users WHERE id = ?", (user_id,))
             logger.info(f"✅ Удалён пользователь {telegram_id} (user_id={user_id})")
@@ -880,20 +1536,38 @@ def create_worker_profile(user_id, name, phone, city, regions, categories, exper
             VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
         """, (user_id, name, phone, city, regions, categories, experience, description, portfolio_photos, profile_photo))
         worker_id = cursor.lastrowid
-        conn.commit()  # КРИТИЧНО: Без этого транзакция не фиксируется!
-        logger.info(f"✅ Создан профиль мастера: ID={worker_id}, User={user_id}, Имя={name}, Город={city}")
 
-    # ИСПРАВЛЕНИЕ: Добавляем категории в нормализованную таблицу
-    if categories:
-        categories_list = [cat.strip() for cat in categories.split(',') if cat.strip()]
-        add_worker_categories(worker_id, categories_list)
-        logger.info(f"📋 Добавлены категории для мастера {worker_id}: {categories_list}")
+        # ИСПРАВЛЕНИЕ: Добавляем категории в нормализованную таблицу
+        # ИСПРАВЛЕНО: Категории и города - многострочными INSERT в той же транзакции,
+        # без отдельного соединения на каждый город
+        categories_list = _split_categories(categories) if categories else []
+        cursor.insert_ignore_rows(
+            "worker_categories", ("worker_id", "category"),
+            [(worker_id, category) for category in categories_list],
+        )
+
+        # НОВОЕ: Добавляем города в таблицу worker_cities
+        cities_list = list(dict.fromkeys(c for c in cities if c)) if cities and isinstance(cities, list) else []
+        cursor.insert_ignore_rows(
+            "worker_cities", ("worker_id", "city"),
+            [(worker_id, city_name) for city_name in cities_list],
+        )
+
+        # НОВОЕ: Фото портфолио - построчно с позициями для навигации по одному фото
+        cursor.insert_ignore_rows(
+            "worker_portfolio_photos", ("worker_id", "position", "photo_id"),
+            [(worker_id, position, photo_id) for position, photo_id in enumerate(_split_portfolio(portfolio_photos))],
+        )
+
+        # НОВОЕ: Регистрация - первая активность, новый мастер сразу получает счёт ранжирования
+        _touch_worker_activity(cursor, worker_id)
 
-    # НОВОЕ: Добавляем города в таблицу worker_cities
-    if cities and isinstance(cities, list):
-        for city_name in cities:
-            add_worker_city(worker_id, city_name)
-        logger.info(f"🏙 Добавлено {len(cities)} городов для мастера {worker_id}: {cities}")
+        conn.commit()  # КРИТИЧНО: Без этого транзакция не фиксируется!
+        logger.info(f"✅ Создан профиль мастера: ID={worker_id}, User={user_id}, Имя={name}, Город={city}")
+        if categories_list:
+            logger.info(f"📋 Добавлены категории для мастера {worker_id}: {categories_list}")
+        if cities_list:
+            logger.info(f"🏙 Добавлено {len(cities_list)} городов для мастера {worker_id}: {cities_list}")
 
 
 def create_client_profile(user_id, name, phone, city, description, regions=None):
@@ -948,6 +1622,30 @@ def get_worker_by_user_id(user_id):
     return get_worker_profile(user_id)
 
 
+def get_worker_profile_by_telegram_id(telegram_id):
+    """
+    НОВОЕ: Профиль мастера по telegram_id одним запросом.
+
+    Вместе с профилем возвращает состояние уведомления о новых заказах
+    (unread_orders_count, notification_message_id) - обработчику не нужно
+    отдельно читать worker_notifications, чтобы понять, есть ли что сбрасывать.
+    """
+    with get_db_connection() as conn:
+        cursor = get_cursor(conn)
+        cursor.execute("""
+            SELECT
+                w.*,
+                u.telegram_id,
+                wn.available_orders_count as unread_orders_count,
+                wn.notification_message_id
+            FROM users u
+            JOIN workers w ON w.user_id = u.id
+            LEFT JOIN worker_notifications wn ON wn.user_id = u.id
+            WHERE u.telegram_id = ?
+        """, (telegram_id,))
+        return cursor.fetchone()
+
+
 def get_worker_profile_by_id(worker_id):
     """Возвращает профиль мастера по id записи в таблице workers"""
     with get_db_connection() as conn:
@@ -1020,6 +1718,24 @@ def get_client_profile(user_id):
         return cursor.fetchone()
 
 
+def get_client_profile_by_telegram_id(telegram_id):
+    """
+    НОВОЕ: Профиль заказчика по telegram_id одним запросом.
+
+    Заменяет пару get_user() + get_client_profile() в обработчиках,
+    которым пользователь нужен только ради поиска профиля.
+    """
+    with get_db_connection() as conn:
+        cursor = get_cursor(conn)
+        cursor.execute("""
+            SELECT c.*, u.telegram_id
+            FROM users u
+            JOIN clients c ON c.user_id = u.id
+            WHERE u.telegram_id = ?
+        """, (telegram_id,))
+        return cursor.fetchone()
+
+
 def get_client_by_id(client_id):
     """Возвращает профиль заказчика по client_id"""
     with get_db_connection() as conn:
@@ -1036,6 +1752,61 @@ def get_client_by_id(client_id):
 
 # --- Рейтинг и отзывы ---
 
+# Таблица профиля по роли получателя отзыва
+_RATING_TABLES = {"worker": "workers", "client": "clients"}
+
+# Оценки отзыва и колонки гистограммы в workers/clients: stars_N - количество отзывов с оценкой N
+RATING_STARS = (1, 2, 3, 4, 5)
+RATING_HISTOGRAM_COLUMNS = tuple(f"stars_{stars}" for stars in RATING_STARS)
+# Агрегаты гистограммы по reviews для пересчёта (SELECT ... GROUP BY to_user_id)
+_RATING_HISTOGRAM_SELECT = ", ".join(
+    f"SUM(CASE WHEN rating = {stars} THEN 1 ELSE 0 END) as stars_{stars}" for stars in RATING_STARS
+)
+
+# Страница ленты отзывов
+REVIEWS_PAGE_SIZE = 10
+
+
+def _apply_rating(cursor, user_id, rating, role_to, from_review=False):
+    """
+    НОВОЕ: Добавляет оценку в агрегаты рейтинга в текущей транзакции.
+
+    rating_sum и rating_count - агрегаты, rating пересчитывается из них же
+    в том же UPDATE (в SET видны старые значения колонок), без чтения в Python.
+
+    Args:
+        cursor: Курсор текущей транзакции
+        user_id: ID пользователя (users.id)
+        rating: Оценка
+        role_to: 'worker' или 'client'
+        from_review: Оценка из отзыва - обновить гистограмму stars_N
+            и verified_reviews (только для мастеров)
+    """
+    table = _RATING_TABLES.get(role_to)
+    if table is None:
+        return
+
+    # Рейтинг виден в карточке мастера - новая версия профиля
+    extra_sql = ", profile_version = profile_version + 1" if role_to == "worker" else ""
+    if from_review:
+        if rating in RATING_STARS:
+            extra_sql += f", stars_{int(rating)} = stars_{int(rating)} + 1"
+        if role_to == "worker":
+            extra_sql += ", verified_reviews = verified_reviews + 1"
+
+    cursor.execute(f"""
+        UPDATE {table}
+        SET
+            rating_sum = rating_sum + ?,
+            rating_count = rating_count + 1,
+            rating = (rating_sum + ?) / (rating_count + 1){extra_sql}
+        WHERE user_id = ?
+    """, (rating, rating, user_id))
+
+    if role_to == "worker":
+        _refresh_ranking_score(cursor, "user_id = ?", (user_id,))
+
+
 def update_user_rating(user_id, new_rating, role_to):
     """
     ИСПРАВЛЕНО: Использует атомарный UPDATE для предотвращения race conditions.
@@ -1044,33 +1815,7 @@ def update_user_rating(user_id, new_rating, role_to):
     """
     with get_db_connection() as conn:
         cursor = get_cursor(conn)
-
-        if role_to == "worker":
-            # Атомарный UPDATE: вычисление происходит в БД, не в Python
-            cursor.execute("""
-                UPDATE workers
-                SET
-                    rating = CASE
-                        WHEN rating_count = 0 THEN ?
-                        ELSE (rating * rating_count + ?) / (rating_count + 1)
-                    END,
-                    rating_count = rating_count + 1
-                WHERE user_id = ?
-            """, (new_rating, new_rating, user_id))
-
-        elif role_to == "client":
-            # Атомарный UPDATE для клиентов
-            cursor.execute("""
-                UPDATE clients
-                SET
-                    rating = CASE
-                        WHEN rating_count = 0 THEN ?
-                        ELSE (rating * rating_count + ?) / (rating_count + 1)
-                    END,
-                    rating_count = rating_count + 1
-                WHERE user_id = ?
-            """, (new_rating, new_rating, user_id))
-
+        _apply_rating(cursor, user_id, new_rating, role_to)
         conn.commit()
 
 
@@ -1078,6 +1823,9 @@ def add_review(from_user_id, to_user_id, order_id, role_from, role_to, rating, c
     """
     Добавляет отзыв и обновляет рейтинг пользователя.
     Если роль получателя - worker, увеличивает счетчик verified_reviews.
+
+    ИСПРАВЛЕНО: Отзыв, агрегаты рейтинга и verified_reviews пишутся в одной
+    транзакции - сбой посередине больше не оставляет рейтинг рассогласованным.
     """
     with get_db_connection() as conn:
         cursor = get_cursor(conn)
@@ -1088,91 +1836,452 @@ def add_review(from_user_id, to_user_id, order_id, role_from, role_to, rating, c
                 (from_user_id, to_user_id, order_id, role_from, role_to, rating, comment, created_at)
                 VALUES (?, ?, ?, ?, ?, ?, ?, ?)
             """, (from_user_id, to_user_id, order_id, role_from, role_to, rating, comment, created_at))
+            _apply_rating(cursor, to_user_id, rating, role_to, from_review=True)
             conn.commit()
-            update_user_rating(to_user_id, rating, role_to)
-
-            # Увеличиваем счетчик проверенных отзывов для мастеров
-            if role_to == "worker":
-                increment_verified_reviews(to_user_id)
-
             return True
         except (sqlite3.IntegrityError, Exception) as e:
+            conn.rollback()
             print(f"⚠️ Ошибка при добавлении отзыва: {e}")
             return False
 
 
-def get_reviews_for_user(user_id, role):
+def rebuild_all_ratings():
     """
-    Получает все отзывы о пользователе.
+    НОВОЕ: Пересчитывает рейтинги всех мастеров и клиентов по таблице reviews.
 
-    Args:
-        user_id: ID пользователя
-        role: Роль пользователя ('worker' или 'client')
+    Один проход агрегации по reviews на таблицу профилей (UPDATE ... FROM,
+    SQLite 3.33+), перезаписываются только расхождения. Профили без отзывов
+    обнуляются. Штрафы за просроченные чаты в reviews не хранятся - после
+    пересчёта они сбрасываются. Гистограммы оценок пересчитываются вместе с рейтингом.
 
     Returns:
-        List of reviews with reviewer info
+        dict: {'workers': исправлено, 'clients': исправлено}
     """
+    histogram_set = "".join(f", {column} = agg.{column}" for column in RATING_HISTOGRAM_COLUMNS)
+    histogram_reset = "".join(f", {column} = 0" for column in RATING_HISTOGRAM_COLUMNS)
+
+    fixed = {}
     with get_db_connection() as conn:
         cursor = get_cursor(conn)
 
-        # Получаем отзывы с информацией о том, кто оставил
-        cursor.execute("""
-            SELECT
-                r.rating,
-                r.comment,
-                r.created_at,
-                r.order_id,
-                r.role_from,
-                CASE
-                    WHEN r.role_from = 'worker' THEN w.name
-                    WHEN r.role_from = 'client' THEN c.name
-                END as reviewer_name
-            FROM reviews r
-            LEFT JOIN workers w ON r.from_user_id = w.user_id AND r.role_from = 'worker'
-            LEFT JOIN clients c ON r.from_user_id = c.user_id AND r.role_from = 'client'
-            WHERE r.to_user_id = ? AND r.role_to = ?
-            ORDER BY r.created_at DESC
-        """, (user_id, role))
+        for role, table in _RATING_TABLES.items():
+            histogram_drift = " OR ".join(f"{table}.{column} <> agg.{column}" for column in RATING_HISTOGRAM_COLUMNS)
+            verified_sql = (
+                ", verified_reviews = agg.reviews_count, profile_version = profile_version + 1"
+                if role == "worker" else ""
+            )
+            cursor.execute(f"""
+                UPDATE {table}
+                SET
+                    rating_sum = agg.rating_sum,
+                    rating_count = agg.reviews_count,
+                    rating = agg.rating_sum * 1.0 / agg.reviews_count{verified_sql}{histogram_set}
+                FROM (
+                    SELECT to_user_id, SUM(rating) as rating_sum, COUNT(*) as reviews_count,
+                           {_RATING_HISTOGRAM_SELECT}
+                    FROM reviews
+                    WHERE role_to = ?
+                    GROUP BY to_user_id
+                ) agg
+                WHERE {table}.user_id = agg.to_user_id
+                AND ({table}.rating_count <> agg.reviews_count OR {table}.rating_sum <> agg.rating_sum
+                     OR {histogram_drift})
+            """, (role,))
+            fixed[table] = max(cursor.rowcount, 0)
+
+            verified_reset = ", verified_reviews = 0, profile_version = profile_version + 1" if role == "worker" else ""
+            cursor.execute(f"""
+                UPDATE {table}
+                SET rating_sum = 0, rating_count = 0, rating = 0{verified_reset}{histogram_reset}
+                WHERE (rating_count <> 0 OR rating_sum <> 0)
+                AND NOT EXISTS (
+                    SELECT 1 FROM reviews r WHERE r.to_user_id = {table}.user_id AND r.role_to = ?
+                )
+            """, (role,))
+            fixed[table] += max(cursor.rowcount, 0)
 
-        return cursor.fetchall()
+        # Рейтинг входит в счёт ранжирования мастеров
+        _refresh_ranking_score(cursor, "1 = 1")
+        conn.commit()
 
+    logger.info(f"✅ Рейтинги пересчитаны: мастеров {fixed['workers']}, клиентов {fixed['clients']}")
+    return fixed
 
-def check_review_exists(order_id, from_user_id):
-    """
-    Проверяет, оставил ли пользователь уже отзыв по этому заказу.
 
-    Returns:
-        bool: True если отзыв уже существует
-    """
-    with get_db_connection() as conn:
-        cursor = get_cursor(conn)
-        cursor.execute("""
-            SELECT COUNT(*) FROM reviews
-            WHERE order_id = ? AND from_user_id = ?
-        """, (order_id, from_user_id))
+# --- НОВОЕ: Ранжирование мастеров ---
+#
+# workers.ranking_score = байесовски сглаженный рейтинг
+#     + бонус за проверенные отзывы + бонус за завершённые заказы
+#     + свежесть: RANKING_RECENCY_WEIGHT за активность сегодня, линейно до 0
+#       за RANKING_RECENCY_DAYS дней без активности.
+# ИСПРАВЛЕНО: Свежесть ограничена (не больше одного балла рейтинга) и убывает
+# с возрастом активности. На событиях мастера (отзыв, отклик, завершённый заказ)
+# счёт пересчитывается сразу, затухание для всех - раз в день decay_ranking_scores().
 
-        count = cursor.fetchone()
-        if USE_POSTGRES:
-            return count['count'] > 0
-        else:
-            return count[0] > 0
+RANKING_PRIOR_RATING = 4.0      # Априорная оценка мастера без отзывов
+RANKING_PRIOR_WEIGHT = 5.0      # Вес априорной оценки в "виртуальных отзывах"
+RANKING_VERIFIED_WEIGHT = 1.0   # Максимальный бонус за проверенные отзывы
+RANKING_COMPLETED_WEIGHT = 1.0  # Максимальный бонус за завершённые заказы
+RANKING_BONUS_HALF = 10.0       # На стольких отзывах/заказах бонус равен половине максимума
+RANKING_RECENCY_WEIGHT = 1.0    # Бонус свежести за активность сегодня
+RANKING_RECENCY_DAYS = 90.0     # Через столько дней без активности бонус свежести равен 0
+RANKING_EPOCH = date(2024, 1, 1)
 
+# Статусы завершённого заказа
+COMPLETED_ORDER_STATUSES = ('completed', 'done')
 
-def update_review_comment(order_id, from_user_id, comment):
-    """Обновляет комментарий существующего отзыва."""
-    with get_db_connection() as conn:
-        cursor = get_cursor(conn)
-        try:
-            cursor.execute("""
-                UPDATE reviews
-                SET comment = ?
-                WHERE order_id = ? AND from_user_id = ?
-            """, (comment, order_id, from_user_id))
-            conn.commit()
-            return cursor.rowcount > 0
-        except Exception as e:
-            print(f"⚠️ Ошибка при обновлении комментария отзыва: {e}")
-            return False
+# Страница просмотра мастеров клиентом
+WORKERS_PAGE_SIZE = 20
+
+
+def _activity_day(moment=None):
+    """Номер дня активности мастера от RANKING_EPOCH"""
+    return ((moment or datetime.now()).date() - RANKING_EPOCH).days
+
+
+def _ranking_score_sql(today=None, **columns):
+    """
+    SQL-выражение ranking_score по колонкам workers.
+
+    Args:
+        today: Номер текущего дня (_activity_day()), от него считается свежесть
+        columns: Подмена колонки выражением, например completed_orders="(completed_orders + 1)" -
+            в SET одного UPDATE видны старые значения колонок
+    """
+    if today is None:
+        today = _activity_day()
+    rating_sum = columns.get("rating_sum", "rating_sum")
+    rating_count = columns.get("rating_count", "rating_count")
+    verified = columns.get("verified_reviews", "verified_reviews")
+    completed = columns.get("completed_orders", "completed_orders")
+    active_day = columns.get("last_active_day", "last_active_day")
+    return (
+        f"(({RANKING_PRIOR_RATING} * {RANKING_PRIOR_WEIGHT} + {rating_sum}) / ({RANKING_PRIOR_WEIGHT} + {rating_count})"
+        f" + {RANKING_VERIFIED_WEIGHT} * {verified} / ({verified} + {RANKING_BONUS_HALF})"
+        f" + {RANKING_COMPLETED_WEIGHT} * {completed} / ({completed} + {RANKING_BONUS_HALF})"
+        f" + CASE WHEN {active_day} IS NULL OR {today} - {active_day} >= {RANKING_RECENCY_DAYS} THEN 0"
+        f" ELSE {RANKING_RECENCY_WEIGHT} * (1 - ({today} - {active_day}) / {RANKING_RECENCY_DAYS}) END)"
+    )
+
+
+def _refresh_ranking_score(cursor, where_sql, params=()):
+    """Пересчитывает ranking_score мастеров по условию where_sql в текущей транзакции"""
+    cursor.execute(f"UPDATE workers SET ranking_score = {_ranking_score_sql()} WHERE {where_sql}", params)
+
+
+def _touch_worker_activity(cursor, worker_id):
+    """Отмечает активность мастера сегодня (не чаще одной записи в день)"""
+    day = _activity_day()
+    cursor.execute(f"""
+        UPDATE workers
+        SET last_active_day = ?, ranking_score = {_ranking_score_sql(day, last_active_day=str(day))}
+        WHERE id = ? AND COALESCE(last_active_day, -1) <> ?
+    """, (day, worker_id, day))
+
+
+def _credit_completed_order(cursor, order_id):
+    """
+    Засчитывает завершённый заказ выбранному мастеру.
+
+    Вызывается до смены статуса: заказ, уже бывший завершённым
+    (completed -> done, повторное завершение второй стороной), не засчитывается.
+    """
+    day = _activity_day()
+    statuses = ", ".join(f"'{status}'" for status in COMPLETED_ORDER_STATUSES)
+    cursor.execute(f"""
+        UPDATE workers
+        SET completed_orders = completed_orders + 1,
+            last_active_day = ?,
+            ranking_score = {_ranking_score_sql(day, completed_orders="(completed_orders + 1)", last_active_day=str(day))}
+        WHERE id = (
+            SELECT selected_worker_id FROM orders
+            WHERE id = ? AND status NOT IN ({statuses})
+        )
+    """, (day, order_id))
+
+
+def _activity_day_sql(column):
+    """SQL-выражение номера дня от RANKING_EPOCH для колонки с датой-строкой"""
+    if USE_POSTGRES:
+        return f"(CAST({column} AS DATE) - DATE '{RANKING_EPOCH.isoformat()}')"
+    return f"CAST(julianday({column}) - julianday('{RANKING_EPOCH.isoformat()}') AS INTEGER)"
+
+
+def _backfill_activity_from_registration(cursor):
+    """
+    ИСПРАВЛЕНО: Мастерам без отметки активности - день регистрации (users.created_at), а не NULL.
+
+    Трогает только строки, которым есть что проставить: повторный вызов ничего не пишет.
+
+    Returns:
+        int: Количество заполненных мастеров
+    """
+    cursor.execute(f"""
+        UPDATE workers
+        SET last_active_day = (
+            SELECT {_activity_day_sql("u.created_at")} FROM users u WHERE u.id = workers.user_id
+        )
+        WHERE last_active_day IS NULL
+        AND EXISTS (SELECT 1 FROM users u WHERE u.id = workers.user_id AND u.created_at IS NOT NULL)
+    """)
+    return max(cursor.rowcount, 0)
+
+
+def rebuild_ranking_scores():
+    """
+    НОВОЕ: Пересчитывает счётчики и ranking_score всех мастеров.
+
+    completed_orders пересчитывается по orders, last_active_day только
+    сдвигается вперёд по последнему отклику; мастерам без откликов и без
+    отметки активности ставится день регистрации (users.created_at).
+    Нужен для заполнения после миграции и массовой загрузки данных в обход бота.
+
+    Returns:
+        int: Количество мастеров
+    """
+    statuses = ", ".join(f"'{status}'" for status in COMPLETED_ORDER_STATUSES)
+    with get_db_connection() as conn:
+        cursor = get_cursor(conn)
+
+        cursor.execute(f"""
+            UPDATE workers
+            SET completed_orders = (
+                SELECT COUNT(*) FROM orders o
+                WHERE o.selected_worker_id = workers.id AND o.status IN ({statuses})
+            )
+        """)
+
+        cursor.execute(f"""
+            UPDATE workers
+            SET last_active_day = agg.active_day
+            FROM (
+                SELECT worker_id, {_activity_day_sql("MAX(created_at)")} as active_day
+                FROM bids
+                GROUP BY worker_id
+            ) agg
+            WHERE workers.id = agg.worker_id
+            AND agg.active_day > COALESCE(workers.last_active_day, -1)
+        """)
+
+        _backfill_activity_from_registration(cursor)
+        _refresh_ranking_score(cursor, "1 = 1")
+        updated = max(cursor.rowcount, 0)
+        conn.commit()
+
+    logger.info(f"✅ Счёт ранжирования пересчитан: мастеров {updated}")
+    return updated
+
+
+def decay_ranking_scores():
+    """
+    НОВОЕ: Ежедневное затухание свежести в ranking_score.
+
+    Пересчитывает счёт мастеров с отметкой активности: бонус свежести зависит
+    от сегодняшней даты, события самого мастера обновляют только его счёт.
+
+    Returns:
+        int: Количество пересчитанных мастеров
+    """
+    with get_db_connection() as conn:
+        cursor = get_cursor(conn)
+        _refresh_ranking_score(cursor, "last_active_day IS NOT NULL")
+        updated = max(cursor.rowcount, 0)
+        conn.commit()
+
+    logger.info(f"✅ Затухание свежести в счёте ранжирования: мастеров {updated}")
+    return updated
+
+
+def migrate_add_rating_aggregates():
+    """
+    НОВОЕ: Добавляет агрегат rating_sum в workers и clients.
+
+    Начальное значение - rating * rating_count: текущие рейтинги (включая штрафы
+    за просроченные чаты) сохраняются как есть, пересчёт по отзывам - rebuild_all_ratings().
+    """
+    with get_db_connection() as conn:
+        cursor = get_cursor(conn)
+
+        try:
+            for table in _RATING_TABLES.values():
+                if USE_POSTGRES:
+                    cursor.execute("""
+                        SELECT 1 FROM information_schema.columns
+                        WHERE table_name = ? AND column_name = 'rating_sum'
+                    """, (table,))
+                    exists = cursor.fetchone() is not None
+                else:
+                    cursor.execute(f"PRAGMA table_info({table})")
+                    exists = 'rating_sum' in [column[1] for column in cursor.fetchall()]
+
+                if exists:
+                    continue
+
+                cursor.execute(f"ALTER TABLE {table} ADD COLUMN rating_sum REAL DEFAULT 0")
+                cursor.execute(f"""
+                    UPDATE {table}
+                    SET rating_sum = COALESCE(rating, 0) * COALESCE(rating_count, 0)
+                """)
+
+            conn.commit()
+            logger.info("✅ Migration completed: rating aggregates!")
+
+        except Exception as e:
+            logger.error(f"⚠️ Error in migrate_add_rating_aggregates: {e}")
+            conn.rollback()
+
+
+def migrate_add_rating_histograms():
+    """
+    НОВОЕ: Гистограммы оценок (stars_1..stars_5) в workers и clients
+    и индекс для постраничной ленты отзывов.
+
+    Гистограммы заполняются из reviews одним проходом при добавлении колонок,
+    дальше их ведёт add_review в той же транзакции, что и сам отзыв.
+    """
+    histogram_set = ", ".join(f"{column} = agg.{column}" for column in RATING_HISTOGRAM_COLUMNS)
+
+    with get_db_connection() as conn:
+        cursor = get_cursor(conn)
+
+        try:
+            for role, table in _RATING_TABLES.items():
+                if USE_POSTGRES:
+                    cursor.execute("""
+                        SELECT column_name FROM information_schema.columns
+                        WHERE table_name = ?
+                    """, (table,))
+                    columns = [dict(row)['column_name'] for row in cursor.fetchall()]
+                else:
+                    cursor.execute(f"PRAGMA table_info({table})")
+                    columns = [column[1] for column in cursor.fetchall()]
+
+                missing = [column for column in RATING_HISTOGRAM_COLUMNS if column not in columns]
+                if not missing:
+                    continue
+
+                for column in missing:
+                    cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} INTEGER DEFAULT 0")
+
+                cursor.execute(f"""
+                    UPDATE {table}
+                    SET {histogram_set}
+                    FROM (
+                        SELECT to_user_id,
+                               {_RATING_HISTOGRAM_SELECT}
+                        FROM reviews
+                        WHERE role_to = ?
+                        GROUP BY to_user_id
+                    ) agg
+                    WHERE {table}.user_id = agg.to_user_id
+                """, (role,))
+
+            # Лента отзывов: WHERE to_user_id/role_to + keyset по (created_at, id)
+            cursor.execute("""
+                CREATE INDEX IF NOT EXISTS idx_reviews_feed
+                ON reviews(to_user_id, role_to, created_at, id)
+            """)
+
+            conn.commit()
+            logger.info("✅ Migration completed: rating histograms!")
+
+        except Exception as e:
+            logger.error(f"⚠️ Error in migrate_add_rating_histograms: {e}")
+            conn.rollback()
+
+
+def get_reviews_for_user(user_id, role, limit=None, after_review_id=None):
+    """
+    Получает отзывы о пользователе, новые первыми.
+
+    ИСПРАВЛЕНО: Keyset-пагинация по (created_at, id) вместо загрузки всех отзывов:
+    следующая страница начинается после отзыва after_review_id, стоимость
+    не зависит от номера страницы (индекс idx_reviews_feed).
+
+    Args:
+        user_id: ID пользователя
+        role: Роль пользователя ('worker' или 'client')
+        limit: Размер страницы (None - все отзывы)
+        after_review_id: ID последнего отзыва предыдущей страницы
+
+    Returns:
+        List of reviews with reviewer info
+    """
+    conditions = ["r.to_user_id = ?", "r.role_to = ?"]
+    params = [user_id, role]
+
+    if after_review_id is not None:
+        conditions.append("(r.created_at, r.id) < (SELECT created_at, id FROM reviews WHERE id = ?)")
+        params.append(after_review_id)
+
+    limit_sql = ""
+    if limit is not None:
+        limit_sql = "LIMIT ?"
+        params.append(limit)
+
+    with get_db_connection() as conn:
+        cursor = get_cursor(conn)
+
+        # Получаем отзывы с информацией о том, кто оставил
+        cursor.execute(f"""
+            SELECT
+                r.id,
+                r.rating,
+                r.comment,
+                r.created_at,
+                r.order_id,
+                r.role_from,
+                CASE
+                    WHEN r.role_from = 'worker' THEN w.name
+                    WHEN r.role_from = 'client' THEN c.name
+                END as reviewer_name
+            FROM reviews r
+            LEFT JOIN workers w ON r.from_user_id = w.user_id AND r.role_from = 'worker'
+            LEFT JOIN clients c ON r.from_user_id = c.user_id AND r.role_from = 'client'
+            WHERE {' AND '.join(conditions)}
+            ORDER BY r.created_at DESC, r.id DESC
+            {limit_sql}
+        """, tuple(params))
+
+        return cursor.fetchall()
+
+
+def check_review_exists(order_id, from_user_id):
+    """
+    Проверяет, оставил ли пользователь уже отзыв по этому заказу.
+
+    Returns:
+        bool: True если отзыв уже существует
+    """
+    with get_db_connection() as conn:
+        cursor = get_cursor(conn)
+        cursor.execute("""
+            SELECT COUNT(*) FROM reviews
+            WHERE order_id = ? AND from_user_id = ?
+        """, (order_id, from_user_id))
+
+        count = cursor.fetchone()
+        if USE_POSTGRES:
+            return count['count'] > 0
+        else:
+            return count[0] > 0
+
+
+def update_review_comment(order_id, from_user_id, comment):
+    """Обновляет комментарий существующего отзыва."""
+    with get_db_connection() as conn:
+        cursor = get_cursor(conn)
+        try:
+            cursor.execute("""
+                UPDATE reviews
+                SET comment = ?
+                WHERE order_id = ? AND from_user_id = ?
+            """, (comment, order_id, from_user_id))
+            conn.commit()
+            return cursor.rowcount > 0
+        except Exception as e:
+            print(f"⚠️ Ошибка при обновлении комментария отзыва: {e}")
+            return False
 
 
 def increment_verified_reviews(user_id):
@@ -1183,9 +2292,10 @@ def increment_verified_reviews(user_id):
         cursor = get_cursor(conn)
         cursor.execute("""
             UPDATE workers
-            SET verified_reviews = verified_reviews + 1
+            SET verified_reviews = verified_reviews + 1, profile_version = profile_version + 1
             WHERE user_id = ?
         """, (user_id,))
+        _refresh_ranking_score(cursor, "user_id = ?", (user_id,))
         conn.commit()
 
 
@@ -1292,9 +2402,10 @@ def verify_completed_work_photo(photo_id):
 
                     cursor.execute("""
                         UPDATE workers
-                        SET portfolio_photos = ?
+                        SET portfolio_photos = ?, profile_version = profile_version + 1
                         WHERE id = ?
                     """, (new_portfolio, worker_id))
+                    _append_portfolio_photo(cursor, worker_id, photo_file_id)
 
                     logger.info(f"✅ Подтверждённое фото {photo_file_id} добавлено в портфолио мастера {worker_id}")
 
@@ -1510,6 +2621,7 @@ def update_order_status(order_id, new_status):
             WHERE id = ?
         """, (new_status, order_id))
         conn.commit()
+    _chat_sessions.invalidate_order(order_id)
 
 
 def get_all_user_telegram_ids():
@@ -1542,6 +2654,7 @@ def set_selected_worker(order_id, worker_id):
             WHERE id = ?
         """, (worker_id, order_id))
         conn.commit()
+    _chat_sessions.invalidate_order(order_id)
 
 
 def mark_order_completed_by_client(order_id):
@@ -1556,6 +2669,9 @@ def mark_order_completed_by_client(order_id):
     with get_db_connection() as conn:
         cursor = get_cursor(conn)
 
+        # НОВОЕ: Засчитываем заказ мастеру до смены статуса
+        _credit_completed_order(cursor, order_id)
+
         # Помечаем что клиент завершил и сразу меняем статус
         cursor.execute("""
             UPDATE orders
@@ -1565,6 +2681,7 @@ def mark_order_completed_by_client(order_id):
         """, (order_id,))
 
         conn.commit()
+        _chat_sessions.invalidate_order(order_id)
         logger.info(f"✅ Заказ {order_id} завершен клиентом")
         return True
 
@@ -1581,6 +2698,9 @@ def mark_order_completed_by_worker(order_id):
     with get_db_connection() as conn:
         cursor = get_cursor(conn)
 
+        # НОВОЕ: Засчитываем заказ мастеру до смены статуса
+        _credit_completed_order(cursor, order_id)
+
         # Помечаем что мастер завершил и сразу меняем статус
         cursor.execute("""
             UPDATE orders
@@ -1590,6 +2710,7 @@ def mark_order_completed_by_worker(order_id):
         """, (order_id,))
 
         conn.commit()
+        _chat_sessions.invalidate_order(order_id)
         logger.info(f"✅ Заказ {order_id} завершен мастером")
         return True
 
@@ -1679,16 +2800,25 @@ def update_worker_field(user_id, field_name, new_value):
         logger.info(f"🔍 Cursor получен: type={type(cursor)}, has_rowcount={hasattr(cursor, 'rowcount')}")
 
         # Безопасное построение запроса с явным whitelist
-        query = f"UPDATE workers SET {safe_field} = ? WHERE user_id = ?"
+        # НОВОЕ: Любое поле профиля меняет карточку мастера - увеличиваем версию профиля
+        query = f"UPDATE workers SET {safe_field} = ?, profile_version = profile_version + 1 WHERE user_id = ?"
         logger.info(f"🔍 Выполняем UPDATE: {query}")
         cursor.execute(query, (new_value, user_id))
         logger.info(f"🔍 UPDATE выполнен")
+        updated_rows = cursor.rowcount
+
+        # НОВОЕ: Портфолио дублируется в worker_portfolio_photos в той же транзакции
+        if field_name == "portfolio_photos":
+            cursor.execute("SELECT id FROM workers WHERE user_id = ?", (user_id,))
+            worker = cursor.fetchone()
+            if worker:
+                _replace_portfolio_photos(cursor, dict(worker)['id'], _split_portfolio(new_value))
 
         conn.commit()
         logger.info(f"🔍 COMMIT выполнен")
 
         try:
-            rowcount = cursor.rowcount
+            rowcount = updated_rows
             logger.info(f"🔍 rowcount получен: {rowcount}")
             result = rowcount > 0
             logger.info(f"🔍 Результат: {result}")
@@ -1745,6 +2875,47 @@ def update_client_field(user_id, field_name, new_value):
 
 # --- Поиск мастеров ---
 
+def _worker_filters_sql(city=None, category=None):
+    """
+    Условия WHERE для выборки мастеров по городу и категории.
+
+    Returns:
+        tuple: (SQL-фрагмент из "AND ..." условий, список параметров)
+    """
+    sql = ""
+    params = []
+
+    # ИСПРАВЛЕНО: Поиск по городу через worker_cities ИЛИ через city (для старых записей)
+    if city:
+        sql += """
+            AND (
+                EXISTS (
+                    SELECT 1 FROM worker_cities wc
+                    WHERE wc.worker_id = w.id AND wc.city = ?
+                )
+                OR w.city = ?
+            )
+        """
+        params.append(city)
+        params.append(city)
+
+    if category:
+        # ИСПРАВЛЕНО: Поиск по категории через worker_categories ИЛИ через categories (для старых записей)
+        sql += """
+            AND (
+                EXISTS (
+                    SELECT 1 FROM worker_categories wc
+                    WHERE wc.worker_id = w.id AND wc.category = ?
+                )
+                OR w.categories LIKE ?
+            )
+        """
+        params.append(category)
+        params.append(f"%{category}%")
+
+    return sql, params
+
+
 def get_all_workers(city=None, category=None):
     """
     ИСПРАВЛЕНО: Использует точный поиск по категориям через worker_categories.
@@ -1762,45 +2933,17 @@ def get_all_workers(city=None, category=None):
     with get_db_connection() as conn:
         cursor = get_cursor(conn)
 
-        query = """
+        filters_sql, params = _worker_filters_sql(city, category)
+        query = f"""
             SELECT
                 w.*,
                 u.telegram_id
             FROM workers w
             JOIN users u ON w.user_id = u.id
             WHERE 1=1
+            {filters_sql}
+            ORDER BY w.rating DESC, w.rating_count DESC
         """
-        params = []
-
-        # ИСПРАВЛЕНО: Поиск по городу через worker_cities ИЛИ через city (для старых записей)
-        if city:
-            query += """
-                AND (
-                    EXISTS (
-                        SELECT 1 FROM worker_cities wc
-                        WHERE wc.worker_id = w.id AND wc.city = ?
-                    )
-                    OR w.city = ?
-                )
-            """
-            params.append(city)
-            params.append(city)
-
-        if category:
-            # ИСПРАВЛЕНО: Поиск по категории через worker_categories ИЛИ через categories (для старых записей)
-            query += """
-                AND (
-                    EXISTS (
-                        SELECT 1 FROM worker_categories wc
-                        WHERE wc.worker_id = w.id AND wc.category = ?
-                    )
-                    OR w.categories LIKE ?
-                )
-            """
-            params.append(category)
-            params.append(f"%{category}%")
-
-        query += " ORDER BY w.rating DESC, w.rating_count DESC"
 
         logger.info(f"🔍 Поиск мастеров: город={city}, категория={category}")
         cursor.execute(query, params)
@@ -1809,6 +2952,52 @@ def get_all_workers(city=None, category=None):
         return results
 
 
+def get_top_workers(city=None, category=None, limit=WORKERS_PAGE_SIZE, after=None):
+    """
+    НОВОЕ: Страница лучших мастеров по ranking_score.
+
+    Keyset-пагинация по (ranking_score, id): следующая страница начинается
+    после ключа последней строки предыдущей страницы, обход идёт по индексу
+    idx_workers_ranking и не зависит от числа мастеров в городе.
+
+    ИСПРАВЛЕНО: Ключ продолжения - (ranking_score, id) в том виде, в каком
+    строка была загружена, а не текущий счёт мастера: если счёт изменился
+    между страницами, страницы не повторяются и не пропускают мастеров.
+
+    Args:
+        city: Фильтр по городу (опционально)
+        category: Фильтр по категории (опционально)
+        limit: Размер страницы
+        after: (ranking_score, id) последней строки предыдущей страницы
+
+    Returns:
+        List of worker profiles with user info
+    """
+    filters_sql, params = _worker_filters_sql(city, category)
+
+    if after is not None:
+        filters_sql += """
+            AND (w.ranking_score, w.id) < (?, ?)
+        """
+        params.extend(after)
+    params.append(limit)
+
+    with get_db_connection() as conn:
+        cursor = get_cursor(conn)
+        cursor.execute(f"""
+            SELECT
+                w.*,
+                u.telegram_id
+            FROM workers w
+            JOIN users u ON w.user_id = u.id
+            WHERE 1=1
+            {filters_sql}
+            ORDER BY w.ranking_score DESC, w.id DESC
+            LIMIT ?
+        """, tuple(params))
+        return cursor.fetchall()
+
+
 def get_worker_by_id(worker_id):
     """Получает профиль мастера по ID"""
     with get_db_connection() as conn:
@@ -1827,45 +3016,284 @@ def get_worker_by_id(worker_id):
         return cursor.fetchone()
 
 
-# --- Категории мастеров (новая нормализованная система) ---
+# --- Пакетные запросы по списку ID (вместо N+1 в циклах) ---
 
-def add_worker_categories(worker_id, categories_list):
+# Максимум ID в одном запросе (лимит параметров SQLite - 999)
+BATCH_LOOKUP_CHUNK_SIZE = 500
+
+
+def _fetch_rows_by_ids(select_sql, column, key, ids):
     """
-    Добавляет категории для мастера в таблицу worker_categories.
+    Выполняет select_sql порциями по BATCH_LOOKUP_CHUNK_SIZE ID.
 
     Args:
-        worker_id: ID мастера
-        categories_list: список категорий ["Электрика", "Сантехника"]
+        select_sql: SELECT ... FROM ... без WHERE
+        column: Колонка для фильтра (например, 'w.user_id')
+        key: Имя поля строки, по которому строится словарь
+        ids: Список ID (дубликаты и None игнорируются)
+
+    Returns:
+        dict: {id: строка} - строки в том же виде, что и у одиночных функций
     """
+    unique_ids = list(dict.fromkeys(i for i in ids if i is not None))
+    rows_by_id = {}
+    if not unique_ids:
+        return rows_by_id
+
     with get_db_connection() as conn:
         cursor = get_cursor(conn)
 
-        for category in categories_list:
-            if not category or not category.strip():
-                continue
+        for start in range(0, len(unique_ids), BATCH_LOOKUP_CHUNK_SIZE):
+            chunk = unique_ids[start:start + BATCH_LOOKUP_CHUNK_SIZE]
+            if USE_POSTGRES:
+                cursor.execute(f"{select_sql} WHERE {column} = ANY(%s)", (chunk,))
+            else:
+                placeholders = ','.join('?' * len(chunk))
+                cursor.execute(f"{select_sql} WHERE {column} IN ({placeholders})", tuple(chunk))
 
-            try:
-                cursor.execute("""
-                    INSERT INTO worker_categories (worker_id, category)
-                    VALUES (?, ?)
-                """, (worker_id, category.strip()))
-            except:
-                # Игнорируем дубликаты (UNIQUE constraint)
-                pass
+            for row in cursor.fetchall():
+                rows_by_id[row[key]] = row
 
-        conn.commit()
+    return rows_by_id
 
 
-def get_worker_categories(worker_id):
+def get_users_by_ids(user_ids):
+    """НОВОЕ: Пакетный get_user_by_id. Возвращает {user_id: строка users}"""
+    return _fetch_rows_by_ids("SELECT * FROM users", "id", "id", user_ids)
+
+
+def get_orders_by_ids(order_ids):
     """
-    Получает все категории мастера.
+    НОВОЕ: Пакетный get_order_by_id (те же поля заказа и клиента).
+    Возвращает {order_id: строка}
+    """
+    return _fetch_rows_by_ids("""
+        SELECT
+            o.*,
+            c.name as client_name,
+            c.phone as client_phone,
+            c.user_id as client_user_id,
+            c.rating as client_rating,
+            c.rating_count as client_rating_count
+        FROM orders o
+        JOIN clients c ON o.client_id = c.id
+    """, "o.id", "id", order_ids)
+
+
+def get_workers_by_ids(ids, by_user_id=False):
+    """
+    НОВОЕ: Пакетный get_worker_by_id / get_worker_profile (w.* + telegram_id).
+
+    Args:
+        ids: ID мастеров (workers.id) или пользователей при by_user_id=True
+        by_user_id: Искать и строить словарь по workers.user_id
 
     Returns:
-        Список категорий: ["Электрика", "Сантехника"]
+        dict: {id: строка профиля мастера}
     """
-    with get_db_connection() as conn:
-        cursor = get_cursor(conn)
-        cursor.execute("""
+    column, key = ("w.user_id", "user_id") if by_user_id else ("w.id", "id")
+    return _fetch_rows_by_ids("""
+        SELECT w.*, u.telegram_id
+        FROM workers w
+        JOIN users u ON w.user_id = u.id
+    """, column, key, ids)
+
+
+def get_clients_by_ids(ids, by_user_id=False):
+    """
+    НОВОЕ: Пакетный get_client_profile (c.* + telegram_id).
+
+    Args:
+        ids: ID заказчиков (clients.id) или пользователей при by_user_id=True
+        by_user_id: Искать и строить словарь по clients.user_id
+
+    Returns:
+        dict: {id: строка профиля заказчика}
+    """
+    column, key = ("c.user_id", "user_id") if by_user_id else ("c.id", "id")
+    return _fetch_rows_by_ids("""
+        SELECT c.*, u.telegram_id
+        FROM clients c
+        JOIN users u ON c.user_id = u.id
+    """, column, key, ids)
+
+
+def get_chats_by_order_ids(order_ids):
+    """НОВОЕ: Пакетный get_chat_by_order. Возвращает {order_id: строка chats}"""
+    return _fetch_rows_by_ids("SELECT * FROM chats", "order_id", "order_id", order_ids)
+
+
+def get_bids_counts_by_order_ids(order_ids):
+    """
+    НОВОЕ: Пакетный get_bids_count_for_order.
+    Возвращает {order_id: количество активных откликов}; заказов без откликов в словаре нет.
+    """
+    unique_ids = list(dict.fromkeys(i for i in order_ids if i is not None))
+    counts = {}
+    if not unique_ids:
+        return counts
+
+    with get_db_connection() as conn:
+        cursor = get_cursor(conn)
+
+        for start in range(0, len(unique_ids), BATCH_LOOKUP_CHUNK_SIZE):
+            chunk = unique_ids[start:start + BATCH_LOOKUP_CHUNK_SIZE]
+            if USE_POSTGRES:
+                condition, params = "order_id = ANY(%s)", (chunk,)
+            else:
+                condition, params = f"order_id IN ({','.join('?' * len(chunk))})", tuple(chunk)
+            cursor.execute(f"""
+                SELECT order_id, COUNT(*) as bids_count FROM bids
+                WHERE {condition} AND status = 'active'
+                GROUP BY order_id
+            """, params)
+
+            for row in cursor.fetchall():
+                counts[row['order_id']] = row['bids_count']
+
+    return counts
+
+
+# --- Загрузчик чтений в рамках одного апдейта (DataLoader) ---
+
+# Чтения, которые RequestLoader кэширует по аргументам
+REQUEST_CACHEABLE_READS = {
+    'get_user', 'get_user_by_telegram_id', 'get_user_by_id',
+    'get_worker_profile', 'get_worker_by_user_id', 'get_worker_profile_by_id', 'get_worker_by_id',
+    'get_client_profile', 'get_client_profile_by_telegram_id', 'get_client_by_id',
+    'get_order_by_id', 'get_chat_by_id', 'get_bids_for_order', 'get_bid_list_for_order',
+    'get_bid_worker_details',
+    'is_admin', 'is_user_banned', 'are_notifications_enabled', 'are_client_notifications_enabled',
+}
+
+# Виды пакетной загрузки для RequestLoader.load()
+REQUEST_BATCH_LOADERS = {
+    'users': get_users_by_ids,
+    'orders': get_orders_by_ids,
+    'workers': get_workers_by_ids,
+    'clients': get_clients_by_ids,
+    'order_chats': get_chats_by_order_ids,
+    'order_bids_counts': get_bids_counts_by_order_ids,
+}
+
+
+class RequestLoader:
+    """
+    НОВОЕ: Кэш чтений БД на время обработки одного апдейта.
+
+    - loader.get_user(...), loader.get_order_by_id(...) и т.д. (REQUEST_CACHEABLE_READS)
+      имеют ту же сигнатуру, что и функции db, но повторный вызов с теми же
+      аргументами не идёт в БД.
+    - await loader.load('users', user_id) собирает ID, запрошенные в одном тике
+      event loop (например, через asyncio.gather), и загружает их одним запросом.
+
+    Любая запись в БД (DBCursor.execute не-SELECT) сбрасывает кэш, поэтому
+    чтение после изменения всегда видит свежие данные.
+    """
+
+    def __init__(self):
+        self._memo = {}
+        self._rows = {kind: {} for kind in REQUEST_BATCH_LOADERS}
+        self._queued = {kind: {} for kind in REQUEST_BATCH_LOADERS}  # {kind: {id: [future, ...]}}
+        self._generation = _write_generation
+
+    def _check_generation(self):
+        if self._generation != _write_generation:
+            self.clear()
+
+    def clear(self):
+        self._memo.clear()
+        for rows in self._rows.values():
+            rows.clear()
+        self._generation = _write_generation
+
+    def __getattr__(self, name):
+        if name not in REQUEST_CACHEABLE_READS:
+            raise AttributeError(name)
+        func = globals()[name]
+
+        def cached_read(*args, **kwargs):
+            self._check_generation()
+            key = (name, args, tuple(sorted(kwargs.items())))
+            _record_cache_lookup("request_loader", key in self._memo)
+            if key not in self._memo:
+                self._memo[key] = func(*args, **kwargs)
+            return self._memo[key]
+
+        return cached_read
+
+    async def load(self, kind, item_id):
+        """Загружает строку по ID; запросы одного тика объединяются в один SELECT"""
+        import asyncio
+
+        self._check_generation()
+        rows = self._rows[kind]
+        _record_cache_lookup("request_loader", item_id in rows)
+        if item_id in rows:
+            return rows[item_id]
+
+        queued = self._queued[kind]
+        if not queued:
+            asyncio.get_running_loop().call_soon(self._dispatch, kind)
+        future = asyncio.get_running_loop().create_future()
+        queued.setdefault(item_id, []).append(future)
+        return await future
+
+    async def load_many(self, kind, item_ids):
+        """Загружает несколько строк одним запросом. Возвращает список в порядке item_ids"""
+        import asyncio
+        return list(await asyncio.gather(*(self.load(kind, item_id) for item_id in item_ids)))
+
+    def _dispatch(self, kind):
+        queued = self._queued[kind]
+        self._queued[kind] = {}
+        try:
+            loaded = REQUEST_BATCH_LOADERS[kind](list(queued.keys()))
+        except Exception as e:
+            for futures in queued.values():
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(e)
+            return
+
+        rows = self._rows[kind]
+        for item_id, futures in queued.items():
+            rows[item_id] = loaded.get(item_id)
+            for future in futures:
+                if not future.done():
+                    future.set_result(rows[item_id])
+
+
+# --- Категории мастеров (новая нормализованная система) ---
+
+def add_worker_categories(worker_id, categories_list):
+    """
+    Добавляет категории для мастера в таблицу worker_categories.
+
+    Args:
+        worker_id: ID мастера
+        categories_list: список категорий ["Электрика", "Сантехника"]
+    """
+    # ИСПРАВЛЕНО: Один многострочный INSERT вместо запроса на каждую категорию
+    with get_db_connection() as conn:
+        cursor = get_cursor(conn)
+        cursor.insert_ignore_rows(
+            "worker_categories", ("worker_id", "category"),
+            [(worker_id, category) for category in _split_categories(categories_list)],
+        )
+        conn.commit()
+
+
+def get_worker_categories(worker_id):
+    """
+    Получает все категории мастера.
+
+    Returns:
+        Список категорий: ["Электрика", "Сантехника"]
+    """
+    with get_db_connection() as conn:
+        cursor = get_cursor(conn)
+        cursor.execute("""
             SELECT category FROM worker_categories
             WHERE worker_id = ?
             ORDER BY category
@@ -1904,22 +3332,13 @@ def add_order_categories(order_id, categories_list):
         order_id: ID заказа
         categories_list: список категорий ["Электрика", "Сантехника"]
     """
+    # ИСПРАВЛЕНО: Один многострочный INSERT вместо запроса на каждую категорию
     with get_db_connection() as conn:
         cursor = get_cursor(conn)
-
-        for category in categories_list:
-            if not category or not category.strip():
-                continue
-
-            try:
-                cursor.execute("""
-                    INSERT INTO order_categories (order_id, category)
-                    VALUES (?, ?)
-                """, (order_id, category.strip()))
-            except:
-                # Игнорируем дубликаты (UNIQUE constraint)
-                pass
-
+        cursor.insert_ignore_rows(
+            "order_categories", ("order_id", "category"),
+            [(order_id, category) for category in _split_categories(categories_list)],
+        )
         conn.commit()  # КРИТИЧНО: Фиксируем транзакцию
 
 
@@ -2418,6 +3837,70 @@ def migrate_add_chat_system():
             traceback.print_exc()
 
 
+def migrate_add_chat_read_markers():
+    """
+    НОВОЕ: Добавляет в chats отметки прочтения участников (last_read_message_id)
+    и ID последнего сообщения. Заполняет их по существующему флагу messages.is_read.
+    """
+    with get_db_connection() as conn:
+        cursor = get_cursor(conn)
+
+        backfill_sql = """
+            UPDATE chats
+            SET last_message_id = COALESCE((
+                    SELECT MAX(m.id) FROM messages m WHERE m.chat_id = chats.id
+                ), 0),
+                client_last_read_message_id = COALESCE((
+                    SELECT MAX(m.id) FROM messages m
+                    WHERE m.chat_id = chats.id AND m.sender_user_id != chats.client_user_id
+                    AND m.is_read = TRUE
+                ), 0),
+                worker_last_read_message_id = COALESCE((
+                    SELECT MAX(m.id) FROM messages m
+                    WHERE m.chat_id = chats.id AND m.sender_user_id != chats.worker_user_id
+                    AND m.is_read = TRUE
+                ), 0)
+        """
+
+        try:
+            if USE_POSTGRES:
+                print("📝 Добавление отметок прочтения чатов для PostgreSQL...")
+
+                cursor.execute(f"""
+                    DO $$
+                    BEGIN
+                        IF NOT EXISTS (
+                            SELECT 1 FROM information_schema.columns
+                            WHERE table_name = 'chats' AND column_name = 'last_message_id'
+                        ) THEN
+                            ALTER TABLE chats ADD COLUMN last_message_id INTEGER DEFAULT 0;
+                            ALTER TABLE chats ADD COLUMN client_last_read_message_id INTEGER DEFAULT 0;
+                            ALTER TABLE chats ADD COLUMN worker_last_read_message_id INTEGER DEFAULT 0;
+                            {backfill_sql};
+                        END IF;
+                    END $$;
+                """)
+                conn.commit()
+                print("✅ Отметки прочтения чатов успешно добавлены!")
+
+            else:
+                cursor.execute("PRAGMA table_info(chats)")
+                columns = [column[1] for column in cursor.fetchall()]
+
+                if 'last_message_id' not in columns:
+                    print("📝 Добавление отметок прочтения чатов...")
+                    cursor.execute("ALTER TABLE chats ADD COLUMN last_message_id INTEGER DEFAULT 0")
+                    cursor.execute("ALTER TABLE chats ADD COLUMN client_last_read_message_id INTEGER DEFAULT 0")
+                    cursor.execute("ALTER TABLE chats ADD COLUMN worker_last_read_message_id INTEGER DEFAULT 0")
+                    cursor.execute(backfill_sql)
+
+                conn.commit()
+                print("✅ Отметки прочтения чатов успешно добавлены!")
+
+        except Exception as e:
+            print(f"⚠️  Ошибка при добавлении отметок прочтения чатов: {e}")
+
+
 def migrate_add_transactions():
     """
     Создаёт таблицу для истории транзакций (платежей клиентов)
@@ -2602,7 +4085,7 @@ def migrate_normalize_categories():
             cursor.execute("SELECT id, categories FROM workers WHERE categories IS NOT NULL AND categories != ''")
             workers = cursor.fetchall()
 
-            migrated_count = 0
+            rows = []
             for worker in workers:
                 # PostgreSQL возвращает dict, SQLite может вернуть tuple
                 if isinstance(worker, dict):
@@ -2616,18 +4099,10 @@ def migrate_normalize_categories():
                     continue
 
                 # Разбиваем строку "Электрика, Сантехника" на список
-                categories = [cat.strip() for cat in categories_str.split(',') if cat.strip()]
+                rows.extend((worker_id, category) for category in _split_categories(categories_str))
 
-                for category in categories:
-                    try:
-                        cursor.execute("""
-                            INSERT INTO worker_categories (worker_id, category)
-                            VALUES (?, ?)
-                        """, (worker_id, category))
-                        migrated_count += 1
-                    except:
-                        # Пропускаем дубликаты
-                        pass
+            # ИСПРАВЛЕНО: Пачки многострочных INSERT вместо запроса на каждую категорию
+            migrated_count = cursor.insert_ignore_rows("worker_categories", ("worker_id", "category"), rows)
 
             # Создаем индексы для быстрого поиска
             cursor.execute("""
@@ -2690,7 +4165,7 @@ def migrate_normalize_order_categories():
             cursor.execute("SELECT id, category FROM orders WHERE category IS NOT NULL AND category != ''")
             orders = cursor.fetchall()
 
-            migrated_count = 0
+            rows = []
             for order in orders:
                 # PostgreSQL возвращает dict, SQLite может вернуть tuple
                 if isinstance(order, dict):
@@ -2704,20 +4179,10 @@ def migrate_normalize_order_categories():
                     continue
 
                 # Разбиваем строку на категории
-                categories = [cat.strip() for cat in categories_str.split(',') if cat.strip()]
+                rows.extend((order_id, category) for category in _split_categories(categories_str))
 
-                # Добавляем каждую категорию
-                for category in categories:
-                    try:
-                        cursor.execute("""
-                            INSERT INTO order_categories (order_id, category)
-                            VALUES (?, ?)
-                        """, (order_id, category))
-                        migrated_count += 1
-                    except Exception as e:
-                        # Игнорируем дубликаты (UNIQUE constraint)
-                        if "UNIQUE constraint failed" not in str(e) and "duplicate key" not in str(e):
-                            logger.warning(f"⚠️ Ошибка при добавлении категории '{category}' для заказа {order_id}: {e}")
+            # ИСПРАВЛЕНО: Пачки многострочных INSERT вместо запроса на каждую категорию
+            migrated_count = cursor.insert_ignore_rows("order_categories", ("order_id", "category"), rows)
 
             # 4. Создаем индексы для быстрого поиска
             cursor.execute("""
@@ -2943,28 +4408,45 @@ def get_user_chats(user_id):
         return cursor.fetchall()
 
 
-def send_message(chat_id, sender_user_id, sender_role, message_text):
-    """Отправляет сообщение в чат"""
+def send_message(chat_id, sender_user_id, sender_role, message_text, confirm_worker=False):
+    """
+    Отправляет сообщение в чат.
+    ИСПРАВЛЕНО: Вставка сообщения и обновление last_message_at в одной транзакции.
+    НОВОЕ: confirm_worker=True заодно отмечает подтверждение мастера тем же UPDATE.
+    """
     from datetime import datetime
 
     with get_db_connection() as conn:
         cursor = get_cursor(conn)
+        now = datetime.now().isoformat()
 
         # Добавляем сообщение
         cursor.execute("""
             INSERT INTO messages (chat_id, sender_user_id, sender_role, message_text, created_at)
             VALUES (?, ?, ?, ?, ?)
-        """, (chat_id, sender_user_id, sender_role, message_text, datetime.now().isoformat()))
+        """, (chat_id, sender_user_id, sender_role, message_text, now))
+        message_id = cursor.lastrowid
 
-        # Обновляем время последнего сообщения в чате
-        cursor.execute("""
-            UPDATE chats
-            SET last_message_at = ?
-            WHERE id = ?
-        """, (datetime.now().isoformat(), chat_id))
+        # Обновляем время и ID последнего сообщения в чате
+        if confirm_worker:
+            cursor.execute("""
+                UPDATE chats
+                SET last_message_at = ?, last_message_id = ?,
+                    worker_confirmed = TRUE, worker_confirmed_at = ?
+                WHERE id = ?
+            """, (now, message_id, now, chat_id))
+        else:
+            cursor.execute("""
+                UPDATE chats
+                SET last_message_at = ?, last_message_id = ?
+                WHERE id = ?
+            """, (now, message_id, chat_id))
 
         conn.commit()
-        return cursor.lastrowid
+
+    if confirm_worker:
+        _chat_sessions.invalidate_chat(chat_id)
+    return message_id
 
 
 def get_chat_messages(chat_id, limit=50):
@@ -2981,25 +4463,45 @@ def get_chat_messages(chat_id, limit=50):
 
 
 def mark_messages_as_read(chat_id, user_id):
-    """Отмечает сообщения как прочитанные для пользователя"""
+    """
+    Отмечает сообщения как прочитанные для пользователя.
+    ИСПРАВЛЕНО: Сдвигает отметку прочтения участника до последнего сообщения
+    (одна строка chats) вместо UPDATE всех сообщений чата.
+    """
     with get_db_connection() as conn:
         cursor = get_cursor(conn)
         cursor.execute("""
-            UPDATE messages
-            SET is_read = TRUE
-            WHERE chat_id = ? AND sender_user_id != ?
-        """, (chat_id, user_id))
+            UPDATE chats
+            SET client_last_read_message_id = CASE
+                    WHEN client_user_id = ? THEN last_message_id
+                    ELSE client_last_read_message_id
+                END,
+                worker_last_read_message_id = CASE
+                    WHEN worker_user_id = ? THEN last_message_id
+                    ELSE worker_last_read_message_id
+                END
+            WHERE id = ?
+        """, (user_id, user_id, chat_id))
         conn.commit()
 
 
 def get_unread_messages_count(chat_id, user_id):
-    """Получает количество непрочитанных сообщений"""
+    """
+    Получает количество непрочитанных сообщений.
+    ИСПРАВЛЕНО: Считает только хвост чата после отметки прочтения участника
+    (индекс messages(chat_id, id)), а не сканирует всю историю по is_read.
+    """
     with get_db_connection() as conn:
         cursor = get_cursor(conn)
         cursor.execute("""
-            SELECT COUNT(*) FROM messages
-            WHERE chat_id = ? AND sender_user_id != ? AND is_read = FALSE
-        """, (chat_id, user_id))
+            SELECT COUNT(*) FROM messages m
+            JOIN chats c ON c.id = m.chat_id
+            WHERE m.chat_id = ? AND m.sender_user_id != ?
+            AND m.id > CASE
+                WHEN c.client_user_id = ? THEN COALESCE(c.client_last_read_message_id, 0)
+                ELSE COALESCE(c.worker_last_read_message_id, 0)
+            END
+        """, (chat_id, user_id, user_id))
         result = cursor.fetchone()
         if not result:
             return 0
@@ -3022,6 +4524,7 @@ def confirm_worker_in_chat(chat_id):
             WHERE id = ?
         """, (datetime.now().isoformat(), chat_id))
         conn.commit()
+    _chat_sessions.invalidate_chat(chat_id)
 
 
 def is_worker_confirmed(chat_id):
@@ -3074,6 +4577,7 @@ def set_active_chat(telegram_id, chat_id, role):
             """, (telegram_id, chat_id, role, datetime.now().isoformat()))
 
         conn.commit()
+        _chat_sessions.invalidate(telegram_id)
         logger.info(f"✅ Активный чат сохранён: user={telegram_id}, chat={chat_id}, role={role}")
 
 
@@ -3127,9 +4631,66 @@ def clear_active_chat(telegram_id):
             cursor.execute("DELETE FROM active_chats WHERE telegram_id = ?", (telegram_id,))
 
         conn.commit()
+        _chat_sessions.invalidate(telegram_id)
         logger.info(f"✅ Активный чат очищен для user={telegram_id}")
 
 
+def get_chat_session(telegram_id):
+    """
+    НОВОЕ: Метаданные активного чата пользователя для быстрой пересылки сообщений.
+
+    Один JOIN при промахе кэша, далее - чтение из памяти до инвалидации.
+
+    Args:
+        telegram_id: Telegram ID отправителя
+
+    Returns:
+        dict: {
+            'chat_id', 'role', 'user_id', 'order_id', 'order_status',
+            'worker_confirmed', 'other_user_id', 'other_telegram_id'
+        } или None если активного чата нет
+    """
+    found, session = _chat_sessions.lookup(telegram_id)
+    if found:
+        return session
+
+    with get_db_connection() as conn:
+        cursor = get_cursor(conn)
+        cursor.execute("""
+            SELECT
+                ac.chat_id, ac.role,
+                c.order_id, c.client_user_id, c.worker_user_id, c.worker_confirmed,
+                o.status as order_status,
+                cu.telegram_id as client_telegram_id,
+                wu.telegram_id as worker_telegram_id
+            FROM active_chats ac
+            JOIN chats c ON c.id = ac.chat_id
+            JOIN orders o ON o.id = c.order_id
+            JOIN users cu ON cu.id = c.client_user_id
+            JOIN users wu ON wu.id = c.worker_user_id
+            WHERE ac.telegram_id = ?
+        """, (telegram_id,))
+        row = cursor.fetchone()
+
+    session = None
+    if row:
+        row = dict(row)
+        is_client = row['role'] == 'client'
+        session = {
+            'chat_id': row['chat_id'],
+            'role': row['role'],
+            'user_id': row['client_user_id'] if is_client else row['worker_user_id'],
+            'order_id': row['order_id'],
+            'order_status': row['order_status'],
+            'worker_confirmed': bool(row['worker_confirmed']),
+            'other_user_id': row['worker_user_id'] if is_client else row['client_user_id'],
+            'other_telegram_id': row['worker_telegram_id'] if is_client else row['client_telegram_id'],
+        }
+
+    _chat_sessions.store(telegram_id, session)
+    return session
+
+
 # === TRANSACTION HELPERS ===
 
 def create_transaction(user_id, order_id, bid_id, transaction_type, amount, currency='BYN', payment_method='test', description=''):
@@ -3170,15 +4731,20 @@ def get_transaction_by_order_bid(order_id, bid_id):
         return cursor.fetchone()
 
 
-def get_expired_chats(hours=24):
+def get_expired_chats(hours=24, limit=None):
     """
     Получает чаты где мастер не ответил в течение заданного времени
+    ИСПРАВЛЕНО: Уже обработанные (status = 'expired') чаты не возвращаются.
+    НОВОЕ: Одним JOIN возвращает telegram_id обоих участников и название заказа,
+    limit ограничивает размер пачки для фоновой очистки.
 
     Args:
         hours: количество часов для проверки (по умолчанию 24)
+        limit: максимальное количество чатов (None - без ограничения)
 
     Returns:
         Список чатов где worker_confirmed = FALSE и прошло более hours часов с created_at
+        (поля chats.* + client_telegram_id, worker_telegram_id, order_title)
     """
     from datetime import datetime, timedelta
 
@@ -3186,22 +4752,131 @@ def get_expired_chats(hours=24):
         cursor = get_cursor(conn)
         expiration_time = datetime.now() - timedelta(hours=hours)
 
+        query = """
+            SELECT
+                c.*,
+                cu.telegram_id as client_telegram_id,
+                wu.telegram_id as worker_telegram_id,
+                COALESCE(o.title, o.description) as order_title
+            FROM chats c
+            JOIN orders o ON o.id = c.order_id
+            JOIN users cu ON cu.id = c.client_user_id
+            JOIN users wu ON wu.id = c.worker_user_id
+            WHERE c.worker_confirmed = FALSE
+            AND COALESCE(c.status, 'active') = 'active'
+            AND c.created_at < ?
+            ORDER BY c.created_at
+        """
+        params = [expiration_time.isoformat()]
+        if limit:
+            query += " LIMIT ?"
+            params.append(limit)
+
+        cursor.execute(query, tuple(params))
+        return [dict(row) for row in cursor.fetchall()]
+
+
+def count_expired_chats(hours=24):
+    """НОВОЕ: Количество необработанных просроченных чатов (размер очереди очистки)"""
+    from datetime import datetime, timedelta
+
+    with get_db_connection() as conn:
+        cursor = get_cursor(conn)
+        expiration_time = datetime.now() - timedelta(hours=hours)
         cursor.execute("""
-            SELECT * FROM chats
+            SELECT COUNT(*) FROM chats
             WHERE worker_confirmed = FALSE
+            AND COALESCE(status, 'active') = 'active'
             AND created_at < ?
         """, (expiration_time.isoformat(),))
+        return _get_count_from_result(cursor.fetchone())
 
-        return cursor.fetchall()
 
+def mark_chat_as_expired(chat_ids):
+    """
+    Помечает чат как просроченный (мастер не ответил вовремя)
+    ИСПРАВЛЕНО: Раньше была заглушкой - одни и те же чаты обрабатывались при каждой проверке.
+    НОВОЕ: Обрабатывает пачку чатов одной транзакцией set-based запросами:
+    - chats.status = 'expired'
+    - заказ возвращается в 'open' (если мастер всё ещё ожидается)
+    - выбранный отклик отклоняется
+    - рейтинг мастера снижается (оценка 1.0 за каждый чат)
+
+    Args:
+        chat_ids: ID чата или список ID
+
+    Returns:
+        list: ID чатов, которые были обработаны этим вызовом
+    """
+    if not isinstance(chat_ids, (list, tuple, set)):
+        chat_ids = [chat_ids]
+    if not chat_ids:
+        return []
 
-def mark_chat_as_expired(chat_id):
-    """Помечает чат как просроченный (мастер не ответил вовремя)"""
     with get_db_connection() as conn:
         cursor = get_cursor(conn)
-        # Можно добавить поле expired_at или is_expired, но пока просто оставим
-        # Чат будет считаться просроченным по факту что worker_confirmed = 0 и прошло 24 часа
-        pass
+
+        # Берём только ещё не обработанные чаты (защита от повторного снижения рейтинга)
+        placeholders = ','.join('?' * len(chat_ids))
+        cursor.execute(f"""
+            SELECT id, order_id, bid_id, worker_user_id FROM chats
+            WHERE id IN ({placeholders})
+            AND COALESCE(status, 'active') = 'active'
+        """, tuple(chat_ids))
+        chats = [dict(row) for row in cursor.fetchall()]
+        if not chats:
+            return []
+
+        expired_ids = [chat['id'] for chat in chats]
+        order_ids = list({chat['order_id'] for chat in chats})
+        bid_ids = [chat['bid_id'] for chat in chats]
+
+        chat_placeholders = ','.join('?' * len(expired_ids))
+        order_placeholders = ','.join('?' * len(order_ids))
+        bid_placeholders = ','.join('?' * len(bid_ids))
+
+        cursor.execute(f"""
+            UPDATE chats SET status = 'expired'
+            WHERE id IN ({chat_placeholders})
+        """, tuple(expired_ids))
+
+        # Заказ снова открыт - клиент может выбрать другого мастера
+        cursor.execute(f"""
+            UPDATE orders SET status = 'open'
+            WHERE id IN ({order_placeholders})
+            AND status IN ('master_selected', 'waiting_master_confirmation')
+        """, tuple(order_ids))
+
+        # Отклик не удаляем - клиент видит, что этот мастер не ответил
+        cursor.execute(f"""
+            UPDATE bids SET status = 'rejected'
+            WHERE id IN ({bid_placeholders})
+        """, tuple(bid_ids))
+
+        # Снижаем рейтинг мастеров (те же агрегаты, что в _apply_rating)
+        cursor.executemany("""
+            UPDATE workers
+            SET
+                rating_sum = rating_sum + ?,
+                rating_count = rating_count + 1,
+                rating = (rating_sum + ?) / (rating_count + 1),
+                profile_version = profile_version + 1
+            WHERE user_id = ?
+        """, [(1.0, 1.0, chat['worker_user_id']) for chat in chats])
+        cursor.executemany(
+            f"UPDATE workers SET ranking_score = {_ranking_score_sql()} WHERE user_id = ?",
+            [(chat['worker_user_id'],) for chat in chats],
+        )
+
+        # Вновь открытые заказы снова доступны подходящим мастерам
+        _shift_available_orders_counters(cursor, order_ids, +1)
+
+        conn.commit()
+
+    for order_id in order_ids:
+        _chat_sessions.invalidate_order(order_id)
+
+    return expired_ids
 
 
 # === NOTIFICATION SETTINGS HELPERS ===
@@ -3480,39 +5155,23 @@ def get_banned_users():
 
 
 def search_users(query, limit=20):
-    """Ищет пользователей по telegram_id, имени или username"""
-    with get_db_connection() as conn:
-        cursor = get_cursor(conn)
-        # Ищем по telegram_id (точное совпадение) или имени/username (LIKE)
-        if USE_POSTGRES:
-            cursor.execute("""
-                SELECT u.*,
-                       w.id as worker_id,
-                       c.id as client_id
-                FROM users u
-                LEFT JOIN workers w ON u.id = w.user_id
-                LEFT JOIN clients c ON u.id = c.user_id
-                WHERE u.telegram_id::text LIKE %s
-                   OR LOWER(u.full_name) LIKE LOWER(%s)
-                   OR LOWER(u.username) LIKE LOWER(%s)
-                ORDER BY u.created_at DESC
-                LIMIT %s
-            """, (f'%{query}%', f'%{query}%', f'%{query}%', limit))
-        else:
-            cursor.execute("""
-                SELECT u.*,
-                       w.id as worker_id,
-                       c.id as client_id
-                FROM users u
-                LEFT JOIN workers w ON u.id = w.user_id
-                LEFT JOIN clients c ON u.id = c.user_id
-                WHERE CAST(u.telegram_id AS TEXT) LIKE ?
-                   OR LOWER(u.full_name) LIKE LOWER(?)
-                   OR LOWER(u.username) LIKE LOWER(?)
-                ORDER BY u.created_at DESC
-                LIMIT ?
-            """, (f'%{query}%', f'%{query}%', f'%{query}%', limit))
-        return cursor.fetchall()
+    """
+    Ищет пользователей по telegram_id или имени из профиля мастера/заказчика.
+
+    ИСПРАВЛЕНО: Раньше - LIKE '%q%' по несуществующим users.full_name/username
+    и сортировка по дате (полный скан на каждый поиск). Теперь - индексный поиск
+    с ранжированием (см. раздел "ПОИСК ПОЛЬЗОВАТЕЛЕЙ ДЛЯ АДМИН-ПАНЕЛИ"):
+    - цифры: префикс telegram_id по уникальному индексу
+    - текст: pg_trgm GIN (PostgreSQL) / FTS5 (SQLite), лучшие совпадения первыми
+
+    В строках результата есть full_name - имя из профиля.
+    """
+    query = (query or "").strip().lstrip("@")
+    if not query:
+        return []
+    if query.isdigit():
+        return _search_users_by_telegram_id_prefix(query, limit)
+    return _search_users_by_name(query, limit)
 
 
 def get_users_filtered(filter_type='all', page=1, per_page=20):
@@ -3798,6 +5457,8 @@ def create_indexes():
             cursor.execute("CREATE INDEX IF NOT EXISTS idx_orders_created_at ON orders(created_at DESC)")
             # Composite index для часто используемого запроса
             cursor.execute("CREATE INDEX IF NOT EXISTS idx_orders_status_category ON orders(status, category)")
+            # Индекс для поиска истёкших заказов по дедлайну
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_orders_status_deadline ON orders(status, deadline)")
 
             # Индексы для таблицы bids
             cursor.execute("CREATE INDEX IF NOT EXISTS idx_bids_order_id ON bids(order_id)")
@@ -3811,17 +5472,21 @@ def create_indexes():
             cursor.execute("CREATE INDEX IF NOT EXISTS idx_reviews_to_user ON reviews(to_user_id)")
             cursor.execute("CREATE INDEX IF NOT EXISTS idx_reviews_order_id ON reviews(order_id)")
 
+            # Индекс для подсчёта непрочитанных сообщений (хвост чата после last_read_message_id)
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_messages_chat_id_id ON messages(chat_id, id)")
+
             conn.commit()
             print("✅ Индексы успешно созданы для оптимизации производительности")
 
         except Exception as e:
             print(f"⚠️  Предупреждение при создании индексов: {e}")
 
-def create_order(client_id, city, categories, description, photos, videos=None, budget_type="none", budget_value=0):
+def create_order(client_id, city, categories, description, photos, videos=None, budget_type="none", budget_value=0, deadline=None):
     """
     Создаёт новый заказ.
     ИСПРАВЛЕНО: Валидация file_id для фотографий.
     ОБНОВЛЕНО: Добавлена поддержка видео.
+    НОВОЕ: deadline (datetime или None) - срок, после которого заказ истекает.
     """
     # Rate limiting: проверяем лимит заказов
     allowed, remaining_seconds = _rate_limiter.is_allowed(client_id, "create_order", RATE_LIMIT_ORDERS_PER_HOUR)
@@ -3858,23 +5523,52 @@ def create_order(client_id, city, categories, description, photos, videos=None,
         # Преобразуем список видео в строку
         videos_str = ",".join(videos) if videos and isinstance(videos, list) else (videos if videos else "")
 
-        cursor.execute("""
-            INSERT INTO orders (
-                client_id, city, category, description, photos, videos,
-                budget_type, budget_value, status, created_at
+        deadline_str = deadline.strftime(ORDER_DEADLINE_FORMAT) if deadline else None
+        order_values = (client_id, city, categories_str, description, photos_str, videos_str, budget_type, budget_value, deadline_str, now)
+
+        # ИСПРАВЛЕНИЕ: Добавляем категории в нормализованную таблицу
+        # ИСПРАВЛЕНО: Заказ и его категории пишутся в одной транзакции
+        categories_list = _split_categories(categories) if categories else []
+
+        if USE_POSTGRES:
+            # Один запрос (один round trip): заказ через CTE, категории из массива
+            cursor.execute("""
+                WITH new_order AS (
+                    INSERT INTO orders (
+                        client_id, city, category, description, photos, videos,
+                        budget_type, budget_value, deadline, status, created_at
+                    )
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 'open', ?)
+                    RETURNING id
+                ), new_categories AS (
+                    INSERT INTO order_categories (order_id, category)
+                    SELECT new_order.id, category FROM new_order, unnest(?::text[]) AS category
+                    ON CONFLICT DO NOTHING
+                )
+                SELECT id FROM new_order
+            """, order_values + (categories_list,))
+            order_id = cursor.fetchone()['id']
+        else:
+            cursor.execute("""
+                INSERT INTO orders (
+                    client_id, city, category, description, photos, videos,
+                    budget_type, budget_value, deadline, status, created_at
+                )
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 'open', ?)
+            """, order_values)
+            order_id = cursor.lastrowid
+            cursor.insert_ignore_rows(
+                "order_categories", ("order_id", "category"),
+                [(order_id, category) for category in categories_list],
             )
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, 'open', ?)
-        """, (client_id, city, categories_str, description, photos_str, videos_str, budget_type, budget_value, now))
 
-        order_id = cursor.lastrowid
         conn.commit()  # КРИТИЧНО: Фиксируем транзакцию создания заказа
         logger.info(f"✅ Создан заказ: ID={order_id}, Клиент={client_id}, Город={city}, Категории={categories_str}, Фото={len(photos) if photos else 0}, Видео={len(videos) if videos else 0}")
+        if categories_list:
+            logger.info(f"📋 Добавлены категории для заказа {order_id}: {categories_list}")
 
-    # ИСПРАВЛЕНИЕ: Добавляем категории в нормализованную таблицу
-    if categories:
-        categories_list = categories if isinstance(categories, list) else [cat.strip() for cat in categories.split(',') if cat.strip()]
-        add_order_categories(order_id, categories_list)
-        logger.info(f"📋 Добавлены категории для заказа {order_id}: {categories_list}")
+    # НОВОЕ: Заказ стал доступен подходящим мастерам - пакетно увеличиваем их счётчики
+    adjust_available_orders_counters([order_id], +1)
 
     return order_id
 
@@ -3929,7 +5623,7 @@ def get_orders_by_category(category, page=1, per_page=10):
         return orders, total_count, has_next_page
 
 
-def get_orders_by_categories(categories_list, per_page=30, worker_id=None):
+def get_orders_by_categories(categories_list, per_page=30, worker_id=None, exclude_seen=False):
     """
     ИСПРАВЛЕНО: Получает заказы для НЕСКОЛЬКИХ категорий ОДНИМ запросом с ТОЧНЫМ поиском.
     ИСПРАВЛЕНО: Фильтрует заказы по городам мастера (мастер видит только заказы из СВОИХ городов).
@@ -3948,6 +5642,9 @@ def get_orders_by_categories(categories_list, per_page=30, worker_id=None):
         categories_list: Список категорий ["Электрика", "Сантехника"]
         per_page: Максимум заказов (по умолчанию 30)
         worker_id: ID мастера для фильтрации по городам (опционально)
+        exclude_seen: НОВОЕ: Исключить заказы, на которые мастер уже откликнулся
+            или от которых отказался (только вместе с worker_id). Фильтр в SQL,
+            а не после LIMIT - список не "худеет" из-за уже просмотренных заказов
 
     Returns:
         Список заказов, отсортированных по дате (новые первые)
@@ -3972,6 +5669,20 @@ def get_orders_by_categories(categories_list, per_page=30, worker_id=None):
                 )
             """
 
+        # НОВОЕ: declined_orders.worker_id хранит users.id мастера (см. decline_order)
+        seen_filter = ""
+        if worker_id and exclude_seen:
+            seen_filter = """
+                AND NOT EXISTS (
+                    SELECT 1 FROM bids b WHERE b.order_id = o.id AND b.worker_id = ?
+                )
+                AND NOT EXISTS (
+                    SELECT 1 FROM declined_orders d
+                    WHERE d.order_id = o.id
+                    AND d.worker_id = (SELECT user_id FROM workers WHERE id = ?)
+                )
+            """
+
         query = f"""
             SELECT DISTINCT
                 o.*,
@@ -3984,6 +5695,7 @@ def get_orders_by_categories(categories_list, per_page=30, worker_id=None):
             WHERE o.status = 'open'
             AND oc.category IN ({placeholders})
             {city_filter}
+            {seen_filter}
             ORDER BY o.created_at DESC
             LIMIT ?
         """
@@ -3995,6 +5707,10 @@ def get_orders_by_categories(categories_list, per_page=30, worker_id=None):
             params.append(worker_id)
             params.append(worker_id)
 
+        if seen_filter:
+            params.append(worker_id)
+            params.append(worker_id)
+
         params.append(per_page)
 
         logger.info(f"🔍 Поиск заказов: категории={categories_list}, worker_id={worker_id}")
@@ -4063,12 +5779,16 @@ def update_order_status(order_id, new_status):
     """Обновляет статус заказа"""
     with get_db_connection() as conn:
         cursor = get_cursor(conn)
+        # НОВОЕ: Завершённый заказ засчитывается мастеру до смены статуса
+        if new_status in COMPLETED_ORDER_STATUSES:
+            _credit_completed_order(cursor, order_id)
         cursor.execute("""
             UPDATE orders
             SET status = ?
             WHERE id = ?
         """, (new_status, order_id))
         conn.commit()
+        _chat_sessions.invalidate_order(order_id)
         success = cursor.rowcount > 0
         if success:
             logger.info(f"✅ Обновлен статус заказа: ID={order_id}, Новый статус={new_status}")
@@ -4122,6 +5842,10 @@ def cancel_order(order_id, cancelled_by_user_id, reason=""):
                 'notified_workers': []
             }
 
+        # НОВОЕ: Отменённый открытый заказ больше не доступен мастерам
+        if order_dict['status'] == 'open':
+            _shift_available_orders_counters(cursor, [order_id], -1)
+
         # Обновляем статус заказа
         cursor.execute("""
             UPDATE orders
@@ -4147,6 +5871,7 @@ def cancel_order(order_id, cancelled_by_user_id, reason=""):
         """, (order_id,))
 
         conn.commit()
+        _chat_sessions.invalidate_order(order_id)
 
         logger.info(f"Заказ {order_id} отменен пользователем {cancelled_by_user_id}. Причина: {reason}")
 
@@ -4157,12 +5882,57 @@ def cancel_order(order_id, cancelled_by_user_id, reason=""):
         }
 
 
-def check_expired_orders():
+ORDER_DEADLINE_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+def parse_order_deadline(value):
+    """
+    Разбирает orders.deadline в datetime.
+    Поддерживает основной формат и старые значения в ISO (с 'T' или только дата).
+    """
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(str(value))
+    except ValueError:
+        return None
+
+
+def get_pending_order_deadlines():
+    """
+    НОВОЕ: Возвращает дедлайны всех заказов, которые ещё могут истечь.
+    Используется для восстановления планировщика дедлайнов при старте бота.
+
+    Returns:
+        list: [(order_id, deadline: datetime), ...]
+    """
+    with get_db_connection() as conn:
+        cursor = get_cursor(conn)
+        cursor.execute("""
+            SELECT id, deadline FROM orders
+            WHERE deadline IS NOT NULL
+            AND deadline != ''
+            AND status IN ('open', 'waiting_master_confirmation')
+        """)
+        rows = cursor.fetchall()
+
+    result = []
+    for row in rows:
+        row = dict(row)
+        deadline = parse_order_deadline(row['deadline'])
+        if deadline:
+            result.append((row['id'], deadline))
+    return result
+
+
+def check_expired_orders(order_ids=None):
     """
     НОВОЕ: Проверяет и обрабатывает заказы с истекшим дедлайном.
+    ИСПРАВЛЕНО: Обработка пачкой - один SELECT с получателями и set-based UPDATE
+    вместо отдельных запросов на каждый заказ.
 
     Автоматически находит заказы, у которых:
-    - deadline прошел (deadline < now)
+    - deadline прошел (deadline <= now)
     - статус 'open' или 'waiting_master_confirmation'
 
     Для найденных заказов:
@@ -4170,87 +5940,109 @@ def check_expired_orders():
     - Отклоняет все активные отклики
     - Возвращает информацию для отправки уведомлений
 
+    Args:
+        order_ids: Проверить только эти заказы (из планировщика). None - все заказы.
+
     Returns:
         list: Список словарей с информацией о просроченных заказах:
             [
                 {
                     'order_id': int,
                     'client_user_id': int,
+                    'client_telegram_id': int,
                     'worker_user_ids': [int, ...],
+                    'worker_telegram_ids': [int, ...],
                     'title': str
                 },
                 ...
             ]
     """
-    from datetime import datetime
+    if order_ids is not None and not order_ids:
+        return []
 
     with get_db_connection() as conn:
         cursor = get_cursor(conn)
 
-        # Находим просроченные заказы
-        now = datetime.now().isoformat()
+        now = datetime.now().strftime(ORDER_DEADLINE_FORMAT)
+        params = [now]
+        ids_filter = ""
+        if order_ids is not None:
+            ids_filter = f"AND o.id IN ({','.join('?' * len(order_ids))})"
+            params.extend(order_ids)
 
-        cursor.execute("""
-            SELECT o.id, o.title, o.deadline, c.user_id as client_user_id
+        # Находим просроченные заказы вместе с telegram_id клиента и откликнувшихся мастеров
+        cursor.execute(f"""
+            SELECT
+                o.id, o.title, o.description, o.status,
+                c.user_id as client_user_id, cu.telegram_id as client_telegram_id,
+                w.user_id as worker_user_id, wu.telegram_id as worker_telegram_id
             FROM orders o
             JOIN clients c ON o.client_id = c.id
+            JOIN users cu ON cu.id = c.user_id
+            LEFT JOIN bids b ON b.order_id = o.id AND b.status IN ('active', 'pending', 'selected')
+            LEFT JOIN workers w ON w.id = b.worker_id
+            LEFT JOIN users wu ON wu.id = w.user_id
             WHERE o.deadline IS NOT NULL
             AND o.deadline != ''
-            AND o.deadline < ?
+            AND o.deadline <= ?
             AND o.status IN ('open', 'waiting_master_confirmation')
-        """, (now,))
+            {ids_filter}
+            ORDER BY o.id
+        """, tuple(params))
 
-        expired_orders = cursor.fetchall()
+        rows = [dict(row) for row in cursor.fetchall()]
 
-        if not expired_orders:
+        if not rows:
             logger.debug("Просроченных заказов не найдено")
             return []
 
-        result = []
+        expired = {}
+        open_order_ids = []
+        for row in rows:
+            order_id = row['id']
+            if order_id not in expired:
+                expired[order_id] = {
+                    'order_id': order_id,
+                    'client_user_id': row['client_user_id'],
+                    'client_telegram_id': row['client_telegram_id'],
+                    'worker_user_ids': [],
+                    'worker_telegram_ids': [],
+                    'title': row['title'] or (row['description'] or '')[:50]
+                }
+                if row['status'] == 'open':
+                    open_order_ids.append(order_id)
+            if row['worker_user_id'] is not None and row['worker_user_id'] not in expired[order_id]['worker_user_ids']:
+                expired[order_id]['worker_user_ids'].append(row['worker_user_id'])
+                expired[order_id]['worker_telegram_ids'].append(row['worker_telegram_id'])
+
+        expired_ids = list(expired.keys())
+        placeholders = ','.join('?' * len(expired_ids))
+
+        # НОВОЕ: Одним пакетом уменьшаем счётчики мастеров для истёкших открытых заказов
+        _shift_available_orders_counters(cursor, open_order_ids, -1)
+
+        # Обновляем статус заказов одним запросом
+        cursor.execute(f"""
+            UPDATE orders
+            SET status = 'expired'
+            WHERE id IN ({placeholders})
+            AND status IN ('open', 'waiting_master_confirmation')
+        """, tuple(expired_ids))
 
-        for order_row in expired_orders:
-            order_id = order_row[0]
-            title = order_row[1]
-            client_user_id = order_row[3]
+        # Отклоняем все активные отклики одним запросом
+        cursor.execute(f"""
+            UPDATE bids
+            SET status = 'rejected'
+            WHERE order_id IN ({placeholders}) AND status IN ('active', 'pending', 'selected')
+        """, tuple(expired_ids))
 
-            # Получаем всех мастеров, которые откликнулись
-            cursor.execute("""
-                SELECT DISTINCT w.user_id
-                FROM bids b
-                JOIN workers w ON b.worker_id = w.id
-                WHERE b.order_id = ? AND b.status IN ('pending', 'selected')
-            """, (order_id,))
+        conn.commit()
 
-            worker_rows = cursor.fetchall()
-            worker_user_ids = [row[0] for row in worker_rows]
+    for order_id in expired_ids:
+        _chat_sessions.invalidate_order(order_id)
 
-            # Обновляем статус заказа
-            cursor.execute("""
-                UPDATE orders
-                SET status = 'expired'
-                WHERE id = ?
-            """, (order_id,))
-
-            # Отклоняем все активные отклики
-            cursor.execute("""
-                UPDATE bids
-                SET status = 'rejected'
-                WHERE order_id = ? AND status IN ('pending', 'selected')
-            """, (order_id,))
-
-            logger.info(f"Заказ {order_id} истек по дедлайну. Клиент: {client_user_id}, Мастеров: {len(worker_user_ids)}")
-
-            result.append({
-                'order_id': order_id,
-                'client_user_id': client_user_id,
-                'worker_user_ids': worker_user_ids,
-                'title': title
-            })
-
-        conn.commit()
-
-        logger.info(f"Обработано просроченных заказов: {len(result)}")
-        return result
+    logger.info(f"Обработано просроченных заказов: {len(expired_ids)}")
+    return list(expired.values())
 
 
 def create_bid(order_id, worker_id, proposed_price, currency, comment="", ready_in_days=7):
@@ -4269,6 +6061,9 @@ def create_bid(order_id, worker_id, proposed_price, currency, comment="", ready_
 
         now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
+        # НОВОЕ: После отклика заказ пропадает из доступных для этого мастера
+        _shift_available_orders_counters(cursor, [order_id], -1, worker_id=worker_id)
+
         cursor.execute("""
             INSERT INTO bids (
                 order_id, worker_id, proposed_price, currency,
@@ -4276,9 +6071,12 @@ def create_bid(order_id, worker_id, proposed_price, currency, comment="", ready_
             )
             VALUES (?, ?, ?, ?, ?, ?, ?, 'active')
         """, (order_id, worker_id, proposed_price, currency, comment, ready_in_days, now))
+        bid_id = cursor.lastrowid
+
+        # НОВОЕ: Отклик - активность мастера для ранжирования
+        _touch_worker_activity(cursor, worker_id)
 
         conn.commit()
-        bid_id = cursor.lastrowid
         logger.info(f"✅ Создан отклик: ID={bid_id}, Заказ={order_id}, Мастер={worker_id}, Цена={proposed_price} {currency}, Срок={ready_in_days} дн.")
         return bid_id
 
@@ -4303,6 +6101,7 @@ def get_bids_for_order(order_id):
                 w.city as worker_city,
                 w.categories as worker_categories,
                 w.verified_reviews as worker_verified_reviews,
+                w.profile_version as worker_profile_version,
                 u.telegram_id as worker_telegram_id
             FROM bids b
             JOIN workers w ON b.worker_id = w.id
@@ -4315,6 +6114,90 @@ def get_bids_for_order(order_id):
         return cursor.fetchall()
 
 
+# Сортировки списка откликов: {sort_order: ORDER BY}. При равенстве - в порядке поступления
+BID_LIST_SORT_ORDERS = {
+    'default': "b.created_at ASC, b.id ASC",
+    'price_low': "b.proposed_price ASC, b.created_at ASC, b.id ASC",
+    'price_high': "b.proposed_price DESC, b.created_at ASC, b.id ASC",
+    'rating': "w.rating DESC, b.created_at ASC, b.id ASC",
+    'timeline': "COALESCE(b.ready_in_days, 999) ASC, b.created_at ASC, b.id ASC",
+}
+
+
+def get_bid_list_for_order(order_id, sort_order='default', client_id=None):
+    """
+    НОВОЕ: Облегчённый список активных откликов на заказ, отсортированный в SQL.
+
+    Только поля для навигации, сортировки и выбора мастера. Тяжёлые поля
+    мастера (описание, фото) догружаются по одному мастеру через
+    get_bid_worker_details() при открытии карточки отклика.
+
+    Args:
+        order_id: ID заказа
+        sort_order: Ключ BID_LIST_SORT_ORDERS (неизвестный - порядок поступления)
+        client_id: Если указан - только отклики на заказ этого заказчика
+            (проверка владельца в том же запросе; пустой список - нет
+            откликов или чужой заказ)
+    """
+    order_by = BID_LIST_SORT_ORDERS.get(sort_order, BID_LIST_SORT_ORDERS['default'])
+
+    owner_filter = ""
+    params = [order_id]
+    if client_id is not None:
+        owner_filter = "AND b.order_id IN (SELECT id FROM orders WHERE id = ? AND client_id = ?)"
+        params.extend([order_id, client_id])
+
+    with get_db_connection() as conn:
+        cursor = get_cursor(conn)
+        cursor.execute(f"""
+            SELECT
+                b.id,
+                b.order_id,
+                b.worker_id,
+                b.proposed_price,
+                b.currency,
+                b.ready_in_days,
+                b.comment,
+                b.created_at,
+                w.name as worker_name,
+                w.rating as worker_rating,
+                w.rating_count as worker_rating_count,
+                w.verified_reviews as worker_verified_reviews,
+                w.profile_version as worker_profile_version,
+                u.telegram_id as worker_telegram_id
+            FROM bids b
+            JOIN workers w ON b.worker_id = w.id
+            JOIN users u ON w.user_id = u.id
+            WHERE b.order_id = ?
+            AND b.status = 'active'
+            {owner_filter}
+            ORDER BY {order_by}
+        """, params)
+
+        return cursor.fetchall()
+
+
+def get_bid_worker_details(worker_id):
+    """
+    НОВОЕ: Тяжёлые поля мастера для карточки отклика (по одному мастеру).
+    Имена колонок совпадают с get_bids_for_order (префикс worker_).
+    """
+    with get_db_connection() as conn:
+        cursor = get_cursor(conn)
+        cursor.execute("""
+            SELECT
+                w.experience as worker_experience,
+                w.city as worker_city,
+                w.categories as worker_categories,
+                w.description as worker_description,
+                w.profile_photo as worker_profile_photo,
+                w.portfolio_photos as worker_portfolio_photos
+            FROM workers w
+            WHERE w.id = ?
+        """, (worker_id,))
+        return cursor.fetchone()
+
+
 def check_worker_bid_exists(order_id, worker_id):
     """Проверяет, откликался ли уже мастер на этот заказ"""
     with get_db_connection() as conn:
@@ -4355,6 +6238,7 @@ def get_bid_by_id(bid_id):
                     w.city as worker_city,
                     w.categories as worker_categories,
                     w.verified_reviews as worker_verified_reviews,
+                    w.profile_version as worker_profile_version,
                     u.telegram_id as worker_telegram_id
                 FROM bids b
                 JOIN workers w ON b.worker_id = w.id
@@ -4376,6 +6260,7 @@ def get_bid_by_id(bid_id):
                     w.city as worker_city,
                     w.categories as worker_categories,
                     w.verified_reviews as worker_verified_reviews,
+                    w.profile_version as worker_profile_version,
                     u.telegram_id as worker_telegram_id
                 FROM bids b
                 JOIN workers w ON b.worker_id = w.id
@@ -4474,6 +6359,10 @@ def select_bid(bid_id):
             logger.warning(f"Заказ {order_id} уже в статусе '{order_status}', нельзя выбрать мастера")
             return False
 
+        # НОВОЕ: Открытый заказ уходит из доступных у всех подходящих мастеров
+        if order_status == 'open':
+            _shift_available_orders_counters(cursor, [order_id], -1)
+
         # Обновляем статус выбранного отклика
         cursor.execute("""
             UPDATE bids
@@ -4503,6 +6392,7 @@ def select_bid(bid_id):
             return False
 
         conn.commit()
+        _chat_sessions.invalidate_order(order_id)
         logger.info(f"✅ Заказ {order_id}: выбран мастер {worker_id}, установлен selected_worker_id")
         return True
 
@@ -5018,16 +6908,33 @@ def save_chat_message_notification(user_id, message_id, chat_id):
             """, (user_id, message_id, chat_id, timestamp))
         conn.commit()
 
+    _chat_sessions.store_notification(user_id, {
+        'user_id': user_id,
+        'notification_message_id': message_id,
+        'notification_chat_id': chat_id,
+        'last_update_timestamp': timestamp,
+    })
+
 
 def get_chat_message_notification(user_id):
-    """Получает сохраненное уведомление о сообщениях в чате"""
+    """
+    Получает сохраненное уведомление о сообщениях в чате.
+    НОВОЕ: Результат кэшируется вместе с сессиями чата.
+    """
+    found, notification = _chat_sessions.lookup_notification(user_id)
+    if found:
+        return dict(notification) if notification else None
+
     with get_db_connection() as conn:
         cursor = get_cursor(conn)
         cursor.execute("""
             SELECT * FROM chat_message_notifications WHERE user_id = ?
         """, (user_id,))
         row = cursor.fetchone()
-        return dict(row) if row else None
+        notification = dict(row) if row else None
+
+    _chat_sessions.store_notification(user_id, notification)
+    return dict(notification) if notification else None
 
 
 def delete_chat_message_notification(user_id):
@@ -5036,6 +6943,7 @@ def delete_chat_message_notification(user_id):
         cursor = get_cursor(conn)
         cursor.execute("DELETE FROM chat_message_notifications WHERE user_id = ?", (user_id,))
         conn.commit()
+    _chat_sessions.store_notification(user_id, None)
 
 
 def get_orders_with_unread_bids(client_user_id):
@@ -5137,6 +7045,230 @@ def count_available_orders_for_worker(worker_user_id):
         return count
 
 
+# ============================================
+# НОВОЕ: СЧЁТЧИКИ ДОСТУПНЫХ ЗАКАЗОВ МАСТЕРОВ
+# ============================================
+# Вместо тяжёлого JOIN с NOT IN на каждое уведомление храним готовое число
+# в worker_order_counters и сдвигаем его пакетно при изменении заказов/откликов.
+# Дрейф (смена городов/категорий мастера, гонки) исправляет периодическая сверка.
+
+def migrate_add_worker_order_counters():
+    """
+    НОВОЕ: Создаёт таблицу worker_order_counters и заполняет её начальными значениями.
+    """
+    with get_db_connection() as conn:
+        cursor = get_cursor(conn)
+
+        try:
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS worker_order_counters (
+                    worker_id INTEGER PRIMARY KEY,
+                    available_orders INTEGER NOT NULL DEFAULT 0,
+                    updated_at TEXT,
+                    FOREIGN KEY (worker_id) REFERENCES workers(id) ON DELETE CASCADE
+                )
+            """)
+            conn.commit()
+            logger.info("✅ Таблица worker_order_counters создана")
+
+        except Exception as e:
+            logger.error(f"⚠️ Error in migrate_add_worker_order_counters: {e}")
+            conn.rollback()
+            return
+
+    reconcile_available_orders_counters()
+    logger.info("✅ Migration completed: worker_order_counters!")
+
+
+def _count_available_orders_by_worker(cursor, order_ids=None, worker_id=None):
+    """
+    Считает доступные заказы, сгруппированные по мастеру, одним запросом.
+
+    Заказ доступен мастеру, если он открыт, совпадает по категории и городу,
+    мастер на него не откликался и не скрывал его (declined_orders хранит users.id).
+
+    Args:
+        cursor: Курсор текущей транзакции
+        order_ids: Ограничить подсчёт этими заказами (None - все открытые)
+        worker_id: Ограничить подсчёт одним мастером (workers.id)
+
+    Returns:
+        dict: {worker_id: количество заказов}
+    """
+    conditions = ["o.status = 'open'"]
+    params = []
+
+    if order_ids is not None:
+        if not order_ids:
+            return {}
+        placeholders = ','.join('?' * len(order_ids))
+        conditions.append(f"o.id IN ({placeholders})")
+        params.extend(order_ids)
+
+    if worker_id is not None:
+        conditions.append("wc.worker_id = ?")
+        params.append(worker_id)
+
+    cursor.execute(f"""
+        SELECT wc.worker_id, COUNT(DISTINCT o.id) as orders_count
+        FROM orders o
+        JOIN order_categories oc ON oc.order_id = o.id
+        JOIN worker_categories wc ON wc.category = oc.category
+        JOIN worker_cities wci ON wci.worker_id = wc.worker_id AND wci.city = o.city
+        JOIN workers w ON w.id = wc.worker_id
+        WHERE {' AND '.join(conditions)}
+        AND NOT EXISTS (
+            SELECT 1 FROM bids b WHERE b.order_id = o.id AND b.worker_id = wc.worker_id
+        )
+        AND NOT EXISTS (
+            SELECT 1 FROM declined_orders d WHERE d.order_id = o.id AND d.worker_id = w.user_id
+        )
+        GROUP BY wc.worker_id
+    """, tuple(params))
+
+    counts = {}
+    for row in cursor.fetchall():
+        if isinstance(row, dict):
+            counts[row['worker_id']] = row['orders_count']
+        else:
+            counts[row[0]] = row[1]
+    return counts
+
+
+def _shift_available_orders_counters(cursor, order_ids, direction, worker_id=None):
+    """
+    Пакетно сдвигает счётчики всех затронутых мастеров в текущей транзакции.
+
+    Вызывать ДО изменения статуса заказа / вставки отклика или отказа:
+    подсчёт учитывает только те заказы, которые сейчас ещё видны мастеру.
+    Отсутствующие строки не создаются - их заполнит get_available_orders_count.
+
+    Args:
+        cursor: Курсор текущей транзакции
+        order_ids: Список ID заказов
+        direction: +1 (заказ стал доступен) или -1 (заказ больше недоступен)
+        worker_id: Ограничить сдвиг одним мастером (workers.id)
+    """
+    counts = _count_available_orders_by_worker(cursor, order_ids, worker_id)
+    if not counts:
+        return
+
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    cursor.executemany("""
+        UPDATE worker_order_counters
+        SET available_orders = CASE
+                WHEN available_orders + ? > 0 THEN available_orders + ?
+                ELSE 0
+            END,
+            updated_at = ?
+        WHERE worker_id = ?
+    """, [(direction * count, direction * count, now, w_id) for w_id, count in counts.items()])
+
+
+def adjust_available_orders_counters(order_ids, direction, worker_id=None):
+    """Сдвигает счётчики доступных заказов в отдельной транзакции."""
+    with get_db_connection() as conn:
+        cursor = get_cursor(conn)
+        _shift_available_orders_counters(cursor, order_ids, direction, worker_id)
+        conn.commit()
+
+
+def get_available_orders_count(worker_user_id):
+    """
+    НОВОЕ: Возвращает количество доступных заказов мастера одним поиском по ключу.
+    Если счётчик ещё не заполнен (новый мастер) - считает его и сохраняет.
+    """
+    with get_db_connection() as conn:
+        cursor = get_cursor(conn)
+
+        cursor.execute("""
+            SELECT w.id as worker_id, c.available_orders
+            FROM workers w
+            LEFT JOIN worker_order_counters c ON c.worker_id = w.id
+            WHERE w.user_id = ?
+        """, (worker_user_id,))
+        row = cursor.fetchone()
+        if not row:
+            return 0
+
+        if isinstance(row, dict):
+            worker_id, available_orders = row['worker_id'], row['available_orders']
+        else:
+            worker_id, available_orders = row[0], row[1]
+
+        if available_orders is not None:
+            return available_orders
+
+        available_orders = _count_available_orders_by_worker(cursor, worker_id=worker_id).get(worker_id, 0)
+        now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+        if USE_POSTGRES:
+            cursor.execute("""
+                INSERT INTO worker_order_counters (worker_id, available_orders, updated_at)
+                VALUES (%s, %s, %s)
+                ON CONFLICT (worker_id) DO UPDATE
+                SET available_orders = EXCLUDED.available_orders, updated_at = EXCLUDED.updated_at
+            """, (worker_id, available_orders, now))
+        else:
+            cursor.execute("""
+                INSERT OR REPLACE INTO worker_order_counters (worker_id, available_orders, updated_at)
+                VALUES (?, ?, ?)
+            """, (worker_id, available_orders, now))
+
+        conn.commit()
+        return available_orders
+
+
+def reconcile_available_orders_counters():
+    """
+    НОВОЕ: Сверяет счётчики доступных заказов с реальными данными.
+    Пересчитывает всех мастеров одним запросом и перезаписывает только расхождения.
+
+    Returns:
+        int: Количество исправленных счётчиков
+    """
+    with get_db_connection() as conn:
+        cursor = get_cursor(conn)
+
+        actual = _count_available_orders_by_worker(cursor)
+
+        cursor.execute("""
+            SELECT w.id as worker_id, c.available_orders
+            FROM workers w
+            LEFT JOIN worker_order_counters c ON c.worker_id = w.id
+        """)
+        drifted = []
+        for row in cursor.fetchall():
+            if isinstance(row, dict):
+                worker_id, stored = row['worker_id'], row['available_orders']
+            else:
+                worker_id, stored = row[0], row[1]
+            expected = actual.get(worker_id, 0)
+            if stored != expected:
+                drifted.append((worker_id, expected))
+
+        if not drifted:
+            return 0
+
+        now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        if USE_POSTGRES:
+            cursor.executemany("""
+                INSERT INTO worker_order_counters (worker_id, available_orders, updated_at)
+                VALUES (%s, %s, %s)
+                ON CONFLICT (worker_id) DO UPDATE
+                SET available_orders = EXCLUDED.available_orders, updated_at = EXCLUDED.updated_at
+            """, [(worker_id, expected, now) for worker_id, expected in drifted])
+        else:
+            cursor.executemany("""
+                INSERT OR REPLACE INTO worker_order_counters (worker_id, available_orders, updated_at)
+                VALUES (?, ?, ?)
+            """, [(worker_id, expected, now) for worker_id, expected in drifted])
+
+        conn.commit()
+        logger.info(f"🔄 Сверка счётчиков заказов: исправлено {len(drifted)}")
+        return len(drifted)
+
+
 # ============================================
 # СИСТЕМА АДМИН-ПАНЕЛИ И РЕКЛАМЫ
 # ============================================
@@ -5437,21 +7569,26 @@ def create_ad(title, description, photo_file_id, button_text, button_url,
 
         # Добавляем категории для таргетинга (если указаны)
         if categories:
-            for category in categories:
-                cursor.execute("""
-                    INSERT INTO ad_categories (ad_id, category)
-                    VALUES (?, ?)
-                """, (ad_id, category))
+            cursor.insert_ignore_rows(
+                "ad_categories", ("ad_id", "category"),
+                [(ad_id, category) for category in _split_categories(categories)],
+            )
 
         conn.commit()
         logger.info(f"✅ Реклама создана: ID={ad_id}, categories={categories}")
-        return ad_id
+
+    # НОВОЕ: Новое объявление сразу попадает в индекс показа
+    _ad_index.invalidate()
+    return ad_id
 
 
 def get_active_ad(placement, user_id=None, user_categories=None):
     """
     Получает активную рекламу для показа.
 
+    ИСПРАВЛЕНО: Раньше - запрос с EXISTS по ad_categories и коррелированным
+    COUNT(*) по ad_views на каждый вызов. Теперь - выбор из in-memory AdIndex.
+
     Args:
         placement: где показывать ('menu_banner', 'morning_digest')
         user_id: ID пользователя (для проверки лимита показов)
@@ -5460,74 +7597,77 @@ def get_active_ad(placement, user_id=None, user_categories=None):
     Returns:
         dict с данными рекламы или None
     """
+    return _ad_index.pick(placement, user_id, user_categories)
+
+
+def has_active_ads(placement):
+    """НОВОЕ: Есть ли объявления для размещения - чтобы не готовить таргетинг зря"""
+    return _ad_index.has_ads(placement)
+
+
+def _load_active_ads(now):
+    """Активные и не закончившиеся объявления: ({placement: [ad]}, {ad_id: frozenset(категорий)})"""
     with get_db_connection() as conn:
         cursor = get_cursor(conn)
-        now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        today_start = datetime.now().strftime("%Y-%m-%d 00:00:00")
+        cursor.execute("""
+            SELECT * FROM ads
+            WHERE active = TRUE
+            AND (end_date IS NULL OR end_date >= ?)
+            ORDER BY id DESC
+        """, (now.strftime("%Y-%m-%d %H:%M:%S"),))
+        ads_by_placement = defaultdict(list)
+        for row in cursor.fetchall():
+            ad = dict(row)
+            ads_by_placement[ad['placement']].append(ad)
+
+        categories = defaultdict(set)
+        cursor.execute("""
+            SELECT ac.ad_id, ac.category FROM ad_categories ac
+            JOIN ads a ON a.id = ac.ad_id
+            WHERE a.active = TRUE
+        """)
+        for row in cursor.fetchall():
+            row = dict(row)
+            categories[row['ad_id']].add(row['category'])
 
-        # Базовый запрос
-        query = """
-            SELECT a.*
-            FROM ads a
-            WHERE a.active = 1
-            AND a.placement = ?
-            AND (a.start_date IS NULL OR a.start_date <= ?)
-            AND (a.end_date IS NULL OR a.end_date >= ?)
-        """
-        params = [placement, now, now]
+    return dict(ads_by_placement), {ad_id: frozenset(cats) for ad_id, cats in categories.items()}
 
-        # Если есть категории пользователя - фильтруем по таргетингу
-        if user_categories:
-            query += """
-                AND (
-                    NOT EXISTS (SELECT 1 FROM ad_categories WHERE ad_id = a.id)
-                    OR EXISTS (
-                        SELECT 1 FROM ad_categories ac
-                        WHERE ac.ad_id = a.id
-                        AND ac.category IN ({})
-                    )
-                )
-            """.format(','.join('?' * len(user_categories)))
-            params.extend(user_categories)
 
-        # Проверяем лимит показов пользователю
-        if user_id:
-            query += """
-                AND (
-                    SELECT COUNT(*) FROM ad_views av
-                    WHERE av.ad_id = a.id
-                    AND av.user_id = ?
-                    AND av.viewed_at >= ?
-                ) < a.max_views_per_user_per_day
-            """
-            params.extend([user_id, today_start])
+def _load_ad_impressions(day):
+    """Показы за день из ad_views: {(ad_id, user_id): количество}"""
+    with get_db_connection() as conn:
+        cursor = get_cursor(conn)
+        cursor.execute("""
+            SELECT ad_id, user_id, COUNT(*) as views
+            FROM ad_views
+            WHERE viewed_at >= ? AND clicked = FALSE
+            GROUP BY ad_id, user_id
+        """, (day.strftime("%Y-%m-%d 00:00:00"),))
+        return {(row['ad_id'], row['user_id']): row['views'] for row in map(dict, cursor.fetchall())}
 
-        query += " ORDER BY a.id DESC LIMIT 1"
 
-        cursor.execute(query, params)
-        result = cursor.fetchone()
+def log_ad_view(ad_id, user_id, placement, clicked=False):
+    """
+    Записывает просмотр/клик по рекламе.
 
-        return dict(result) if result else None
+    ИСПРАВЛЕНО: Раньше - INSERT, UPDATE и commit на каждый показ. Теперь событие
+    попадает в буфер AdEventBuffer и пишется пачкой при flush_ad_events().
+    """
+    _ad_events.add(ad_id, user_id, placement, clicked)
 
+    # НОВОЕ: Дневной лимит показов считается в памяти
+    if not clicked:
+        _ad_index.record_impression(ad_id, user_id)
 
-def log_ad_view(ad_id, user_id, placement, clicked=False):
-    """Записывает просмотр/клик по рекламе"""
-    with get_db_connection() as conn:
-        cursor = get_cursor(conn)
-        now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
-        cursor.execute("""
-            INSERT INTO ad_views (ad_id, user_id, viewed_at, clicked, placement)
-            VALUES (?, ?, ?, ?, ?)
-        """, (ad_id, user_id, now, clicked, placement))
+def flush_ad_events(max_batches=None):
+    """НОВОЕ: Сбрасывает буфер показов/кликов рекламы в БД. Возвращает число событий."""
+    return _ad_events.flush(max_batches)
 
-        # Обновляем счетчики
-        if clicked:
-            cursor.execute("UPDATE ads SET click_count = click_count + 1 WHERE id = ?", (ad_id,))
-        else:
-            cursor.execute("UPDATE ads SET view_count = view_count + 1 WHERE id = ?", (ad_id,))
 
-        conn.commit()
+def get_pending_ad_events():
+    """НОВОЕ: Сколько событий рекламы ждут записи в БД"""
+    return _ad_events.pending
 
 
 def get_all_users():
@@ -5700,6 +7840,18 @@ def add_worker_city(worker_id, city):
         logger.info(f"✅ Город '{city}' добавлен мастеру worker_id={worker_id}")
 
 
+def add_worker_cities(worker_id, cities):
+    """НОВОЕ: Добавляет мастеру несколько городов одним запросом"""
+    cities = list(dict.fromkeys(city for city in cities if city))
+    if not cities:
+        return
+    with get_db_connection() as conn:
+        cursor = get_cursor(conn)
+        cursor.insert_ignore_rows("worker_cities", ("worker_id", "city"), [(worker_id, city) for city in cities])
+        conn.commit()
+        logger.info(f"✅ Города {cities} добавлены мастеру worker_id={worker_id}")
+
+
 def remove_worker_city(worker_id, city):
     """Удаляет город у мастера"""
     with get_db_connection() as conn:
@@ -6146,6 +8298,13 @@ def decline_order(worker_id, order_id):
         declined_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
         try:
+            # НОВОЕ: Скрытый заказ больше не считается доступным для мастера
+            cursor.execute("SELECT id FROM workers WHERE user_id = ?", (worker_id,))
+            worker = cursor.fetchone()
+            if worker:
+                worker_profile_id = worker['id'] if isinstance(worker, dict) else worker[0]
+                _shift_available_orders_counters(cursor, [order_id], -1, worker_id=worker_profile_id)
+
             if USE_POSTGRES:
                 cursor.execute("""
                     INSERT INTO declined_orders (worker_id, order_id, declined_at)
@@ -6228,3 +8387,638 @@ def get_declined_orders(worker_id):
 
         results = cursor.fetchall()
         return [row['order_id'] if isinstance(row, dict) else row[0] for row in results]
+
+
+# ============================================================
+# НОВОЕ: ПОИСК ПОЛЬЗОВАТЕЛЕЙ ДЛЯ АДМИН-ПАНЕЛИ
+# ============================================================
+# Имена живут в профилях (workers.name, clients.name), а не в users.
+# PostgreSQL: GIN-индексы pg_trgm по LOWER(name) - LIKE '%q%' идёт по индексу.
+# SQLite: теневая FTS5-таблица user_search_fts, её поддерживают триггеры
+# на workers/clients; rowid = workers.id * 2 или clients.id * 2 + 1.
+# Если индекс недоступен (нет pg_trgm/FTS5) - поиск работает через LIKE.
+
+# Самый длинный telegram_id, который ищется по префиксу
+MAX_TELEGRAM_ID_DIGITS = 16
+
+_USER_SEARCH_SELECT = """
+    SELECT u.*,
+           w.id as worker_id,
+           c.id as client_id,
+           COALESCE(w.name, c.name) as full_name
+    FROM users u
+    LEFT JOIN workers w ON u.id = w.user_id
+    LEFT JOIN clients c ON u.id = c.user_id
+"""
+
+# FTS5-таблицы SQLite, существование которых уже проверено
+_fts_tables_ready = set()
+
+
+def _fts_table_ready(cursor, table):
+    """Есть ли FTS5-таблица (SQLite). Положительный результат кэшируется."""
+    if table in _fts_tables_ready:
+        return True
+    cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = ?", (table,))
+    if cursor.fetchone() is None:
+        return False
+    _fts_tables_ready.add(table)
+    return True
+
+
+def _fts_prefix_query(text):
+    """
+    'Иван Пет' -> '("иван" OR "иван"*) AND ("пет" OR "пет"*)'.
+    Все слова, каждое по префиксу; совпадение целого слова повышает bm25.
+    """
+    tokens = re.findall(r"\w+", text.lower())
+    return " AND ".join(f'("{token}" OR "{token}"*)' for token in tokens)
+
+
+def _escape_like(text):
+    """Экранирует спецсимволы LIKE (для ESCAPE '!')"""
+    return text.replace("!", "!!").replace("%", "!%").replace("_", "!_")
+
+
+def migrate_add_user_search_index():
+    """
+    НОВОЕ: Индексы для поиска пользователей по имени.
+
+    PostgreSQL: расширение pg_trgm и GIN-индексы по LOWER(name) мастеров и заказчиков.
+    SQLite: FTS5-таблица user_search_fts, триггеры синхронизации и начальное заполнение.
+    """
+    with get_db_connection() as conn:
+        cursor = get_cursor(conn)
+
+        try:
+            if USE_POSTGRES:
+                cursor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+                cursor.execute("""
+                    CREATE INDEX IF NOT EXISTS idx_workers_name_trgm
+                    ON workers USING gin (LOWER(name) gin_trgm_ops)
+                """)
+                cursor.execute("""
+                    CREATE INDEX IF NOT EXISTS idx_clients_name_trgm
+                    ON clients USING gin (LOWER(name) gin_trgm_ops)
+                """)
+                conn.commit()
+                logger.info("✅ Migration completed: pg_trgm индексы поиска пользователей!")
+                return
+
+            if _fts_table_ready(cursor, "user_search_fts"):
+                logger.info("✅ Таблица user_search_fts уже существует")
+                return
+
+            cursor.execute("""
+                CREATE VIRTUAL TABLE user_search_fts USING fts5(
+                    name,
+                    user_id UNINDEXED,
+                    tokenize = 'unicode61 remove_diacritics 2'
+                )
+            """)
+            for table, rowid_offset in (("workers", 0), ("clients", 1)):
+                cursor.execute(f"""
+                    CREATE TRIGGER IF NOT EXISTS trg_{table}_search_insert AFTER INSERT ON {table}
+                    BEGIN
+                        INSERT INTO user_search_fts (rowid, name, user_id)
+                        VALUES (new.id * 2 + {rowid_offset}, new.name, new.user_id);
+                    END
+                """)
+                cursor.execute(f"""
+                    CREATE TRIGGER IF NOT EXISTS trg_{table}_search_update AFTER UPDATE OF name ON {table}
+                    BEGIN
+                        DELETE FROM user_search_fts WHERE rowid = old.id * 2 + {rowid_offset};
+                        INSERT INTO user_search_fts (rowid, name, user_id)
+                        VALUES (new.id * 2 + {rowid_offset}, new.name, new.user_id);
+                    END
+                """)
+                cursor.execute(f"""
+                    CREATE TRIGGER IF NOT EXISTS trg_{table}_search_delete AFTER DELETE ON {table}
+                    BEGIN
+                        DELETE FROM user_search_fts WHERE rowid = old.id * 2 + {rowid_offset};
+                    END
+                """)
+                cursor.execute(f"""
+                    INSERT INTO user_search_fts (rowid, name, user_id)
+                    SELECT id * 2 + {rowid_offset}, name, user_id FROM {table}
+                """)
+            conn.commit()
+            logger.info("✅ Migration completed: user_search_fts (FTS5)!")
+
+        except Exception as e:
+            # Без pg_trgm/FTS5 поиск продолжит работать через LIKE
+            logger.warning(f"⚠️ Индекс поиска пользователей недоступен, поиск будет через LIKE: {e}")
+            conn.rollback()
+
+
+def _search_users_by_telegram_id_prefix(digits, limit):
+    """
+    Пользователи, чей telegram_id начинается с digits.
+    Префикс числа - набор диапазонов [digits * 10^k, (digits + 1) * 10^k):
+    каждый идёт по уникальному индексу telegram_id, без CAST в текст.
+    """
+    if digits.startswith("0") or len(digits) > MAX_TELEGRAM_ID_DIGITS:
+        return []
+
+    prefix = int(digits)
+    conditions = []
+    params = []
+    for k in range(MAX_TELEGRAM_ID_DIGITS - len(digits) + 1):
+        conditions.append("u.telegram_id BETWEEN ? AND ?")
+        params.extend((prefix * 10 ** k, (prefix + 1) * 10 ** k - 1))
+
+    with get_db_connection() as conn:
+        cursor = get_cursor(conn)
+        # Точное совпадение и более короткие ID (ближе к запросу) - первыми
+        cursor.execute(f"""
+            {_USER_SEARCH_SELECT}
+            WHERE {" OR ".join(conditions)}
+            ORDER BY u.telegram_id
+            LIMIT ?
+        """, (*params, limit))
+        return cursor.fetchall()
+
+
+def _search_users_by_name(text, limit):
+    """Поиск по имени: FTS5 на SQLite (если есть), иначе LIKE (по pg_trgm на PostgreSQL)"""
+    with get_db_connection() as conn:
+        cursor = get_cursor(conn)
+
+        if not USE_POSTGRES and _fts_table_ready(cursor, "user_search_fts"):
+            match = _fts_prefix_query(text)
+            if not match:
+                return []
+            # bm25: меньше - лучше; у пользователя с двумя профилями берём лучший
+            cursor.execute(f"""
+                {_USER_SEARCH_SELECT}
+                JOIN (
+                    SELECT user_id, MIN(rank) AS score
+                    FROM (
+                        SELECT user_id, rank FROM user_search_fts
+                        WHERE user_search_fts MATCH ?
+                    )
+                    GROUP BY user_id
+                    ORDER BY score
+                    LIMIT ?
+                ) m ON m.user_id = u.id
+                ORDER BY m.score, u.created_at DESC
+            """, (match, limit))
+            return cursor.fetchall()
+
+        # LIKE '%q%' по LOWER(name) - на PostgreSQL его обслуживает GIN-индекс pg_trgm.
+        # Ранжирование: точное совпадение, затем начало имени, затем вхождение.
+        lowered = text.lower()
+        contains = f"%{_escape_like(lowered)}%"
+        starts_with = f"{_escape_like(lowered)}%"
+        cursor.execute(f"""
+            {_USER_SEARCH_SELECT}
+            WHERE u.id IN (
+                SELECT user_id FROM workers WHERE LOWER(name) LIKE ? ESCAPE '!'
+                UNION
+                SELECT user_id FROM clients WHERE LOWER(name) LIKE ? ESCAPE '!'
+            )
+            ORDER BY
+                CASE
+                    WHEN LOWER(COALESCE(w.name, c.name)) = ? THEN 0
+                    WHEN LOWER(COALESCE(w.name, c.name)) LIKE ? ESCAPE '!' THEN 1
+                    ELSE 2
+                END,
+                u.created_at DESC
+            LIMIT ?
+        """, (contains, contains, lowered, starts_with, limit))
+        return cursor.fetchall()
+
+
+# ============================================================
+# НОВОЕ: ПОИСК ОТКРЫТЫХ ЗАКАЗОВ ПО ТЕКСТУ
+# ============================================================
+# Мастер ищет по словам в описании заказа - в пределах своих категорий и городов,
+# без заказов, на которые уже откликнулся или которые скрыл. Один индексный запрос.
+# PostgreSQL: GIN-индекс по to_tsvector('russian', description) - стемминг Snowball.
+# SQLite: FTS5-таблица order_search_fts (external content поверх orders, синхронизация
+# триггерами). Русского стеммера в FTS5 нет, поэтому окончания слов запроса
+# отрезает _russian_stem, а поиск идёт по префиксу основы.
+
+ORDER_SEARCH_MIN_WORD_LENGTH = 3
+
+# Окончания, которые отрезаются от слов запроса (длинные первыми)
+_RUSSIAN_ENDINGS = (
+    "ями", "ами", "ыми", "ими", "ого", "его", "ому", "ему", "ать", "ять", "ить", "еть",
+    "ах", "ях", "ам", "ям", "ом", "ем", "ой", "ей", "ый", "ий", "ая", "яя", "ое", "ее",
+    "ые", "ие", "ую", "юю", "ов", "ев", "ть",
+    "а", "я", "о", "е", "ы", "и", "у", "ю", "ь", "й",
+)
+_RUSSIAN_MIN_STEM_LENGTH = 3
+
+
+def _russian_stem(word):
+    """Грубая основа слова: 'проводку' -> 'проводк', 'трубы' -> 'труб'"""
+    for ending in _RUSSIAN_ENDINGS:
+        if word.endswith(ending) and len(word) - len(ending) >= _RUSSIAN_MIN_STEM_LENGTH:
+            return word[:-len(ending)]
+    return word
+
+
+def _order_search_words(text):
+    """Слова запроса без коротких (предлоги, союзы)"""
+    words = re.findall(r"\w+", text.lower())
+    return [word for word in words if len(word) >= ORDER_SEARCH_MIN_WORD_LENGTH]
+
+
+def migrate_add_order_search_index():
+    """
+    НОВОЕ: Полнотекстовый индекс по описаниям заказов.
+
+    PostgreSQL: GIN-индекс по to_tsvector('russian', description).
+    SQLite: FTS5-таблица order_search_fts, триггеры синхронизации и rebuild.
+    """
+    with get_db_connection() as conn:
+        cursor = get_cursor(conn)
+
+        try:
+            if USE_POSTGRES:
+                cursor.execute("""
+                    CREATE INDEX IF NOT EXISTS idx_orders_description_fts
+                    ON orders USING gin (to_tsvector('russian', COALESCE(description, '')))
+                """)
+                conn.commit()
+                logger.info("✅ Migration completed: GIN-индекс поиска заказов!")
+                return
+
+            if _fts_table_ready(cursor, "order_search_fts"):
+                logger.info("✅ Таблица order_search_fts уже существует")
+                return
+
+            cursor.execute("""
+                CREATE VIRTUAL TABLE order_search_fts USING fts5(
+                    description,
+                    content = 'orders',
+                    content_rowid = 'id',
+                    tokenize = 'unicode61 remove_diacritics 2'
+                )
+            """)
+            cursor.execute("""
+                CREATE TRIGGER IF NOT EXISTS trg_orders_search_insert AFTER INSERT ON orders
+                BEGIN
+                    INSERT INTO order_search_fts (rowid, description) VALUES (new.id, new.description);
+                END
+            """)
+            cursor.execute("""
+                CREATE TRIGGER IF NOT EXISTS trg_orders_search_update AFTER UPDATE OF description ON orders
+                BEGIN
+                    INSERT INTO order_search_fts (order_search_fts, rowid, description)
+                    VALUES ('delete', old.id, old.description);
+                    INSERT INTO order_search_fts (rowid, description) VALUES (new.id, new.description);
+                END
+            """)
+            cursor.execute("""
+                CREATE TRIGGER IF NOT EXISTS trg_orders_search_delete AFTER DELETE ON orders
+                BEGIN
+                    INSERT INTO order_search_fts (order_search_fts, rowid, description)
+                    VALUES ('delete', old.id, old.description);
+                END
+            """)
+            cursor.execute("INSERT INTO order_search_fts (order_search_fts) VALUES ('rebuild')")
+            conn.commit()
+            logger.info("✅ Migration completed: order_search_fts (FTS5)!")
+
+        except Exception as e:
+            # Без индекса поиск продолжит работать через LIKE
+            logger.warning(f"⚠️ Индекс поиска заказов недоступен, поиск будет через LIKE: {e}")
+            conn.rollback()
+
+
+def search_open_orders(query, categories_list, worker_id, limit=10):
+    """
+    Ищет открытые заказы по словам из описания.
+
+    Учитывает те же фильтры, что и лента мастера (worker_view_orders):
+    категории, города мастера, уже оставленные отклики и скрытые заказы.
+
+    Args:
+        query: Текст запроса ("протекает кран")
+        categories_list: Категории мастера
+        worker_id: ID мастера (workers.id)
+        limit: Максимум заказов
+
+    Returns:
+        Список заказов, самые релевантные первыми
+    """
+    words = _order_search_words(query or "")
+    categories = [cat.strip() for cat in categories_list if cat and cat.strip()]
+    if not words or not categories:
+        return []
+
+    category_placeholders = ', '.join('?' for _ in categories)
+    # declined_orders хранит users.id мастера
+    filters_sql = f"""
+        AND o.status = 'open'
+        AND EXISTS (
+            SELECT 1 FROM order_categories oc
+            WHERE oc.order_id = o.id AND oc.category IN ({category_placeholders})
+        )
+        AND (
+            o.city IN (SELECT city FROM worker_cities WHERE worker_id = ?)
+            OR o.city = (SELECT city FROM workers WHERE id = ?)
+        )
+        AND NOT EXISTS (SELECT 1 FROM bids b WHERE b.order_id = o.id AND b.worker_id = ?)
+        AND NOT EXISTS (
+            SELECT 1 FROM declined_orders d
+            WHERE d.order_id = o.id AND d.worker_id = (SELECT user_id FROM workers WHERE id = ?)
+        )
+    """
+    filter_params = [*categories, worker_id, worker_id, worker_id, worker_id]
+
+    with get_db_connection() as conn:
+        cursor = get_cursor(conn)
+
+        if USE_POSTGRES:
+            # Слова объединяются через AND, стемминг делает словарь russian
+            cursor.execute(f"""
+                SELECT o.*,
+                       c.name as client_name,
+                       c.rating as client_rating,
+                       c.rating_count as client_rating_count
+                FROM orders o
+                JOIN clients c ON o.client_id = c.id,
+                     plainto_tsquery('russian', ?) AS q
+                WHERE to_tsvector('russian', COALESCE(o.description, '')) @@ q
+                {filters_sql}
+                ORDER BY ts_rank(to_tsvector('russian', COALESCE(o.description, '')), q) DESC,
+                         o.created_at DESC
+                LIMIT ?
+            """, (" ".join(words), *filter_params, limit))
+            return cursor.fetchall()
+
+        if _fts_table_ready(cursor, "order_search_fts"):
+            match = " AND ".join(f'"{_russian_stem(word)}"*' for word in words)
+            cursor.execute(f"""
+                SELECT o.*,
+                       c.name as client_name,
+                       c.rating as client_rating,
+                       c.rating_count as client_rating_count
+                FROM (
+                    SELECT rowid AS order_id, rank FROM order_search_fts
+                    WHERE order_search_fts MATCH ?
+                ) f
+                JOIN orders o ON o.id = f.order_id
+                JOIN clients c ON o.client_id = c.id
+                WHERE 1=1
+                {filters_sql}
+                ORDER BY f.rank, o.created_at DESC
+                LIMIT ?
+            """, (match, *filter_params, limit))
+            return cursor.fetchall()
+
+        # Без FTS5: каждое слово (основа) должно встречаться в описании
+        like_sql = " ".join("AND o.description LIKE ? ESCAPE '!'" for _ in words)
+        like_params = [f"%{_escape_like(_russian_stem(word))}%" for word in words]
+        cursor.execute(f"""
+            SELECT o.*,
+                   c.name as client_name,
+                   c.rating as client_rating,
+                   c.rating_count as client_rating_count
+            FROM orders o
+            JOIN clients c ON o.client_id = c.id
+            WHERE 1=1
+            {like_sql}
+            {filters_sql}
+            ORDER BY o.created_at DESC
+            LIMIT ?
+        """, (*like_params, *filter_params, limit))
+        return cursor.fetchall()
+
+
+# ============================================================
+# ПОРТФОЛИО МАСТЕРА: НОРМАЛИЗОВАННОЕ ХРАНЕНИЕ
+# ============================================================
+
+def _split_portfolio(portfolio_photos):
+    """Разбирает строку workers.portfolio_photos в список file_id"""
+    return [p.strip() for p in (portfolio_photos or "").split(",") if p.strip()]
+
+
+def migrate_add_worker_portfolio_photos():
+    """
+    НОВОЕ: Таблица worker_portfolio_photos - по строке на фото с позицией в портфолио.
+
+    Навигация по портфолио читает одну строку по (worker_id, position) вместо
+    разбора всей строки workers.portfolio_photos. Сама строка остаётся
+    денормализованной копией для карточек и списков (как workers.categories
+    рядом с worker_categories). Заполняется из строки для мастеров, у которых
+    в таблице ещё нет фото.
+    """
+    with get_db_connection() as conn:
+        cursor = get_cursor(conn)
+
+        try:
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS worker_portfolio_photos (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    worker_id INTEGER NOT NULL,
+                    position INTEGER NOT NULL,
+                    photo_id TEXT NOT NULL,
+                    FOREIGN KEY (worker_id) REFERENCES workers(id) ON DELETE CASCADE
+                )
+            """)
+            # Позиции сдвигаются при удалении фото, поэтому индекс не уникальный
+            cursor.execute("""
+                CREATE INDEX IF NOT EXISTS idx_worker_portfolio_photos_position
+                ON worker_portfolio_photos(worker_id, position)
+            """)
+
+            cursor.execute("""
+                SELECT w.id, w.portfolio_photos FROM workers w
+                WHERE w.portfolio_photos IS NOT NULL AND w.portfolio_photos != ''
+                AND NOT EXISTS (SELECT 1 FROM worker_portfolio_photos p WHERE p.worker_id = w.id)
+            """)
+            rows = []
+            for worker in cursor.fetchall():
+                worker = dict(worker)
+                photo_ids = _split_portfolio(worker['portfolio_photos'])
+                rows.extend((worker['id'], position, photo_id) for position, photo_id in enumerate(photo_ids))
+
+            cursor.insert_ignore_rows("worker_portfolio_photos", ("worker_id", "position", "photo_id"), rows)
+
+            conn.commit()
+            logger.info(f"✅ Migration completed: worker_portfolio_photos! Перенесено фото: {len(rows)}")
+
+        except Exception as e:
+            logger.error(f"⚠️ Error in migrate_add_worker_portfolio_photos: {e}")
+            conn.rollback()
+
+
+def _replace_portfolio_photos(cursor, worker_id, photo_ids):
+    """
+    Перезаписывает фото портфолио мастера в текущей транзакции.
+    Позиции - порядок photo_ids, начиная с 0.
+    """
+    cursor.execute("DELETE FROM worker_portfolio_photos WHERE worker_id = ?", (worker_id,))
+    cursor.insert_ignore_rows(
+        "worker_portfolio_photos", ("worker_id", "position", "photo_id"),
+        [(worker_id, position, photo_id) for position, photo_id in enumerate(photo_ids)],
+    )
+
+
+def _append_portfolio_photo(cursor, worker_id, photo_id):
+    """Добавляет фото в конец портфолио мастера в текущей транзакции"""
+    cursor.execute("""
+        INSERT INTO worker_portfolio_photos (worker_id, position, photo_id)
+        SELECT ?, COALESCE(MAX(position) + 1, 0), ?
+        FROM worker_portfolio_photos
+        WHERE worker_id = ?
+    """, (worker_id, photo_id, worker_id))
+
+
+def get_portfolio_photo(worker_id, index):
+    """
+    НОВОЕ: Одно фото портфолио по порядковому номеру.
+
+    Args:
+        worker_id: ID мастера (workers.id)
+        index: Позиция фото, начиная с 0
+
+    Returns:
+        Row с полями photo_id и total (всего фото в портфолио) или None
+    """
+    with get_db_connection() as conn:
+        cursor = get_cursor(conn)
+        cursor.execute("""
+            SELECT p.photo_id,
+                   (SELECT COUNT(*) FROM worker_portfolio_photos WHERE worker_id = ?) as total
+            FROM worker_portfolio_photos p
+            WHERE p.worker_id = ? AND p.position = ?
+        """, (worker_id, worker_id, index))
+        return cursor.fetchone()
+
+
+def count_portfolio_photos(worker_id):
+    """НОВОЕ: Количество фото в портфолио мастера (workers.id)"""
+    with get_db_connection() as conn:
+        cursor = get_cursor(conn)
+        cursor.execute("""
+            SELECT COUNT(*) as total FROM worker_portfolio_photos WHERE worker_id = ?
+        """, (worker_id,))
+        return dict(cursor.fetchone())['total']
+
+
+def delete_portfolio_photo(worker_id, index):
+    """
+    НОВОЕ: Удаляет фото портфолио по позиции и сдвигает следующие.
+
+    Строка workers.portfolio_photos пересобирается в той же транзакции.
+
+    Returns:
+        int: Сколько фото осталось, или None если фото на этой позиции нет
+    """
+    with get_db_connection() as conn:
+        cursor = get_cursor(conn)
+        cursor.execute("""
+            DELETE FROM worker_portfolio_photos WHERE worker_id = ? AND position = ?
+        """, (worker_id, index))
+        if cursor.rowcount == 0:
+            conn.rollback()
+            return None
+
+        cursor.execute("""
+            UPDATE worker_portfolio_photos SET position = position - 1
+            WHERE worker_id = ? AND position > ?
+        """, (worker_id, index))
+
+        cursor.execute("""
+            SELECT photo_id FROM worker_portfolio_photos
+            WHERE worker_id = ?
+            ORDER BY position
+        """, (worker_id,))
+        photo_ids = [dict(row)['photo_id'] for row in cursor.fetchall()]
+
+        cursor.execute("""
+            UPDATE workers SET portfolio_photos = ?, profile_version = profile_version + 1 WHERE id = ?
+        """, (",".join(photo_ids), worker_id))
+
+        conn.commit()
+
+    return len(photo_ids)
+
+
+def migrate_add_worker_profile_version():
+    """
+    НОВОЕ: Счётчик версии профиля мастера workers.profile_version.
+
+    Увеличивается при каждом изменении, которое видно в карточке мастера
+    (поля профиля, рейтинг, фото). По (worker_id, profile_version) handlers
+    кэшируют отрисованные карточки без явной инвалидации.
+    """
+    with get_db_connection() as conn:
+        cursor = get_cursor(conn)
+
+        try:
+            if USE_POSTGRES:
+                cursor.execute("""
+                    SELECT 1 FROM information_schema.columns
+                    WHERE table_name = 'workers' AND column_name = 'profile_version'
+                """)
+                exists = cursor.fetchone() is not None
+            else:
+                cursor.execute("PRAGMA table_info(workers)")
+                exists = 'profile_version' in [column[1] for column in cursor.fetchall()]
+
+            if not exists:
+                cursor.execute("ALTER TABLE workers ADD COLUMN profile_version INTEGER DEFAULT 0")
+
+            conn.commit()
+            logger.info("✅ Migration completed: workers.profile_version!")
+
+        except Exception as e:
+            logger.error(f"⚠️ Error in migrate_add_worker_profile_version: {e}")
+            conn.rollback()
+
+
+def migrate_add_worker_ranking_score():
+    """
+    НОВОЕ: Счёт ранжирования мастеров workers.ranking_score.
+
+    Добавляет ranking_score, completed_orders и last_active_day, заполняет их
+    по текущим данным и создаёт индекс для top-K выборки get_top_workers().
+    """
+    with get_db_connection() as conn:
+        cursor = get_cursor(conn)
+
+        try:
+            if USE_POSTGRES:
+                cursor.execute("""
+                    SELECT 1 FROM information_schema.columns
+                    WHERE table_name = 'workers' AND column_name = 'ranking_score'
+                """)
+                exists = cursor.fetchone() is not None
+            else:
+                cursor.execute("PRAGMA table_info(workers)")
+                exists = 'ranking_score' in [column[1] for column in cursor.fetchall()]
+
+            if not exists:
+                cursor.execute("ALTER TABLE workers ADD COLUMN ranking_score REAL DEFAULT 0")
+                cursor.execute("ALTER TABLE workers ADD COLUMN completed_orders INTEGER DEFAULT 0")
+                cursor.execute("ALTER TABLE workers ADD COLUMN last_active_day INTEGER")
+
+            cursor.execute("""
+                CREATE INDEX IF NOT EXISTS idx_workers_ranking
+                ON workers(ranking_score DESC, id DESC)
+            """)
+
+            # ИСПРАВЛЕНО: Разовое заполнение мастеров без отметки активности - после
+            # первого запуска запрос не находит строк и ничего не пишет. Счёт (в том
+            # числе посчитанный со старой неограниченной свежестью) пересчитывает
+            # decay_ranking_scores_job при старте бота, а не каждая миграция
+            backfilled = _backfill_activity_from_registration(cursor) if exists else 0
+            conn.commit()
+
+        except Exception as e:
+            logger.error(f"⚠️ Error in migrate_add_worker_ranking_score: {e}")
+            conn.rollback()
+            return
+
+    if not exists:
+        rebuild_ranking_scores()
+    elif backfilled:
+        logger.info(f"📝 Отметка активности по дате регистрации: мастеров {backfilled}")
+    logger.info("✅ Migration completed: workers.ranking_score!")
@@ -1,6 +1,9 @@
 import logging
 import re
+import html
 import asyncio
+import heapq
+from collections import OrderedDict
 from datetime import datetime, timedelta
 from telegram import (
     Update,
@@ -10,6 +13,7 @@ from telegram import (
     InputMediaPhoto,
 )
 from telegram.ext import (
+    CallbackContext,
     ContextTypes,
     ConversationHandler,
     MessageHandler,
@@ -18,10 +22,30 @@ from telegram.ext import (
 )
 
 import db
+import metrics
 
 logger = logging.getLogger(__name__)
 
 
+class BotContext(CallbackContext):
+    """
+    НОВОЕ: Контекст апдейта с загрузчиком чтений БД.
+
+    PTB создаёт один контекст на апдейт для всех групп обработчиков, поэтому
+    context.loader живёт ровно одно обновление: повторные одинаковые чтения
+    (db.RequestLoader) не идут в БД. Обработчик подключается заменой
+    db.get_xxx(...) на context.loader.get_xxx(...) без изменения логики.
+    """
+
+    @property
+    def loader(self):
+        loader = self.__dict__.get('_request_loader')
+        if loader is None:
+            loader = db.RequestLoader()
+            self.__dict__['_request_loader'] = loader
+        return loader
+
+
 # ===== BELARUS REGIONS AND CITIES =====
 #
 # ЛОГИКА "ДРУГОЙ ГОРОД":
@@ -1891,6 +1915,31 @@ async def register_client_city_other(update: Update, context: ContextTypes.DEFAU
 
 # ------- МЕНЮ -------
 
+MENU_BANNER_PLACEMENT = "menu_banner"
+
+
+def build_menu_banner(user, categories=None):
+    """
+    НОВОЕ: Рекламный баннер для меню из in-memory индекса рекламы.
+
+    Returns:
+        (текст для конца сообщения, ряд кнопок или None); ("", None) если показывать нечего
+    """
+    if not user:
+        return "", None
+    ad = db.get_active_ad(MENU_BANNER_PLACEMENT, user_id=user['id'], user_categories=categories)
+    if not ad:
+        return "", None
+
+    db.log_ad_view(ad['id'], user['id'], MENU_BANNER_PLACEMENT)
+
+    text = f"\n\n━━━━━━━━━━━━━━━\n📢 <b>{html.escape(ad['title'])}</b>\n{html.escape(ad['description'])}"
+    button_row = None
+    if ad.get('button_text') and ad.get('button_url'):
+        button_row = [InlineKeyboardButton(ad['button_text'], url=ad['button_url'])]
+    return text, button_row
+
+
 async def show_worker_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
@@ -1898,10 +1947,12 @@ async def show_worker_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # ИСПРАВЛЕНИЕ БАГА: Очищаем активный чат при возврате в меню
     # Это предотвращает открытие неправильного чата при нажатии "Обновить чат"
     db.clear_active_chat(update.effective_user.id)
+    # НОВОЕ: Выход из поиска заказов через меню - сбрасываем флаг поиска
+    context.user_data.pop('order_search_active', None)
 
     # Получаем текущий статус уведомлений
-    user = db.get_user_by_telegram_id(update.effective_user.id)
-    notifications_enabled = db.are_notifications_enabled(user['id']) if user else True
+    user = context.loader.get_user_by_telegram_id(update.effective_user.id)
+    notifications_enabled = context.loader.are_notifications_enabled(user['id']) if user else True
     notification_status = "🔔 Вкл" if notifications_enabled else "🔕 Выкл"
 
     # НОВОЕ: Получаем количество непрочитанных заказов
@@ -1909,7 +1960,8 @@ async def show_worker_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if user:
         notification = db.get_worker_notification(user['id'])
         if notification:
-            unread_orders_count = notification.get('available_orders_count', 0)
+            # ИСПРАВЛЕНО: sqlite3.Row не поддерживает .get()
+            unread_orders_count = dict(notification).get('available_orders_count', 0)
 
     # Формируем текст кнопки с бейджем
     orders_button_text = "📋 Доступные заказы"
@@ -1918,6 +1970,7 @@ async def show_worker_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     keyboard = [
         [InlineKeyboardButton(orders_button_text, callback_data="worker_view_orders")],
+        [InlineKeyboardButton("🔎 Поиск заказов", callback_data="worker_search_orders")],
         [InlineKeyboardButton("💼 Мои отклики", callback_data="worker_my_bids")],
         [InlineKeyboardButton("📦 Мои заказы", callback_data="worker_my_orders")],
         [InlineKeyboardButton("👤 Мой профиль", callback_data="worker_profile")],
@@ -1927,9 +1980,18 @@ async def show_worker_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     ]
 
     # Добавляем кнопку админки только для админов
-    if db.is_admin(update.effective_user.id):
+    if context.loader.is_admin(update.effective_user.id):
         keyboard.insert(0, [InlineKeyboardButton("🔧 Админ-панель", callback_data="admin_panel")])
 
+    # НОВОЕ: Рекламный баннер (категории мастера - для таргетинга, только если реклама есть)
+    banner_text, banner_button = "", None
+    if user and db.has_active_ads(MENU_BANNER_PLACEMENT):
+        worker_profile = context.loader.get_worker_profile(user['id'])
+        categories = (dict(worker_profile).get('categories') or "").split(", ") if worker_profile else None
+        banner_text, banner_button = build_menu_banner(user, categories)
+    if banner_button:
+        keyboard.insert(-1, banner_button)
+
     # Удаляем старое сообщение и отправляем новое
     # (работает с любым типом сообщения: текст, фото, медиа)
     try:
@@ -1940,7 +2002,7 @@ async def show_worker_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await context.bot.send_message(
         chat_id=query.message.chat_id,
         text="🧰 <b>Меню мастера</b>\n\n"
-             "Выберите действие:",
+             "Выберите действие:" + banner_text,
         parse_mode="HTML",
         reply_markup=InlineKeyboardMarkup(keyboard),
     )
@@ -2071,9 +2133,12 @@ async def worker_my_bids(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     keyboard = []
 
+    # Заказы всех показываемых откликов одним запросом
+    orders_by_id = db.get_orders_by_ids([bid['order_id'] for bid in active_bids[:10]])
+
     for i, bid in enumerate(active_bids[:10], 1):  # Показываем до 10 активных
         order_id = bid['order_id']
-        order = db.get_order_by_id(order_id)
+        order = orders_by_id.get(order_id)
 
         if order:
             order_dict = dict(order)
@@ -2146,10 +2211,13 @@ async def worker_my_orders(update: Update, context: ContextTypes.DEFAULT_TYPE):
         active_count = 0
         completed_count = 0
 
+        # Заказы выбранных откликов одним запросом
+        orders_by_id = db.get_orders_by_ids([bid['order_id'] for bid in bids if bid['status'] == 'selected'])
+
         for bid in bids:
             bid_dict = dict(bid)
             if bid_dict['status'] == 'selected':
-                order = db.get_order_by_id(bid_dict['order_id'])
+                order = orders_by_id.get(bid_dict['order_id'])
                 if order:
                     order_dict = dict(order)
                     if order_dict['status'] in ('master_selected', 'contact_shared', 'master_confirmed', 'waiting_master_confirmation'):
@@ -2224,10 +2292,13 @@ async def worker_active_orders(update: Update, context: ContextTypes.DEFAULT_TYP
         bids = db.get_bids_for_worker(worker_dict['id'])
         active_orders = []
 
+        # Заказы выбранных откликов одним запросом
+        orders_by_id = db.get_orders_by_ids([bid['order_id'] for bid in bids if bid['status'] == 'selected'])
+
         for bid in bids:
             bid_dict = dict(bid)
             if bid_dict['status'] == 'selected':
-                order = db.get_order_by_id(bid_dict['order_id'])
+                order = orders_by_id.get(bid_dict['order_id'])
                 if order:
                     order_dict = dict(order)
                     if order_dict['status'] in ('master_selected', 'contact_shared', 'master_confirmed', 'waiting_master_confirmation'):
@@ -2251,7 +2322,11 @@ async def worker_active_orders(update: Update, context: ContextTypes.DEFAULT_TYP
         text = f"🔧 <b>Заказы в работе</b> ({len(active_orders)})\n\n"
         keyboard = []
 
-        for i, order in enumerate(active_orders[:10], 1):
+        # ИСПРАВЛЕНО: Чаты всех показанных заказов - одним запросом
+        shown_orders = active_orders[:10]
+        chats = await context.loader.load_many('order_chats', [order['order_id'] for order in shown_orders])
+
+        for i, (order, chat) in enumerate(zip(shown_orders, chats), 1):
             text += f"{i}. <b>Заказ #{order['order_id']}</b>\n"
             text += f"🔧 {order.get('order_category', 'Без категории')}\n"
 
@@ -2262,7 +2337,6 @@ async def worker_active_orders(update: Update, context: ContextTypes.DEFAULT_TYP
             text += f"💰 {order['proposed_price']} {order['currency']}\n"
 
             # Кнопка чата
-            chat = db.get_chat_by_order(order['order_id'])
             if chat:
                 chat_dict = dict(chat)
                 keyboard.append([InlineKeyboardButton(
@@ -2310,10 +2384,13 @@ async def worker_completed_orders(update: Update, context: ContextTypes.DEFAULT_
         bids = db.get_bids_for_worker(worker_dict['id'])
         completed_orders = []
 
+        # Заказы выбранных откликов одним запросом
+        orders_by_id = db.get_orders_by_ids([bid['order_id'] for bid in bids if bid['status'] == 'selected'])
+
         for bid in bids:
             bid_dict = dict(bid)
             if bid_dict['status'] == 'selected':
-                order = db.get_order_by_id(bid_dict['order_id'])
+                order = orders_by_id.get(bid_dict['order_id'])
                 if order:
                     order_dict = dict(order)
                     if order_dict['status'] in ('done', 'completed', 'canceled', 'cancelled'):
@@ -2337,7 +2414,11 @@ async def worker_completed_orders(update: Update, context: ContextTypes.DEFAULT_
         text = f"✅ <b>Завершённые заказы</b> ({len(completed_orders)})\n\n"
         keyboard = []
 
-        for i, order in enumerate(completed_orders[:10], 1):
+        # ИСПРАВЛЕНО: Чаты всех показанных заказов - одним запросом
+        shown_orders = completed_orders[:10]
+        chats = await context.loader.load_many('order_chats', [order['order_id'] for order in shown_orders])
+
+        for i, (order, chat) in enumerate(zip(shown_orders, chats), 1):
             status_emoji = {"done": "✅", "completed": "✅", "canceled": "❌"}
             emoji = status_emoji.get(order.get('order_status', 'done'), "✅")
 
@@ -2351,7 +2432,6 @@ async def worker_completed_orders(update: Update, context: ContextTypes.DEFAULT_
             text += f"💰 {order['proposed_price']} {order['currency']}\n"
 
             # Кнопка чата для просмотра истории
-            chat = db.get_chat_by_order(order['order_id'])
             if chat:
                 chat_dict = dict(chat)
                 keyboard.append([InlineKeyboardButton(
@@ -2398,8 +2478,8 @@ async def show_client_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     db.clear_active_chat(update.effective_user.id)
 
     # Получаем текущий статус уведомлений для клиента
-    user = db.get_user_by_telegram_id(update.effective_user.id)
-    notifications_enabled = db.are_client_notifications_enabled(user['id']) if user else True
+    user = context.loader.get_user_by_telegram_id(update.effective_user.id)
+    notifications_enabled = context.loader.are_client_notifications_enabled(user['id']) if user else True
     notification_status = "🔔 Вкл" if notifications_enabled else "🔕 Выкл"
 
     # НОВОЕ: Получаем количество непрочитанных откликов
@@ -2407,7 +2487,8 @@ async def show_client_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if user:
         notification = db.get_client_notification(user['id'])
         if notification:
-            unread_bids_count = notification.get('unread_bids_count', 0)
+            # ИСПРАВЛЕНО: sqlite3.Row не поддерживает .get()
+            unread_bids_count = dict(notification).get('unread_bids_count', 0)
 
     # Формируем текст кнопки с бейджем
     orders_button_text = "📂 Мои заказы"
@@ -2424,9 +2505,14 @@ async def show_client_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     ]
 
     # Добавляем кнопку админки только для админов
-    if db.is_admin(update.effective_user.id):
+    if context.loader.is_admin(update.effective_user.id):
         keyboard.insert(0, [InlineKeyboardButton("🔧 Админ-панель", callback_data="admin_panel")])
 
+    # НОВОЕ: Рекламный баннер
+    banner_text, banner_button = build_menu_banner(user)
+    if banner_button:
+        keyboard.insert(-1, banner_button)
+
     # Удаляем старое сообщение и отправляем новое
     # (работает с любым типом сообщения: текст, фото, медиа)
     try:
@@ -2438,7 +2524,7 @@ async def show_client_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
         chat_id=query.message.chat_id,
         text="🏠 <b>Меню заказчика</b>\n\n"
              "Создайте заказ - мастера увидят его и откликнутся!\n"
-             "Или найдите мастера самостоятельно.",
+             "Или найдите мастера самостоятельно." + banner_text,
         parse_mode="HTML",
         reply_markup=InlineKeyboardMarkup(keyboard),
     )
@@ -2593,6 +2679,9 @@ async def show_worker_profile(update: Update, context: ContextTypes.DEFAULT_TYPE
         if rating and rating > 0:
             rating_text = f"⭐ {rating:.1f}/5.0"
             reviews_text = f"📊 Отзывов: {rating_count} (проверенных: {verified_reviews})"
+            histogram_text = format_rating_histogram(profile_dict)
+            if histogram_text:
+                reviews_text += f"\n{histogram_text}"
         else:
             rating_text = "⭐ Нет отзывов"
             reviews_text = "📊 Отзывов пока нет"
@@ -3060,6 +3149,24 @@ async def worker_add_photos_finish(query, context: ContextTypes.DEFAULT_TYPE):
 
 # ------- ГАЛЕРЕЯ РАБОТ МАСТЕРА -------
 
+def load_portfolio_photo(worker_id, index):
+    """
+    НОВОЕ: Фото портфолио по номеру - одна строка из worker_portfolio_photos.
+    Если портфолио изменилось и такого номера уже нет - первое фото.
+
+    Returns:
+        tuple: (photo_id, index, total) или None если фото нет
+    """
+    photo = db.get_portfolio_photo(worker_id, index)
+    if not photo and index:
+        index = 0
+        photo = db.get_portfolio_photo(worker_id, index)
+    if not photo:
+        return None
+    photo = dict(photo)
+    return photo['photo_id'], index, photo['total']
+
+
 async def view_portfolio(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Просмотр галереи работ мастера с навигацией"""
     query = update.callback_query
@@ -3081,9 +3188,12 @@ async def view_portfolio(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     profile_dict = dict(worker_profile)
-    portfolio_photos = profile_dict.get("portfolio_photos") or ""
+    worker_id = profile_dict.get("id")
 
-    if not portfolio_photos:
+    # ИСПРАВЛЕНО: Читаем одно фото из worker_portfolio_photos вместо разбора всей строки
+    first_photo = load_portfolio_photo(worker_id, 0)
+
+    if not first_photo:
         await query.edit_message_text(
             "📸 У вас пока нет фото работ.\n\nДобавьте их через редактирование профиля.",
             reply_markup=InlineKeyboardMarkup([[
@@ -3092,10 +3202,9 @@ async def view_portfolio(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
 
-    photo_ids = [p.strip() for p in portfolio_photos.split(",") if p.strip()]
+    first_photo_id, _, photos_total = first_photo
 
     # НОВОЕ: Проверяем какие фото подтверждены клиентами (из completed_work_photos)
-    worker_id = profile_dict.get("id")
     verified_photos_info = {}  # photo_id -> True если подтверждено
 
     if worker_id:
@@ -3107,8 +3216,9 @@ async def view_portfolio(update: Update, context: ContextTypes.DEFAULT_TYPE):
             if photo_file_id:
                 verified_photos_info[photo_file_id] = True
 
-    # Сохраняем в context для навигации
-    context.user_data['portfolio_photos'] = photo_ids
+    # Сохраняем в context для навигации (только мастера и позицию, не список фото)
+    context.user_data['portfolio_worker_id'] = worker_id
+    context.user_data['portfolio_total'] = photos_total
     context.user_data['verified_photos'] = verified_photos_info
     context.user_data['current_portfolio_index'] = 0
 
@@ -3116,10 +3226,10 @@ async def view_portfolio(update: Update, context: ContextTypes.DEFAULT_TYPE):
     keyboard = []
 
     # Навигация если фото больше одного
-    if len(photo_ids) > 1:
+    if photos_total > 1:
         nav_buttons = [
             InlineKeyboardButton("◀️", callback_data="portfolio_prev"),
-            InlineKeyboardButton(f"1/{len(photo_ids)}", callback_data="noop"),
+            InlineKeyboardButton(f"1/{photos_total}", callback_data="noop"),
             InlineKeyboardButton("▶️", callback_data="portfolio_next")
         ]
         keyboard.append(nav_buttons)
@@ -3127,15 +3237,14 @@ async def view_portfolio(update: Update, context: ContextTypes.DEFAULT_TYPE):
     keyboard.append([InlineKeyboardButton("⬅️ К профилю", callback_data="worker_profile")])
 
     # НОВОЕ: Добавляем галочку если фото подтверждено клиентом
-    first_photo_id = photo_ids[0]
     is_verified = verified_photos_info.get(first_photo_id, False)
     verified_mark = " ✅ <i>Подтверждено клиентом</i>" if is_verified else ""
 
     try:
         await query.message.delete()
         await query.message.reply_photo(
-            photo=photo_ids[0],
-            caption=f"📸 <b>Фото работ</b>\n\n1 из {len(photo_ids)}{verified_mark}",
+            photo=first_photo_id,
+            caption=f"📸 <b>Фото работ</b>\n\n1 из {photos_total}{verified_mark}",
             parse_mode="HTML",
             reply_markup=InlineKeyboardMarkup(keyboard)
         )
@@ -3149,32 +3258,39 @@ async def portfolio_navigate(update: Update, context: ContextTypes.DEFAULT_TYPE)
     query = update.callback_query
     await query.answer()
 
-    photo_ids = context.user_data.get('portfolio_photos', [])
+    worker_id = context.user_data.get('portfolio_worker_id')
+    photos_total = context.user_data.get('portfolio_total', 0)
     current_index = context.user_data.get('current_portfolio_index', 0)
     verified_photos = context.user_data.get('verified_photos', {})  # НОВОЕ
 
-    if not photo_ids:
+    if not worker_id or not photos_total:
         return
 
     # Определяем направление
     if "prev" in query.data:
-        current_index = (current_index - 1) % len(photo_ids)
+        current_index = (current_index - 1) % photos_total
     elif "next" in query.data:
-        current_index = (current_index + 1) % len(photo_ids)
+        current_index = (current_index + 1) % photos_total
+
+    # ИСПРАВЛЕНО: Одна строка из worker_portfolio_photos вместо списка в context
+    photo = load_portfolio_photo(worker_id, current_index)
+    if not photo:
+        return
+    current_photo_id, current_index, photos_total = photo
 
     context.user_data['current_portfolio_index'] = current_index
+    context.user_data['portfolio_total'] = photos_total
 
     # НОВОЕ: Проверяем подтверждено ли текущее фото
-    current_photo_id = photo_ids[current_index]
     is_verified = verified_photos.get(current_photo_id, False)
     verified_mark = "\n✅ <i>Подтверждено клиентом</i>" if is_verified else ""
 
     # Формируем keyboard
     keyboard = []
-    if len(photo_ids) > 1:
+    if photos_total > 1:
         nav_buttons = [
             InlineKeyboardButton("◀️", callback_data="portfolio_prev"),
-            InlineKeyboardButton(f"{current_index + 1}/{len(photo_ids)}", callback_data="noop"),
+            InlineKeyboardButton(f"{current_index + 1}/{photos_total}", callback_data="noop"),
             InlineKeyboardButton("▶️", callback_data="portfolio_next")
         ]
         keyboard.append(nav_buttons)
@@ -3192,8 +3308,8 @@ async def portfolio_navigate(update: Update, context: ContextTypes.DEFAULT_TYPE)
             await query.message.delete()
             await context.bot.send_photo(
                 chat_id=query.from_user.id,
-                photo=photo_ids[current_index],
-                caption=f"📸 <b>Фото работ</b>\n\n{current_index + 1} из {len(photo_ids)}{verified_mark}",
+                photo=current_photo_id,
+                caption=f"📸 <b>Фото работ</b>\n\n{current_index + 1} из {photos_total}{verified_mark}",
                 parse_mode="HTML",
                 reply_markup=InlineKeyboardMarkup(keyboard)
             )
@@ -3371,9 +3487,9 @@ async def manage_portfolio_photos(update: Update, context: ContextTypes.DEFAULT_
         return
 
     profile_dict = dict(worker_profile)
-    portfolio_photos = profile_dict.get("portfolio_photos", "")
+    worker_id = profile_dict.get("id")
 
-    if not portfolio_photos:
+    if not db.count_portfolio_photos(worker_id):
         await query.edit_message_text(
             "📸 <b>Управление фото работ</b>\n\n"
             "У вас пока нет фото работ в портфолио.\n\n"
@@ -3385,22 +3501,8 @@ async def manage_portfolio_photos(update: Update, context: ContextTypes.DEFAULT_
         )
         return
 
-    # Парсим фото и видео
-    photos_list = [p.strip() for p in portfolio_photos.split(',') if p.strip()]
-
-    if not photos_list:
-        await query.edit_message_text(
-            "📸 <b>Управление фото работ</b>\n\n"
-            "У вас пока нет фото работ в портфолио.",
-            parse_mode="HTML",
-            reply_markup=InlineKeyboardMarkup([[
-                InlineKeyboardButton("⬅️ Назад к редактированию", callback_data="edit_profile_menu")
-            ]])
-        )
-        return
-
-    # Сохраняем список фото в контекст и начинаем с первого
-    context.user_data['portfolio_photos'] = photos_list
+    # ИСПРАВЛЕНО: В контексте только мастер, фото читаются по одному из worker_portfolio_photos
+    context.user_data['portfolio_worker_id'] = worker_id
     context.user_data['current_photo_index'] = 0
 
     # Показываем первое фото
@@ -3409,12 +3511,18 @@ async def manage_portfolio_photos(update: Update, context: ContextTypes.DEFAULT_
 
 async def show_portfolio_photo(query, context, index):
     """Показывает конкретное фото из портфолио с кнопками навигации и удаления"""
-    photos_list = context.user_data.get('portfolio_photos', [])
-
-    if index >= len(photos_list):
-        index = 0
+    photo = load_portfolio_photo(context.user_data.get('portfolio_worker_id'), index)
+    if not photo:
+        await safe_edit_message(
+            query,
+            "📸 В портфолио больше нет фото.",
+            reply_markup=InlineKeyboardMarkup([[
+                InlineKeyboardButton("⬅️ К профилю", callback_data="worker_profile")
+            ]])
+        )
+        return
 
-    photo_id = photos_list[index]
+    photo_id, index, photos_total = photo
     is_video = photo_id.startswith("VIDEO:")
 
     # Формируем кнопки
@@ -3424,7 +3532,7 @@ async def show_portfolio_photo(query, context, index):
     nav_buttons = []
     if index > 0:
         nav_buttons.append(InlineKeyboardButton("⬅️ Предыдущее", callback_data=f"portfolio_prev_{index}"))
-    if index < len(photos_list) - 1:
+    if index < photos_total - 1:
         nav_buttons.append(InlineKeyboardButton("Следующее ➡️", callback_data=f"portfolio_next_{index}"))
 
     if nav_buttons:
@@ -3435,7 +3543,7 @@ async def show_portfolio_photo(query, context, index):
     keyboard.append([InlineKeyboardButton("⬅️ Назад к профилю", callback_data="worker_profile")])
 
     caption = (
-        f"📸 <b>Фото {index + 1} из {len(photos_list)}</b>\n\n"
+        f"📸 <b>Фото {index + 1} из {photos_total}</b>\n\n"
         f"{'🎥 Видео' if is_video else '📷 Фото'}\n\n"
         f"Нажмите кнопку ниже чтобы удалить это фото."
     )
@@ -3514,26 +3622,26 @@ async def delete_portfolio_photo(update: Update, context: ContextTypes.DEFAULT_T
     user_dict = dict(user)
     user_id = user_dict.get("id")
 
-    # Удаляем фото
-    photos_list = context.user_data.get('portfolio_photos', [])
-    if index >= len(photos_list):
-        await query.answer("❌ Фото не найдено", show_alert=True)
+    worker_profile = db.get_worker_profile(user_id)
+    if not worker_profile:
+        await query.edit_message_text("❌ Профиль мастера не найден.")
         return
+    worker_id = dict(worker_profile)["id"]
 
-    deleted_photo = photos_list.pop(index)
-
-    # Обновляем в БД
-    new_portfolio = ",".join(photos_list)
-    db.update_worker_field(user_id, "portfolio_photos", new_portfolio)
+    # ИСПРАВЛЕНО: Удаляем одну строку по позиции вместо перезаписи всей строки портфолио
+    remaining = db.delete_portfolio_photo(worker_id, index)
+    if remaining is None:
+        await query.answer("❌ Фото не найдено", show_alert=True)
+        return
 
     logger.info(f"Удалено фото из портфолио мастера {user_id}: индекс {index}")
 
     # Если остались фото - показываем следующее или предыдущее
-    if photos_list:
-        context.user_data['portfolio_photos'] = photos_list
+    if remaining:
+        context.user_data['portfolio_worker_id'] = worker_id
 
         # Если удалили последнее - показываем предпоследнее
-        new_index = min(index, len(photos_list) - 1)
+        new_index = min(index, remaining - 1)
         context.user_data['current_photo_index'] = new_index
 
         await query.answer("✅ Фото удалено", show_alert=True)
@@ -3578,10 +3686,9 @@ async def view_worker_portfolio(update: Update, context: ContextTypes.DEFAULT_TY
         await safe_edit_message(query, "❌ Профиль мастера не найден")
         return
 
-    profile_dict = dict(worker_profile)
-    portfolio_photos = profile_dict.get("portfolio_photos") or ""
+    first_photo = load_portfolio_photo(worker_id, 0)
 
-    if not portfolio_photos:
+    if not first_photo:
         await safe_edit_message(
             query,
             "📸 У этого мастера пока нет фото работ.",
@@ -3591,10 +3698,10 @@ async def view_worker_portfolio(update: Update, context: ContextTypes.DEFAULT_TY
         )
         return
 
-    photo_ids = [p.strip() for p in portfolio_photos.split(",") if p.strip()]
+    first_photo_id, _, photos_total = first_photo
 
-    # Сохраняем в context для навигации
-    context.user_data['viewing_worker_portfolio'] = photo_ids
+    # Сохраняем в context для навигации (фото читаются по одному)
+    context.user_data['viewing_worker_portfolio_total'] = photos_total
     context.user_data['viewing_worker_portfolio_index'] = 0
     context.user_data['viewing_worker_id'] = worker_id
 
@@ -3602,10 +3709,10 @@ async def view_worker_portfolio(update: Update, context: ContextTypes.DEFAULT_TY
     keyboard = []
 
     # Навигация если фото больше одного
-    if len(photo_ids) > 1:
+    if photos_total > 1:
         nav_buttons = [
             InlineKeyboardButton("◀️", callback_data="worker_portfolio_view_prev"),
-            InlineKeyboardButton(f"1/{len(photo_ids)}", callback_data="noop"),
+            InlineKeyboardButton(f"1/{photos_total}", callback_data="noop"),
             InlineKeyboardButton("▶️", callback_data="worker_portfolio_view_next")
         ]
         keyboard.append(nav_buttons)
@@ -3615,8 +3722,8 @@ async def view_worker_portfolio(update: Update, context: ContextTypes.DEFAULT_TY
     try:
         await query.message.delete()
         await query.message.reply_photo(
-            photo=photo_ids[0],
-            caption=f"📸 <b>Работы мастера</b>\n\n1 из {len(photo_ids)}",
+            photo=first_photo_id,
+            caption=f"📸 <b>Работы мастера</b>\n\n1 из {photos_total}",
             parse_mode="HTML",
             reply_markup=InlineKeyboardMarkup(keyboard)
         )
@@ -3630,29 +3737,34 @@ async def worker_portfolio_view_navigate(update: Update, context: ContextTypes.D
     query = update.callback_query
     await query.answer()
 
-    photos = context.user_data.get('viewing_worker_portfolio', [])
+    worker_id = context.user_data.get('viewing_worker_id')
+    photos_total = context.user_data.get('viewing_worker_portfolio_total', 0)
     current_index = context.user_data.get('viewing_worker_portfolio_index', 0)
 
-    if not photos:
+    # Определяем направление
+    if photos_total:
+        if query.data == "worker_portfolio_view_next":
+            current_index = (current_index + 1) % photos_total
+        elif query.data == "worker_portfolio_view_prev":
+            current_index = (current_index - 1) % photos_total
+
+    photo = load_portfolio_photo(worker_id, current_index) if worker_id else None
+    if not photo:
         await query.message.delete()
         await query.message.reply_text("❌ Ошибка: фотографии не найдены")
         return
 
-    # Определяем направление
-    if query.data == "worker_portfolio_view_next":
-        current_index = (current_index + 1) % len(photos)
-    elif query.data == "worker_portfolio_view_prev":
-        current_index = (current_index - 1) % len(photos)
-
+    current_photo_id, current_index, photos_total = photo
     context.user_data['viewing_worker_portfolio_index'] = current_index
+    context.user_data['viewing_worker_portfolio_total'] = photos_total
 
     # Обновляем фото
     keyboard = []
 
-    if len(photos) > 1:
+    if photos_total > 1:
         nav_buttons = [
             InlineKeyboardButton("◀️", callback_data="worker_portfolio_view_prev"),
-            InlineKeyboardButton(f"{current_index + 1}/{len(photos)}", callback_data="noop"),
+            InlineKeyboardButton(f"{current_index + 1}/{photos_total}", callback_data="noop"),
             InlineKeyboardButton("▶️", callback_data="worker_portfolio_view_next")
         ]
         keyboard.append(nav_buttons)
@@ -3662,8 +3774,8 @@ async def worker_portfolio_view_navigate(update: Update, context: ContextTypes.D
     try:
         await query.message.delete()
         await query.message.reply_photo(
-            photo=photos[current_index],
-            caption=f"📸 <b>Работы мастера</b>\n\n{current_index + 1} из {len(photos)}",
+            photo=current_photo_id,
+            caption=f"📸 <b>Работы мастера</b>\n\n{current_index + 1} из {photos_total}",
             parse_mode="HTML",
             reply_markup=InlineKeyboardMarkup(keyboard)
         )
@@ -4613,9 +4725,14 @@ async def client_waiting_orders(update: Update, context: ContextTypes.DEFAULT_TY
         text = f"🔍 <b>В ожидании мастера</b> ({len(orders)})\n\n"
         keyboard = []
 
-        for order in orders[:10]:
+        # ИСПРАВЛЕНО: Количество откликов по всем показанным заказам - одним запросом
+        shown_orders = orders[:10]
+        bids_counts = await context.loader.load_many('order_bids_counts', [dict(o)['id'] for o in shown_orders])
+
+        for order, bids_count in zip(shown_orders, bids_counts):
             order_dict = dict(order)
             order_id = order_dict['id']
+            bids_count = bids_count or 0
 
             text += f"🟢 <b>Заказ #{order_id}</b> - Открыт\n"
             text += f"🔧 {order_dict.get('category', 'Не указана')}\n"
@@ -4626,7 +4743,6 @@ async def client_waiting_orders(update: Update, context: ContextTypes.DEFAULT_TY
             text += f"📝 {description}\n"
 
             # Количество откликов
-            bids_count = db.get_bids_count_for_order(order_id)
             if bids_count > 0:
                 text += f"💼 {bids_count} {_get_bids_word(bids_count)}\n"
                 keyboard.append([InlineKeyboardButton(
@@ -4697,7 +4813,11 @@ async def client_in_progress_orders(update: Update, context: ContextTypes.DEFAUL
         text = f"🔧 <b>В работе</b> ({len(orders)})\n\n"
         keyboard = []
 
-        for order in orders[:10]:
+        # ИСПРАВЛЕНО: Чаты всех показанных заказов - одним запросом
+        shown_orders = orders[:10]
+        chats = await context.loader.load_many('order_chats', [dict(o)['id'] for o in shown_orders])
+
+        for order, chat in zip(shown_orders, chats):
             order_dict = dict(order)
             order_id = order_dict['id']
             order_status = order_dict.get('status', '')
@@ -4729,7 +4849,6 @@ async def client_in_progress_orders(update: Update, context: ContextTypes.DEFAUL
             text += f"📝 {description}\n"
 
             # Кнопки чата и завершения
-            chat = db.get_chat_by_order(order_id)
             if chat:
                 chat_dict = dict(chat)
                 keyboard.append([InlineKeyboardButton(
@@ -4788,7 +4907,11 @@ async def client_completed_orders(update: Update, context: ContextTypes.DEFAULT_
         text = f"✅ <b>Завершённые заказы</b> ({len(orders)})\n\n"
         keyboard = []
 
-        for order in orders[:10]:  # Показываем первые 10
+        # ИСПРАВЛЕНО: Чаты всех показанных заказов - одним запросом
+        shown_orders = orders[:10]  # Показываем первые 10
+        chats = await context.loader.load_many('order_chats', [dict(o)['id'] for o in shown_orders])
+
+        for order, chat in zip(shown_orders, chats):
             order_dict = dict(order)
             order_id = order_dict['id']
 
@@ -4817,7 +4940,6 @@ async def client_completed_orders(update: Update, context: ContextTypes.DEFAULT_
             # Показываем чат если есть
             selected_worker_id = order_dict.get('selected_worker_id')
             if selected_worker_id:
-                chat = db.get_chat_by_order(order_id)
                 if chat:
                     chat_dict = dict(chat)
                     keyboard.append([InlineKeyboardButton(
@@ -4868,9 +4990,10 @@ async def cancel_order_handler(update: Update, context: ContextTypes.DEFAULT_TYP
 
         # Успешная отмена - уведомляем мастеров
         notified_count = 0
+        workers_by_user_id = db.get_users_by_ids(result['notified_workers'])
         for worker_user_id in result['notified_workers']:
             try:
-                worker_user = db.get_user_by_id(worker_user_id)
+                worker_user = workers_by_user_id.get(worker_user_id)
                 if worker_user:
                     await context.bot.send_message(
                         chat_id=worker_user['telegram_id'],
@@ -6031,45 +6154,48 @@ def _get_photos_word(count):
         return "фото"
 
 
-async def view_order_bids(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Просмотр откликов на заказ клиента с навигацией"""
+async def view_order_bids(update: Update, context: ContextTypes.DEFAULT_TYPE, order_id=None):
+    """
+    Просмотр откликов на заказ клиента с навигацией.
+
+    ИСПРАВЛЕНО: order_id можно передать явно (sort_bids_handler) - тогда callback
+    уже обработан вызывающим и callback_data не разбирается.
+    """
     query = update.callback_query
-    await query.answer()
 
     try:
-        # Извлекаем order_id из callback_data
-        order_id = int(query.data.replace("view_bids_", ""))
-
-        # Проверяем что заказ принадлежит текущему пользователю
-        user = db.get_user(query.from_user.id)
-        if not user:
-            await query.edit_message_text(
-                "❌ Ошибка: пользователь не найден.",
-                parse_mode="HTML"
-            )
-            return
+        if order_id is None:
+            await query.answer()
+            # Извлекаем order_id из callback_data
+            order_id = int(query.data.replace("view_bids_", ""))
 
-        client_profile = db.get_client_profile(user["id"])
+        # ИСПРАВЛЕНО: Профиль заказчика одним запросом по telegram_id (без get_user)
+        client_profile = context.loader.get_client_profile_by_telegram_id(query.from_user.id)
         if not client_profile:
-            await query.edit_message_text(
-                "❌ Ошибка: профиль клиента не найден.",
-                parse_mode="HTML"
-            )
-            return
-
-        # Получаем заказ
-        order = db.get_order_by_id(order_id)
-        if not order or order['client_id'] != client_profile['id']:
-            await query.edit_message_text(
-                "❌ Заказ не найден или у вас нет доступа к нему.",
-                parse_mode="HTML"
-            )
+            # Редкая ветка: уточняем причину отдельным запросом
+            if not context.loader.get_user(query.from_user.id):
+                error_text = "❌ Ошибка: пользователь не найден."
+            else:
+                error_text = "❌ Ошибка: профиль клиента не найден."
+            await query.edit_message_text(error_text, parse_mode="HTML")
             return
 
-        # Получаем все отклики
-        bids = db.get_bids_for_order(order_id)
+        # НОВОЕ: Облегчённый список откликов, отсортированный в SQL.
+        # Тяжёлые поля мастера догружает show_bid_card для открытой карточки
+        # ИСПРАВЛЕНО: Владелец заказа проверяется в том же запросе (client_id),
+        # заказ читается отдельно только если откликов нет
+        sort_order = context.user_data.get('bids_sort_order', 'default')
+        bids = context.loader.get_bid_list_for_order(order_id, sort_order, client_id=client_profile['id'])
 
         if not bids:
+            order = context.loader.get_order_by_id(order_id)
+            if not order or order['client_id'] != client_profile['id']:
+                await query.edit_message_text(
+                    "❌ Заказ не найден или у вас нет доступа к нему.",
+                    parse_mode="HTML"
+                )
+                return
+
             keyboard = [[InlineKeyboardButton("⬅️ К моим заказам", callback_data="client_my_orders")]]
             await query.edit_message_text(
                 f"💼 <b>Отклики на заказ #{order_id}</b>\n\n"
@@ -6080,19 +6206,8 @@ async def view_order_bids(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
             return
 
-        # Применяем сортировку, если выбрана
-        sort_order = context.user_data.get('bids_sort_order', 'default')
         bids_list = [dict(bid) for bid in bids]
 
-        if sort_order == 'price_low':
-            bids_list.sort(key=lambda x: x.get('proposed_price', 0))
-        elif sort_order == 'price_high':
-            bids_list.sort(key=lambda x: x.get('proposed_price', 0), reverse=True)
-        elif sort_order == 'rating':
-            bids_list.sort(key=lambda x: x.get('worker_rating', 0), reverse=True)
-        elif sort_order == 'timeline':
-            bids_list.sort(key=lambda x: x.get('ready_in_days', 999))
-
         # Сохраняем отклики в контексте для навигации
         context.user_data['viewing_bids'] = {
             'order_id': order_id,
@@ -6128,10 +6243,9 @@ async def sort_bids_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # Сохраняем выбранную сортировку
         context.user_data['bids_sort_order'] = sort_type
 
-        # Перезагружаем отклики с новой сортировкой
-        # Используем фейковый callback_data для повторного вызова view_order_bids
-        query.data = f"view_bids_{order_id}"
-        await view_order_bids(update, context)
+        # ИСПРАВЛЕНО: CallbackQuery неизменяем (PTB 21) - передаём order_id напрямую,
+        # а не подменяем query.data
+        await view_order_bids(update, context, order_id=order_id)
 
     except Exception as e:
         logger.error(f"Ошибка в sort_bids_handler: {e}", exc_info=True)
@@ -6157,41 +6271,16 @@ async def show_bid_card(update: Update, context: ContextTypes.DEFAULT_TYPE, quer
         current_index = bid_data['current_index']
         bid = bids[current_index]
 
+        # НОВОЕ: Блоки о мастере - из кэша по версии профиля, данные отклика дорисовываем.
+        # Описание и фото мастера читаем из БД только при промахе кэша
+        worker_block, about_block, photo_to_show, has_portfolio = worker_card_cache.get_or_render(
+            bid.get('worker_id'), bid.get('worker_profile_version'), "bid",
+            lambda: render_bid_worker_card(load_bid_worker_details(bid)),
+        )
+
         # Формируем текст карточки мастера
         text = f"💼 <b>Отклик {current_index + 1} из {len(bids)}</b>\n\n"
-
-        text += f"👤 <b>{bid['worker_name']}</b>\n"
-
-        # Рейтинг
-        rating = bid.get('worker_rating', 0)
-        rating_count = bid.get('worker_rating_count', 0)
-        if rating > 0:
-            stars = "⭐" * int(rating)
-            text += f"{stars} {rating:.1f} ({rating_count} отзывов)\n"
-        else:
-            text += "⭐ Новый мастер (пока нет отзывов)\n"
-
-        # Проверенные отзывы
-        verified_reviews = bid.get('worker_verified_reviews', 0)
-        if verified_reviews > 0:
-            text += f"✅ {verified_reviews} проверенных отзывов\n"
-
-        # Опыт
-        experience = bid.get('worker_experience', '')
-        if experience:
-            text += f"📅 Опыт: {experience}\n"
-
-        # Город
-        city = bid.get('worker_city', '')
-        if city:
-            text += f"📍 Город: {city}\n"
-
-        # Категории
-        categories = bid.get('worker_categories', '')
-        if categories:
-            text += f"🔧 Услуги: {categories}\n"
-
-        text += "\n"
+        text += worker_block
 
         # Предложенная цена
         price = bid.get('proposed_price', 0)
@@ -6225,11 +6314,7 @@ async def show_bid_card(update: Update, context: ContextTypes.DEFAULT_TYPE, quer
             text += f"💬 <b>Комментарий мастера:</b>\n{comment}\n\n"
 
         # Описание мастера
-        description = bid.get('worker_description', '')
-        if description:
-            if len(description) > 200:
-                description = description[:200] + "..."
-            text += f"📝 <b>О мастере:</b>\n{description}\n\n"
+        text += about_block
 
         text += "💡 <i>Выберите этого мастера, чтобы получить доступ к его контактам</i>"
 
@@ -6283,8 +6368,7 @@ async def show_bid_card(update: Update, context: ContextTypes.DEFAULT_TYPE, quer
         )])
 
         # Кнопка просмотра всех работ (если есть фото)
-        portfolio_photos = bid.get('worker_portfolio_photos', '')
-        if portfolio_photos:
+        if has_portfolio:
             keyboard.append([InlineKeyboardButton(
                 "📸 Посмотреть работы мастера",
                 callback_data=f"view_worker_portfolio_{bid['worker_id']}"
@@ -6293,11 +6377,6 @@ async def show_bid_card(update: Update, context: ContextTypes.DEFAULT_TYPE, quer
         keyboard.append([InlineKeyboardButton("⬅️ К моим заказам", callback_data="client_my_orders")])
 
         # Отправляем с фото профиля мастера, если есть
-        profile_photo = bid.get('worker_profile_photo', '')
-        portfolio_photos_list = [p.strip() for p in portfolio_photos.split(',') if p.strip()] if portfolio_photos else []
-
-        photo_to_show = profile_photo if profile_photo else (portfolio_photos_list[0] if portfolio_photos_list else None)
-
         if photo_to_show:
             # Удаляем старое сообщение и отправляем новое с фото
             try:
@@ -6946,7 +7025,8 @@ async def handle_chat_message(update: Update, context: ContextTypes.DEFAULT_TYPE
     # Если находится - пропускаем, чтобы ConversationHandler обработал сообщение
     conversation_keys = ['review_order_id', 'review_bid_id', 'review_rating',
                         'adding_photos', 'bid_order_id',
-                        'uploading_work_photo_order_id', 'order_client_id']
+                        'uploading_work_photo_order_id', 'order_client_id',
+                        'order_search_active']
     if any(key in context.user_data for key in conversation_keys):
         # Пользователь в ConversationHandler, пропускаем
         logger.info(f"[DEBUG] handle_chat_message: пользователь в ConversationHandler, пропускаем")
@@ -6954,15 +7034,16 @@ async def handle_chat_message(update: Update, context: ContextTypes.DEFAULT_TYPE
 
     # ИСПРАВЛЕНО: Получаем активный чат из БД вместо user_data
     # Это решает проблему потери состояния при перезапуске бота
-    active_chat = db.get_active_chat(update.effective_user.id)
+    # НОВОЕ: Метаданные чата (собеседник, статус заказа) берутся из кэша сессий
+    session = db.get_chat_session(update.effective_user.id)
 
-    if not active_chat:
+    if not session:
         # Нет активного чата, пропускаем
         logger.info(f"[DEBUG] handle_chat_message: нет активного чата для пользователя {update.effective_user.id}, пропускаем")
         return
 
-    chat_id = active_chat['chat_id']
-    my_role = active_chat['role']
+    chat_id = session['chat_id']
+    my_role = session['role']
 
     message_text = update.message.text
 
@@ -6970,113 +7051,80 @@ async def handle_chat_message(update: Update, context: ContextTypes.DEFAULT_TYPE
         return
 
     try:
-        # Получаем информацию о пользователе
-        user = db.get_user(update.effective_user.id)
-        if not user:
-            await update.message.reply_text("❌ Пользователь не найден.")
-            return
-
-        user_dict = dict(user)
+        # Если это первое сообщение мастера - подтверждаем готовность тем же запросом
+        confirm_worker = my_role == "worker" and not session['worker_confirmed']
+        order_status = session['order_status']
 
         # Отправляем сообщение в чат
-        message_id = db.send_message(chat_id, user_dict['id'], my_role, message_text)
+        message_id = db.send_message(chat_id, session['user_id'], my_role, message_text, confirm_worker=confirm_worker)
 
         logger.info(f"✅ Сообщение #{message_id} отправлено в чат #{chat_id} от {my_role}")
 
-        # Если это первое сообщение мастера - подтверждаем готовность
-        if my_role == "worker" and not db.is_worker_confirmed(chat_id):
-            db.confirm_worker_in_chat(chat_id)
+        if confirm_worker:
             logger.info(f"✅ Мастер подтвердил готовность в чате #{chat_id}")
 
             # Обновляем статус заказа
-            chat = db.get_chat_by_id(chat_id)
-            if chat:
-                db.update_order_status(chat['order_id'], "master_confirmed")
-                logger.info(f"✅ Заказ #{chat['order_id']} переведён в статус 'master_confirmed'")
-
-        # Получаем информацию о чате для уведомления
-        chat = db.get_chat_by_id(chat_id)
-        if not chat:
-            await update.message.reply_text("❌ Чат не найден.")
-            return
-
-        chat_dict = dict(chat)
+            db.update_order_status(session['order_id'], "master_confirmed")
+            order_status = "master_confirmed"
+            logger.info(f"✅ Заказ #{session['order_id']} переведён в статус 'master_confirmed'")
 
         # Уведомляем собеседника о новом сообщении
-        other_user_id = chat_dict['worker_user_id'] if my_role == "client" else chat_dict['client_user_id']
-        other_user = db.get_user_by_id(other_user_id)
+        other_user_id = session['other_user_id']
 
-        if other_user:
-            other_user_dict = dict(other_user)
+        # ИСПРАВЛЕНО: Проверяем статус заказа - не уведомляем о сообщениях в завершенных заказах
+        # Уведомляем только для активных заказов (НЕ завершенных)
+        should_notify = order_status in ['open', 'waiting_master_confirmation', 'master_confirmed', 'in_progress']
+        if not should_notify:
+            logger.info(f"Заказ #{session['order_id']} имеет статус '{order_status}' - пропускаем уведомление о сообщении")
 
-            # ИСПРАВЛЕНО: Проверяем статус заказа - не уведомляем о сообщениях в завершенных заказах
-            order = db.get_order_by_id(chat_dict['order_id'])
-            should_notify = False
-
-            if order:
-                order_dict = dict(order)
-                order_status = order_dict.get('status', 'open')
-                # Уведомляем только для активных заказов (НЕ завершенных)
-                if order_status in ['open', 'waiting_master_confirmation', 'master_confirmed', 'in_progress']:
-                    should_notify = True
-                else:
-                    logger.info(f"Заказ #{chat_dict['order_id']} имеет статус '{order_status}' - пропускаем уведомление о сообщении")
+        if should_notify:
+            try:
+                # Определяем кнопку для возврата в заказы (в зависимости от роли получателя)
+                orders_callback = "client_my_orders" if my_role == "worker" else "worker_my_orders"
 
-            if should_notify:
-                try:
-                    # Определяем кнопку для возврата в заказы (в зависимости от роли получателя)
-                    other_user_id = other_user_dict['id']
-                    is_client = db.get_client_profile(other_user_id) is not None
-                    orders_callback = "client_my_orders" if is_client else "worker_my_orders"
-
-                    # ОБНОВЛЯЕМОЕ уведомление - одно сообщение на пользователя
-                    notification_text = (
-                        f"💬 <b>У вас есть новые сообщения!</b>\n\n"
-                        f"Откройте \"Мои заказы\" чтобы прочитать сообщения"
-                    )
+                # ОБНОВЛЯЕМОЕ уведомление - одно сообщение на пользователя
+                notification_text = (
+                    f"💬 <b>У вас есть новые сообщения!</b>\n\n"
+                    f"Откройте \"Мои заказы\" чтобы прочитать сообщения"
+                )
 
-                    keyboard = [[InlineKeyboardButton("📂 Мои заказы", callback_data=orders_callback)]]
-                    reply_markup = InlineKeyboardMarkup(keyboard)
+                keyboard = [[InlineKeyboardButton("📂 Мои заказы", callback_data=orders_callback)]]
+                reply_markup = InlineKeyboardMarkup(keyboard)
 
-                    # Получаем существующее уведомление
-                    existing_notification = db.get_chat_message_notification(other_user_id)
+                # Получаем существующее уведомление
+                existing_notification = db.get_chat_message_notification(other_user_id)
 
-                    try:
-                        if existing_notification and existing_notification['notification_message_id']:
-                            # Пытаемся РЕДАКТИРОВАТЬ существующее сообщение
-                            await context.bot.edit_message_text(
-                                chat_id=existing_notification['notification_chat_id'],
-                                message_id=existing_notification['notification_message_id'],
-                                text=notification_text,
-                                reply_markup=reply_markup,
-                                parse_mode="HTML"
-                            )
-                            # Обновляем timestamp
-                            db.save_chat_message_notification(
-                                other_user_id,
-                                existing_notification['notification_message_id'],
-                                existing_notification['notification_chat_id']
-                            )
-                            logger.info(f"✅ Обновлено уведомление о сообщении для пользователя {other_user_id}")
-                        else:
-                            # Сообщения нет - отправляем НОВОЕ
-                            raise Exception("No existing notification")
-
-                    except Exception as edit_error:
-                        # Не удалось отредактировать (сообщение удалено или не существует) - отправляем новое
-                        logger.info(f"Отправка нового уведомления о сообщении для пользователя {other_user_id}: {edit_error}")
-                        msg = await context.bot.send_message(
-                            chat_id=other_user_dict['telegram_id'],
+                try:
+                    if existing_notification and existing_notification['notification_message_id']:
+                        # Пытаемся РЕДАКТИРОВАТЬ существующее сообщение
+                        # (запись в БД не меняется - повторно её не сохраняем)
+                        await context.bot.edit_message_text(
+                            chat_id=existing_notification['notification_chat_id'],
+                            message_id=existing_notification['notification_message_id'],
                             text=notification_text,
                             reply_markup=reply_markup,
                             parse_mode="HTML"
                         )
-                        # Сохраняем message_id для будущих обновлений
-                        db.save_chat_message_notification(other_user_id, msg.message_id, other_user_dict['telegram_id'])
-                        logger.info(f"✅ Отправлено новое уведомление о сообщении пользователю {other_user_id}")
+                        logger.info(f"✅ Обновлено уведомление о сообщении для пользователя {other_user_id}")
+                    else:
+                        # Сообщения нет - отправляем НОВОЕ
+                        raise Exception("No existing notification")
+
+                except Exception as edit_error:
+                    # Не удалось отредактировать (сообщение удалено или не существует) - отправляем новое
+                    logger.info(f"Отправка нового уведомления о сообщении для пользователя {other_user_id}: {edit_error}")
+                    msg = await context.bot.send_message(
+                        chat_id=session['other_telegram_id'],
+                        text=notification_text,
+                        reply_markup=reply_markup,
+                        parse_mode="HTML"
+                    )
+                    # Сохраняем message_id для будущих обновлений
+                    db.save_chat_message_notification(other_user_id, msg.message_id, session['other_telegram_id'])
+                    logger.info(f"✅ Отправлено новое уведомление о сообщении пользователю {other_user_id}")
 
-                except Exception as e:
-                    logger.error(f"Ошибка при отправке уведомления: {e}")
+            except Exception as e:
+                logger.error(f"Ошибка при отправке уведомления: {e}")
 
         # Определяем меню для возврата
         menu_callback = "show_client_menu" if my_role == "client" else "show_worker_menu"
@@ -7357,38 +7405,35 @@ async def worker_view_orders(update: Update, context: ContextTypes.DEFAULT_TYPE)
     await query.answer()
 
     try:
-        # Получаем профиль мастера
-        user = db.get_user(query.from_user.id)
-        if not user:
-            await query.edit_message_text("❌ Ошибка: пользователь не найден.")
-            return
-
-        # НОВОЕ: Обнуляем счётчик непрочитанных заказов (пользователь их просматривает)
-        db.save_worker_notification(user['id'], None, None, 0)
-
-        worker_profile = db.get_worker_profile(user["id"])
+        # ИСПРАВЛЕНО: Профиль мастера и состояние уведомления одним запросом по telegram_id
+        worker_profile = db.get_worker_profile_by_telegram_id(query.from_user.id)
         if not worker_profile:
-            await query.edit_message_text("❌ Ошибка: профиль мастера не найден.")
+            # Редкая ветка: уточняем причину отдельным запросом
+            if not db.get_user(query.from_user.id):
+                await query.edit_message_text("❌ Ошибка: пользователь не найден.")
+            else:
+                await query.edit_message_text("❌ Ошибка: профиль мастера не найден.")
             return
-        
+
         worker_dict = dict(worker_profile)
         worker_id = worker_dict['id']
         categories = worker_dict.get("categories", "").split(", ")
 
+        # НОВОЕ: Обнуляем счётчик непрочитанных заказов (пользователь их просматривает)
+        # ИСПРАВЛЕНО: Только если есть что сбрасывать - повторный просмотр без новых
+        # заказов не пишет в БД
+        if worker_dict.get('unread_orders_count') or worker_dict.get('notification_message_id'):
+            db.save_worker_notification(worker_dict['user_id'], None, None, 0)
+
         # ИСПРАВЛЕНО: Один запрос для всех категорий вместо N запросов
         # ИСПРАВЛЕНО: Фильтрация по городам мастера (worker_id)
         # Раньше: 5 категорий = 5 SQL запросов, мастер видел заказы из ВСЕХ городов
         # Теперь: 5 категорий = 1 SQL запрос, мастер видит заказы ТОЛЬКО из своих городов
-        all_orders = db.get_orders_by_categories(categories, per_page=30, worker_id=worker_id)
+        # ИСПРАВЛЕНО: Заказы с откликом мастера и отклонённые им отсекаются в том же
+        # запросе (exclude_seen), а не отдельными запросами после LIMIT
+        all_orders = db.get_orders_by_categories(categories, per_page=30, worker_id=worker_id, exclude_seen=True)
         all_orders = [dict(order) for order in all_orders]
 
-        # Фильтруем заказы - не показываем те, на которые мастер уже откликнулся
-        # НОВОЕ: Также не показываем заказы, от которых мастер отказался
-        # ИСПРАВЛЕНО: Используем worker_id (ID профиля мастера), а не user["id"] (ID пользователя)
-        all_orders = [order for order in all_orders
-                     if not db.check_worker_bid_exists(order['id'], worker_id)
-                     and not db.check_order_declined(user["id"], order['id'])]
-        
         if not all_orders:
             keyboard = [
                 [InlineKeyboardButton("⬅️ Назад в меню", callback_data="show_worker_menu")],
@@ -7461,6 +7506,92 @@ async def worker_view_orders(update: Update, context: ContextTypes.DEFAULT_TYPE)
         )
 
 
+# ------- НОВОЕ: ПОИСК ЗАКАЗОВ ПО СЛОВАМ -------
+
+WORKER_ORDER_SEARCH = 51  # Уникальное значение, не конфликтует с range(50) и SUGGESTION_TEXT
+ORDER_SEARCH_RESULTS_LIMIT = 10
+ORDER_SEARCH_MAX_QUERY_LENGTH = 100
+
+
+async def worker_search_orders_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Начало поиска заказов по словам из описания"""
+    query = update.callback_query
+    await query.answer()
+
+    # Флаг для handle_chat_message: текст запроса не должен уйти в чат
+    context.user_data['order_search_active'] = True
+
+    await safe_edit_message(
+        query,
+        "🔎 <b>Поиск заказов</b>\n\n"
+        "Напишите, что нужно найти в описании заказа, например:\n"
+        "<i>протекает кран</i> или <i>замена проводки</i>\n\n"
+        "Ищем среди открытых заказов в ваших категориях и городах.",
+        parse_mode="HTML",
+        reply_markup=InlineKeyboardMarkup([
+            [InlineKeyboardButton("❌ Отмена", callback_data="cancel_order_search")]
+        ])
+    )
+    return WORKER_ORDER_SEARCH
+
+
+async def worker_search_orders_execute(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Выполняет поиск заказов и показывает результаты"""
+    query_text = update.message.text.strip()[:ORDER_SEARCH_MAX_QUERY_LENGTH]
+
+    user = db.get_user(update.effective_user.id)
+    worker_profile = db.get_worker_profile(user["id"]) if user else None
+    if not worker_profile:
+        context.user_data.pop('order_search_active', None)
+        await update.message.reply_text("❌ Ошибка: профиль мастера не найден.")
+        return ConversationHandler.END
+
+    worker_dict = dict(worker_profile)
+    categories = (worker_dict.get("categories") or "").split(", ")
+    orders = db.search_open_orders(query_text, categories, worker_dict['id'], limit=ORDER_SEARCH_RESULTS_LIMIT)
+    orders = [dict(order) for order in orders]
+
+    context.user_data.pop('order_search_active', None)
+
+    keyboard = []
+    if not orders:
+        text = (
+            f"🔎 По запросу «{html.escape(query_text)}» ничего не найдено.\n\n"
+            "Попробуйте другие слова или посмотрите всю ленту заказов."
+        )
+        keyboard.append([InlineKeyboardButton("📋 Доступные заказы", callback_data="worker_view_orders")])
+    else:
+        text = f"🔎 <b>Найдено по запросу «{html.escape(query_text)}»:</b> {len(orders)}\n\n"
+        for order in orders:
+            description = order.get('description') or ''
+            if len(description) > 80:
+                description = description[:80] + "..."
+            text += f"🟢 <b>Заказ #{order['id']}</b>\n"
+            text += f"📍 {html.escape(order.get('city') or 'Не указан')} · {html.escape(order.get('category') or 'Не указана')}\n"
+            text += f"📝 {html.escape(description)}\n\n"
+            keyboard.append([InlineKeyboardButton(
+                f"👁 Заказ #{order['id']} - Подробнее",
+                callback_data=f"view_order_{order['id']}"
+            )])
+
+    keyboard.append([InlineKeyboardButton("🔎 Новый поиск", callback_data="worker_search_orders")])
+    keyboard.append([InlineKeyboardButton("⬅️ Назад в меню", callback_data="show_worker_menu")])
+
+    await update.message.reply_text(
+        text,
+        parse_mode="HTML",
+        reply_markup=InlineKeyboardMarkup(keyboard)
+    )
+    return ConversationHandler.END
+
+
+async def cancel_order_search(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Отмена поиска заказов - возврат в меню мастера"""
+    context.user_data.pop('order_search_active', None)
+    await show_worker_menu(update, context)
+    return ConversationHandler.END
+
+
 async def worker_view_order_details(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Детальный просмотр заказа мастером"""
     query = update.callback_query
@@ -7517,16 +7648,6 @@ async def worker_view_order_details(update: Update, context: ContextTypes.DEFAUL
             
             keyboard = []
             
-            # Навигация по фото если их больше 1
-            if len(photo_ids) > 1:
-                nav_buttons = []
-                if len(photo_ids) > 1:
-                    nav_buttons.append(InlineKeyboardButton("◀️", callback_data=f"order_photo_prev_{order_id}"))
-                nav_buttons.append(InlineKeyboardButton(f"1/{len(photo_ids)}", callback_data="noop"))
-                if len(photo_ids) > 1:
-                    nav_buttons.append(InlineKeyboardButton("▶️", callback_data=f"order_photo_next_{order_id}"))
-                keyboard.append(nav_buttons)
-            
             # Кнопка завершения заказа если мастер работает над ним
             order_status = order_dict.get('status', 'open')
             selected_worker_id = order_dict.get('selected_worker_id')
@@ -7547,14 +7668,20 @@ async def worker_view_order_details(update: Update, context: ContextTypes.DEFAUL
             # ИСПРАВЛЕНО: Если мастер откликнулся на заказ - возвращаем в "Мои отклики", иначе в "Доступные заказы"
             back_callback = "worker_my_bids" if already_bid else "worker_view_orders"
             keyboard.append([InlineKeyboardButton("⬅️ Назад", callback_data=back_callback)])
+
+            # НОВОЕ: Подпись и кнопки действий запоминаем - листание фото обходится без БД
+            order_photo_view = {'order_id': order_id, 'caption': text, 'action_rows': keyboard}
+            context.user_data['order_photo_view'] = order_photo_view
+            media, reply_markup = build_order_photo_screen(order_photo_view, photo_ids, 0)
             
             await query.message.delete()
             await query.message.reply_photo(
-                photo=photo_ids[0],
+                photo=media.media,
                 caption=text,
                 parse_mode="HTML",
-                reply_markup=InlineKeyboardMarkup(keyboard)
+                reply_markup=reply_markup
             )
+            schedule_order_photo_prefetch(context, order_photo_view, photo_ids, 0)
         else:
             # Нет фото - просто текст
             keyboard = []
@@ -7719,8 +7846,47 @@ async def worker_decline_order_no(update: Update, context: ContextTypes.DEFAULT_
         )
 
 
+def build_order_photo_screen(view, photo_ids, index):
+    """
+    Экран фото заказа: подпись и кнопки действий из order_photo_view + навигация.
+
+    Returns:
+        tuple: (InputMediaPhoto, клавиатура)
+    """
+    order_id = view['order_id']
+    keyboard = []
+
+    # Навигация по фото если их больше 1
+    if len(photo_ids) > 1:
+        keyboard.append([
+            InlineKeyboardButton("◀️", callback_data=f"order_photo_prev_{order_id}"),
+            InlineKeyboardButton(f"{index + 1}/{len(photo_ids)}", callback_data="noop"),
+            InlineKeyboardButton("▶️", callback_data=f"order_photo_next_{order_id}"),
+        ])
+    keyboard.extend(view['action_rows'])
+
+    media = InputMediaPhoto(media=photo_ids[index], caption=view['caption'], parse_mode="HTML")
+    return media, InlineKeyboardMarkup(keyboard)
+
+
+def schedule_order_photo_prefetch(context, view, photo_ids, index):
+    """Предзагрузка соседних фото заказа (по кругу)"""
+    if len(photo_ids) < 2:
+        return
+    neighbours = {(index + 1) % len(photo_ids), (index - 1) % len(photo_ids)}
+    schedule_prefetch(context, {
+        ("order_photo", view['order_id'], i): (lambda i=i: build_order_photo_screen(view, photo_ids, i))
+        for i in neighbours
+    })
+
+
 async def worker_order_photo_nav(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Навигация по фото заказа"""
+    """
+    Навигация по фото заказа.
+
+    ИСПРАВЛЕНО: Подпись и кнопки берутся из сессии (order_photo_view), а экран
+    соседнего фото обычно уже предзагружен - нажатие стоит одного edit_media.
+    """
     query = update.callback_query
     await query.answer()
     
@@ -7728,8 +7894,9 @@ async def worker_order_photo_nav(update: Update, context: ContextTypes.DEFAULT_T
         photo_ids = context.user_data.get('order_photos', [])
         current_index = context.user_data.get('current_photo_index', 0)
         order_id = context.user_data.get('current_order_id')
+        view = context.user_data.get('order_photo_view')
         
-        if not photo_ids or order_id is None:
+        if not photo_ids or order_id is None or not view or view['order_id'] != order_id:
             return
         
         # Определяем направление
@@ -7739,56 +7906,52 @@ async def worker_order_photo_nav(update: Update, context: ContextTypes.DEFAULT_T
             current_index = (current_index + 1) % len(photo_ids)
         
         context.user_data['current_photo_index'] = current_index
-        
-        # Получаем заказ для caption
-        order = db.get_order_by_id(order_id)
-        order_dict = dict(order)
-        
-        # Проверяем отклик
-        user = db.get_user(query.from_user.id)
-        worker_profile = db.get_worker_profile(user["id"])
-        already_bid = db.check_worker_bid_exists(order_id, worker_profile["id"])
 
-        # ПРОВЕРКА: Мастер не может откликаться на свой заказ
-        client = db.get_client_by_id(order_dict['client_id'])
-        is_own_order = False
-        if client:
-            client_dict = dict(client)
-            is_own_order = (client_dict['user_id'] == user["id"])
+        screen = take_prefetched(context, ("order_photo", order_id, current_index))
+        if screen is None:
+            screen = build_order_photo_screen(view, photo_ids, current_index)
+        media, reply_markup = screen
 
-        # Формируем текст
-        text = f"📋 <b>Заказ #{order_id}</b>\n\n"
-        text += f"📍 <b>Город:</b> {order_dict.get('city', 'Не указан')}\n"
-        text += f"🔧 <b>Категория:</b> {order_dict.get('category', 'Не указана')}\n"
-        text += f"📅 <b>Создан:</b> {order_dict.get('created_at', '')}\n\n"
-        text += f"📝 <b>Описание:</b>\n{order_dict.get('description', 'Нет описания')}\n\n"
-        text += f"👤 <b>Заказчик:</b> {order_dict.get('client_name', 'Неизвестно')}\n"
-        
-        # Обновляем кнопки
-        keyboard = []
-        nav_buttons = []
-        nav_buttons.append(InlineKeyboardButton("◀️", callback_data=f"order_photo_prev_{order_id}"))
-        nav_buttons.append(InlineKeyboardButton(f"{current_index+1}/{len(photo_ids)}", callback_data="noop"))
-        nav_buttons.append(InlineKeyboardButton("▶️", callback_data=f"order_photo_next_{order_id}"))
-        keyboard.append(nav_buttons)
-        
-        if is_own_order:
-            keyboard.append([InlineKeyboardButton("🚫 Это ваш заказ", callback_data="noop")])
-        elif already_bid:
-            keyboard.append([InlineKeyboardButton("✅ Вы уже откликнулись", callback_data="noop")])
-        else:
-            keyboard.append([InlineKeyboardButton("💰 Откликнуться", callback_data=f"bid_on_order_{order_id}")])
+        # Обновляем фото
+        await query.message.edit_media(media=media, reply_markup=reply_markup)
+        schedule_order_photo_prefetch(context, view, photo_ids, current_index)
         
-        keyboard.append([InlineKeyboardButton("⬅️ К списку заказов", callback_data="worker_view_orders")])
+    except Exception as e:
+        logger.error(f"Ошибка навигации по фото: {e}", exc_info=True)
+
+
+# ------- ПРЕДЗАГРУЗКА СЛЕДУЮЩЕГО ЭКРАНА -------
+
+# Ключ сессии с заранее собранными экранами: {ключ экрана: экран}
+PREFETCH_SESSION_KEY = "prefetched_screens"
+
+
+def schedule_prefetch(context, builders):
+    """
+    НОВОЕ: Собирает следующие экраны после ответа и кладёт их в сессию.
+
+    builders: {ключ экрана: функция без аргументов, возвращающая экран}.
+    Сборка запускается через call_soon - когда текущий обработчик уже отдал
+    управление циклу событий, поэтому пользователь её не ждёт. В сессии
+    хранятся только экраны последнего показа: новая предзагрузка заменяет старую.
+    """
+    user_data = context.user_data
+
+    def build():
+        screens = {}
+        for key, builder in builders.items():
+            try:
+                screens[key] = builder()
+            except Exception as e:
+                logger.debug(f"Предзагрузка экрана {key} не удалась: {e}")
+        user_data[PREFETCH_SESSION_KEY] = screens
+
+    asyncio.get_running_loop().call_soon(build)
 
-        # Обновляем фото
-        await query.message.edit_media(
-            media=InputMediaPhoto(media=photo_ids[current_index], caption=text, parse_mode="HTML"),
-            reply_markup=InlineKeyboardMarkup(keyboard)
-        )
-        
-    except Exception as e:
-        logger.error(f"Ошибка навигации по фото: {e}", exc_info=True)
+
+def take_prefetched(context, key):
+    """НОВОЕ: Забирает заранее собранный экран из сессии или None"""
+    return context.user_data.get(PREFETCH_SESSION_KEY, {}).pop(key, None)
 
 
 # ------- ЛИСТАНИЕ МАСТЕРОВ ДЛЯ КЛИЕНТОВ -------
@@ -7822,14 +7985,10 @@ async def browse_start_viewing(update: Update, context: ContextTypes.DEFAULT_TYP
     query = update.callback_query
     await query.answer()
     
-    # Получаем фильтры из context (если есть)
-    city_filter = context.user_data.get("browse_city")
-    category_filter = context.user_data.get("browse_category")
-    
-    # Получаем список мастеров
-    workers = db.get_all_workers(city=city_filter, category=category_filter)
+    # НОВОЕ: Первая страница лучших мастеров по счёту ранжирования
+    workers_count = load_browse_page(context)
     
-    if not workers:
+    if not workers_count:
         await query.edit_message_text(
             "😔 <b>Мастера не найдены</b>\n\n"
             "Пока ни один мастер не зарегистрировался.\n"
@@ -7841,53 +8000,96 @@ async def browse_start_viewing(update: Update, context: ContextTypes.DEFAULT_TYP
         )
         return
     
-    # Сохраняем список и индекс текущего мастера
-    context.user_data["workers_list"] = [dict(w) for w in workers]
-    context.user_data["current_worker_index"] = 0
-    context.user_data["current_photo_index"] = 0
-    
-    logger.info(f"Найдено мастеров: {len(workers)}")
+    logger.info(f"Загружено мастеров: {workers_count}")
     
     # Показываем первого мастера
     await show_worker_card(query, context, edit=True)
 
 
-async def show_worker_card(query_or_message, context: ContextTypes.DEFAULT_TYPE, edit=False):
-    """Показывает карточку мастера"""
-    
-    workers_list = context.user_data.get("workers_list", [])
-    worker_index = context.user_data.get("current_worker_index", 0)
-    photo_index = context.user_data.get("current_photo_index", 0)
-    
-    if worker_index >= len(workers_list):
-        # Все мастера просмотрены
-        keyboard = [
-            [InlineKeyboardButton("🔄 Начать сначала", callback_data="browse_restart")],
-            [InlineKeyboardButton("⬅️ Назад в меню", callback_data="show_client_menu")],
-        ]
-        
-        text = (
-            "✅ <b>Вы просмотрели всех мастеров!</b>\n\n"
-            "Можете начать сначала или вернуться в меню."
-        )
-        
-        if hasattr(query_or_message, 'edit_message_text'):
-            await query_or_message.edit_message_text(
-                text,
-                parse_mode="HTML",
-                reply_markup=InlineKeyboardMarkup(keyboard)
-            )
-        else:
-            await query_or_message.reply_text(
-                text,
-                parse_mode="HTML",
-                reply_markup=InlineKeyboardMarkup(keyboard)
-            )
-        return
-    
-    worker = workers_list[worker_index]
-    
-    # Формируем текст карточки
+def load_browse_page(context, after=None):
+    """
+    НОВОЕ: Загружает в сессию страницу мастеров для просмотра клиентом.
+
+    В сессии хранится только текущая страница; следующая загружается
+    keyset-запросом, когда клиент до неё дошёл.
+    ИСПРАВЛЕНО: Ключ продолжения - (ranking_score, id) последней загруженной
+    строки (browse_after), а не ID мастера: его счёт мог измениться.
+
+    Args:
+        after: browse_after предыдущей страницы; None - первая страница
+
+    Returns:
+        int: Количество мастеров на странице
+    """
+    workers = db.get_top_workers(
+        city=context.user_data.get("browse_city"),
+        category=context.user_data.get("browse_category"),
+        limit=db.WORKERS_PAGE_SIZE + 1,
+        after=after,
+    )
+
+    workers_list = [dict(w) for w in workers[:db.WORKERS_PAGE_SIZE]]
+    context.user_data["workers_list"] = workers_list
+    context.user_data["browse_has_more"] = len(workers) > db.WORKERS_PAGE_SIZE
+    if workers_list:
+        context.user_data["browse_after"] = (workers_list[-1]["ranking_score"], workers_list[-1]["id"])
+    context.user_data.pop(PREFETCH_SESSION_KEY, None)  # Экраны старой страницы больше не нужны
+    context.user_data["current_worker_index"] = 0
+    context.user_data["current_photo_index"] = 0
+    return len(context.user_data["workers_list"])
+
+
+# Максимум отрисованных карточек мастеров в памяти
+WORKER_CARD_CACHE_SIZE = 2000
+
+
+class WorkerCardCache:
+    """
+    НОВОЕ: LRU отрисованных карточек мастеров.
+
+    Ключ - (worker_id, profile_version, layout). Изменения профиля, рейтинга
+    и фото увеличивают workers.profile_version, поэтому устаревшие карточки
+    просто перестают запрашиваться и вытесняются - явная инвалидация не нужна.
+    Кэшируется только зависящее от мастера; номер фото, навигация и данные
+    отклика дорисовываются при каждом показе.
+    """
+
+    def __init__(self, max_size=WORKER_CARD_CACHE_SIZE):
+        self._max_size = max_size
+        self._cards = OrderedDict()
+
+    def get_or_render(self, worker_id, version, layout, render):
+        """Возвращает карточку из кэша или отрисовывает её через render()"""
+        if worker_id is None or version is None:
+            return render()
+
+        key = (worker_id, version, layout)
+        card = self._cards.get(key)
+        if card is not None:
+            self._cards.move_to_end(key)
+            return card
+
+        card = render()
+        self._cards[key] = card
+        if len(self._cards) > self._max_size:
+            self._cards.popitem(last=False)
+        return card
+
+    def clear(self):
+        self._cards.clear()
+
+
+# Глобальный кэш карточек мастеров
+worker_card_cache = WorkerCardCache()
+
+
+def render_browse_card(worker):
+    """
+    Карточка мастера для просмотра клиентом (без номера фото и навигации).
+
+    Returns:
+        tuple: (текст карточки, кортеж file_id фото портфолио)
+    """
     name = worker.get("name", "Без имени")
     city = worker.get("city", "Не указан")
     categories = worker.get("categories", "Не указаны")
@@ -7896,25 +8098,117 @@ async def show_worker_card(query_or_message, context: ContextTypes.DEFAULT_TYPE,
     rating = worker.get("rating", 0.0)
     rating_count = worker.get("rating_count", 0)
     portfolio_photos = worker.get("portfolio_photos", "")
-    
+
     # Обрабатываем фото
-    photos_list = [p for p in portfolio_photos.split(",") if p] if portfolio_photos else []
-    
+    photos_list = tuple(p for p in portfolio_photos.split(",") if p) if portfolio_photos else ()
+
     card_text = f"👤 <b>{name}</b>\n\n"
     card_text += f"📍 Город: {city}\n"
     card_text += f"🔧 Категории: {categories}\n"
     card_text += f"💼 Опыт: {experience}\n"
-    card_text += f"⭐ Рейтинг: {rating:.1f} ({rating_count} отзывов)\n\n"
+    card_text += f"⭐ Рейтинг: {rating:.1f} ({rating_count} отзывов)\n"
+    histogram_text = format_rating_histogram(worker, compact=True)
+    if histogram_text:
+        card_text += f"{histogram_text}\n"
+    card_text += "\n"
     card_text += f"📝 {description}\n\n"
-    
+    return card_text, photos_list
+
+
+def load_bid_worker_details(bid):
+    """Отклик из облегчённого списка, дополненный тяжёлыми полями мастера"""
+    details = db.get_bid_worker_details(bid['worker_id'])
+    return {**bid, **dict(details)} if details else bid
+
+
+def render_bid_worker_card(bid):
+    """
+    Блоки карточки отклика, которые зависят только от мастера.
+
+    Returns:
+        tuple: (блок с рейтингом и данными мастера, блок "О мастере",
+                file_id фото или None, есть ли фото в портфолио)
+    """
+    text = f"👤 <b>{bid['worker_name']}</b>\n"
+
+    # Рейтинг
+    rating = bid.get('worker_rating', 0)
+    rating_count = bid.get('worker_rating_count', 0)
+    if rating > 0:
+        stars = "⭐" * int(rating)
+        text += f"{stars} {rating:.1f} ({rating_count} отзывов)\n"
+    else:
+        text += "⭐ Новый мастер (пока нет отзывов)\n"
+
+    # Проверенные отзывы
+    verified_reviews = bid.get('worker_verified_reviews', 0)
+    if verified_reviews > 0:
+        text += f"✅ {verified_reviews} проверенных отзывов\n"
+
+    # Опыт
+    experience = bid.get('worker_experience', '')
+    if experience:
+        text += f"📅 Опыт: {experience}\n"
+
+    # Город
+    city = bid.get('worker_city', '')
+    if city:
+        text += f"📍 Город: {city}\n"
+
+    # Категории
+    categories = bid.get('worker_categories', '')
+    if categories:
+        text += f"🔧 Услуги: {categories}\n"
+
+    text += "\n"
+
+    # Описание мастера
+    about = ""
+    description = bid.get('worker_description', '')
+    if description:
+        if len(description) > 200:
+            description = description[:200] + "..."
+        about = f"📝 <b>О мастере:</b>\n{description}\n\n"
+
+    # Фото профиля мастера, иначе первое фото портфолио
+    profile_photo = bid.get('worker_profile_photo', '')
+    portfolio_photos = bid.get('worker_portfolio_photos', '')
+    first_portfolio_photo = next((p.strip() for p in portfolio_photos.split(',') if p.strip()), None) if portfolio_photos else None
+    photo_to_show = profile_photo if profile_photo else first_portfolio_photo
+
+    return text, about, photo_to_show, first_portfolio_photo is not None
+
+
+def browse_card_parts(worker):
+    """Текст карточки и фото мастера из кэша карточек"""
+    return worker_card_cache.get_or_render(
+        worker.get("id"), worker.get("profile_version"), "browse",
+        lambda: render_browse_card(worker),
+    )
+
+
+def build_worker_card_screen(workers_list, worker_index, photo_index, has_more=False):
+    """
+    Собирает экран карточки мастера при просмотре клиентом.
+
+    has_more - после текущей страницы есть ещё мастера.
+
+    Returns:
+        tuple: (InputMediaPhoto или None, текст карточки, клавиатура)
+    """
+    worker = workers_list[worker_index]
+
+    # НОВОЕ: Часть карточки, зависящая только от мастера, - из кэша по версии профиля
+    card_text, photos_list = browse_card_parts(worker)
+
     if photos_list:
         card_text += f"📸 Фото работ: {photo_index + 1}/{len(photos_list)}"
     else:
         card_text += "📸 Нет фото работ"
-    
+
     # Кнопки навигации
     keyboard = []
-    
+
     # Навигация по фото
     if photos_list and len(photos_list) > 1:
         photo_nav = []
@@ -7922,50 +8216,112 @@ async def show_worker_card(query_or_message, context: ContextTypes.DEFAULT_TYPE,
             photo_nav.append(InlineKeyboardButton("⬅️ Фото", callback_data="browse_photo_prev"))
         if photo_index < len(photos_list) - 1:
             photo_nav.append(InlineKeyboardButton("Фото ➡️", callback_data="browse_photo_next"))
-        
+
         if photo_nav:
             keyboard.append(photo_nav)
-    
+
     # Действия с мастером
     keyboard.append([
         InlineKeyboardButton("💬 Написать", url=f"tg://user?id={worker.get('telegram_id')}")
     ])
-    
+
     # Навигация по мастерам
     nav_buttons = []
-    if worker_index < len(workers_list) - 1:
+    if worker_index < len(workers_list) - 1 or has_more:
         nav_buttons.append(InlineKeyboardButton("➡️ Следующий мастер", callback_data="browse_next_worker"))
-    
+
     if nav_buttons:
         keyboard.append(nav_buttons)
-    
+
     keyboard.append([InlineKeyboardButton("⬅️ Назад в меню", callback_data="show_client_menu")])
-    
-    # Отправляем карточку
+
+    media = None
     if photos_list:
-        # Отправляем фото
-        current_photo = photos_list[photo_index]
+        media = InputMediaPhoto(media=photos_list[photo_index], caption=card_text, parse_mode="HTML")
+    return media, card_text, InlineKeyboardMarkup(keyboard)
+
+
+def browse_screen_key(workers_list, worker_index, photo_index):
+    """Ключ предзагруженного экрана карточки (id мастера защищает от смены списка)"""
+    return ("browse", workers_list[worker_index].get("id"), worker_index, photo_index)
+
+
+async def show_worker_card(query_or_message, context: ContextTypes.DEFAULT_TYPE, edit=False):
+    """
+    Показывает карточку мастера.
+
+    НОВОЕ: Экран берётся из предзагрузки, если он уже собран; после показа
+    в фоне собираются следующий мастер и следующее фото.
+    """
+    
+    workers_list = context.user_data.get("workers_list", [])
+    worker_index = context.user_data.get("current_worker_index", 0)
+    photo_index = context.user_data.get("current_photo_index", 0)
+    has_more = context.user_data.get("browse_has_more", False)
+    
+    if worker_index >= len(workers_list):
+        # Все мастера просмотрены
+        keyboard = [
+            [InlineKeyboardButton("🔄 Начать сначала", callback_data="browse_restart")],
+            [InlineKeyboardButton("⬅️ Назад в меню", callback_data="show_client_menu")],
+        ]
         
-        if edit and hasattr(query_or_message, 'message'):
-            # Удаляем старое сообщение и отправляем новое с фото
-            try:
-                await query_or_message.message.delete()
-            except:
-                pass
-            
-            await query_or_message.message.reply_photo(
-                photo=current_photo,
-                caption=card_text,
+        text = (
+            "✅ <b>Вы просмотрели всех мастеров!</b>\n\n"
+            "Можете начать сначала или вернуться в меню."
+        )
+        
+        if hasattr(query_or_message, 'edit_message_text'):
+            await query_or_message.edit_message_text(
+                text,
                 parse_mode="HTML",
                 reply_markup=InlineKeyboardMarkup(keyboard)
             )
+        else:
+            await query_or_message.reply_text(
+                text,
+                parse_mode="HTML",
+                reply_markup=InlineKeyboardMarkup(keyboard)
+            )
+        return
+    
+    screen = take_prefetched(context, browse_screen_key(workers_list, worker_index, photo_index))
+    if screen is None:
+        screen = build_worker_card_screen(workers_list, worker_index, photo_index, has_more)
+    media, card_text, reply_markup = screen
+    
+    # Отправляем карточку
+    if media:
+        if edit and hasattr(query_or_message, 'message'):
+            edited = False
+            # НОВОЕ: На экране уже фото - заменяем его одним edit_message_media
+            if query_or_message.message.photo:
+                try:
+                    await query_or_message.edit_message_media(media=media, reply_markup=reply_markup)
+                    edited = True
+                except Exception as e:
+                    logger.warning(f"Не удалось заменить фото карточки мастера: {e}")
+
+            if not edited:
+                # Удаляем старое сообщение и отправляем новое с фото
+                try:
+                    await query_or_message.message.delete()
+                except:
+                    pass
+
+                await query_or_message.message.reply_photo(
+                    photo=media.media,
+                    caption=card_text,
+                    parse_mode="HTML",
+                    reply_markup=reply_markup
+                )
         else:
             # Просто отправляем фото
             await query_or_message.reply_photo(
-                photo=current_photo,
+                photo=media.media,
                 caption=card_text,
                 parse_mode="HTML",
-                reply_markup=InlineKeyboardMarkup(keyboard)
+                reply_markup=reply_markup
             )
     else:
         # Нет фото - отправляем только текст
@@ -7973,23 +8329,42 @@ async def show_worker_card(query_or_message, context: ContextTypes.DEFAULT_TYPE,
             await query_or_message.edit_message_text(
                 card_text,
                 parse_mode="HTML",
-                reply_markup=InlineKeyboardMarkup(keyboard)
+                reply_markup=reply_markup
             )
         else:
             await query_or_message.reply_text(
                 card_text,
                 parse_mode="HTML",
-                reply_markup=InlineKeyboardMarkup(keyboard)
+                reply_markup=reply_markup
             )
 
+    # Предзагрузка: следующий мастер и следующее фото текущего мастера
+    next_screens = {}
+    if worker_index + 1 < len(workers_list):
+        next_screens[browse_screen_key(workers_list, worker_index + 1, 0)] = (
+            lambda: build_worker_card_screen(workers_list, worker_index + 1, 0, has_more)
+        )
+    if photo_index + 1 < len(browse_card_parts(workers_list[worker_index])[1]):
+        next_screens[browse_screen_key(workers_list, worker_index, photo_index + 1)] = (
+            lambda: build_worker_card_screen(workers_list, worker_index, photo_index + 1, has_more)
+        )
+    schedule_prefetch(context, next_screens)
+
 
 async def browse_next_worker(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Переключение на следующего мастера"""
     query = update.callback_query
     await query.answer()
     
-    context.user_data["current_worker_index"] = context.user_data.get("current_worker_index", 0) + 1
-    context.user_data["current_photo_index"] = 0  # Сбрасываем индекс фото
+    workers_list = context.user_data.get("workers_list", [])
+    next_index = context.user_data.get("current_worker_index", 0) + 1
+    
+    # НОВОЕ: Страница закончилась - загружаем следующую после последнего мастера
+    if next_index >= len(workers_list) and context.user_data.get("browse_has_more") and workers_list:
+        load_browse_page(context, after=context.user_data.get("browse_after"))
+    else:
+        context.user_data["current_worker_index"] = next_index
+        context.user_data["current_photo_index"] = 0  # Сбрасываем индекс фото
     
     await show_worker_card(query, context, edit=True)
 
@@ -8013,8 +8388,7 @@ async def browse_photo_next(update: Update, context: ContextTypes.DEFAULT_TYPE):
     worker_index = context.user_data.get("current_worker_index", 0)
     
     if worker_index < len(workers_list):
-        worker = workers_list[worker_index]
-        photos_list = [p for p in worker.get("portfolio_photos", "").split(",") if p]
+        _, photos_list = browse_card_parts(workers_list[worker_index])
         
         current_photo_index = context.user_data.get("current_photo_index", 0)
         context.user_data["current_photo_index"] = min(len(photos_list) - 1, current_photo_index + 1)
@@ -8027,8 +8401,8 @@ async def browse_restart(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     
-    context.user_data["current_worker_index"] = 0
-    context.user_data["current_photo_index"] = 0
+    # НОВОЕ: Заново с первой страницы рейтинга
+    load_browse_page(context)
     
     await show_worker_card(query, context, edit=True)
 
@@ -8846,17 +9220,64 @@ async def create_order_photo_upload(update: Update, context: ContextTypes.DEFAUL
 
 async def create_order_done_uploading(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Завершение загрузки фото и видео по команде /done"""
-    return await create_order_publish(update, context)
+    return await create_order_ask_deadline(update, context)
 
 
 async def create_order_skip_photos(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Пропуск загрузки фото и видео"""
-    query = update.callback_query
-    await query.answer()
-
     context.user_data["order_photos"] = []
     context.user_data["order_videos"] = []
 
+    return await create_order_ask_deadline(update, context)
+
+
+# НОВОЕ: Шаг выбора срока актуальности заказа (отдельное значение, не из range(50))
+CREATE_ORDER_DEADLINE = 111
+
+# (дней, подпись кнопки)
+ORDER_DEADLINE_OPTIONS = [
+    (1, "1 день"),
+    (3, "3 дня"),
+    (7, "7 дней"),
+    (14, "14 дней"),
+    (30, "30 дней"),
+]
+
+
+async def create_order_ask_deadline(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """НОВОЕ: Предлагает клиенту выбрать срок актуальности заказа перед публикацией"""
+    if update.callback_query:
+        query = update.callback_query
+        await query.answer()
+        message = query.message
+    else:
+        message = update.message
+
+    keyboard = [
+        [InlineKeyboardButton(f"⏳ {label}", callback_data=f"order_deadline_{days}")]
+        for days, label in ORDER_DEADLINE_OPTIONS
+    ]
+    keyboard.append([InlineKeyboardButton("♾ Без срока", callback_data="order_deadline_none")])
+
+    await message.reply_text(
+        "⏳ <b>Шаг 5:</b> Сколько времени заказ будет актуален?\n\n"
+        "Когда срок истечёт, заказ автоматически закроется, "
+        "а вы и откликнувшиеся мастера получите уведомление.",
+        parse_mode="HTML",
+        reply_markup=InlineKeyboardMarkup(keyboard)
+    )
+    return CREATE_ORDER_DEADLINE
+
+
+async def create_order_deadline_select(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """НОВОЕ: Сохраняет выбранный срок и публикует заказ"""
+    value = update.callback_query.data.replace("order_deadline_", "")
+
+    if value == "none":
+        context.user_data["order_deadline"] = None
+    else:
+        context.user_data["order_deadline"] = datetime.now() + timedelta(days=int(value))
+
     return await create_order_publish(update, context)
 
 
@@ -9054,7 +9475,8 @@ async def create_order_publish(update: Update, context: ContextTypes.DEFAULT_TYP
                 categories=context.user_data["order_category"],
                 description=context.user_data["order_description"],
                 photos=valid_order_photos,
-                videos=valid_order_videos
+                videos=valid_order_videos,
+                deadline=context.user_data.get("order_deadline")
             )
         except ValueError as e:
             # Rate limiting error
@@ -9068,6 +9490,11 @@ async def create_order_publish(update: Update, context: ContextTypes.DEFAULT_TYP
 
         logger.info(f"✅ Заказ #{order_id} успешно сохранён в БД!")
 
+        # НОВОЕ: Ставим заказ в планировщик дедлайнов
+        order_deadline = context.user_data.get("order_deadline")
+        if order_deadline:
+            deadline_scheduler.add(order_id, order_deadline)
+
         # КРИТИЧНО: Логирование для диагностики уведомлений
         logger.info(f"🔔 НАЧИНАЮ ОТПРАВКУ УВЕДОМЛЕНИЙ для заказа #{order_id}")
 
@@ -9086,13 +9513,16 @@ async def create_order_publish(update: Update, context: ContextTypes.DEFAULT_TYP
             logger.info(f"📢 Найдено {len(workers)} мастеров для уведомления (город: {order_city}, категория: {category})")
 
             notified_count = 0
+            worker_users = db.get_users_by_ids([worker['user_id'] for worker in workers])
             for worker in workers:
                 worker_dict = dict(worker)
 
-                worker_user = db.get_user_by_id(worker_dict['user_id'])
+                worker_user = worker_users.get(worker_dict['user_id'])
                 if worker_user:
                     # Проверяем включены ли уведомления у мастера
-                    notifications_enabled = db.are_notifications_enabled(worker_dict['user_id'])
+                    # ИСПРАВЛЕНО: Флаг уже есть в строке get_all_workers (w.*) - без запроса на каждого мастера
+                    enabled_flag = worker_dict.get('notifications_enabled')
+                    notifications_enabled = bool(enabled_flag) if enabled_flag is not None else True
                     logger.info(f"🔔 Мастер {worker_dict['user_id']}: уведомления {'включены' if notifications_enabled else 'отключены'}")
 
                     if notifications_enabled:
@@ -9100,7 +9530,8 @@ async def create_order_publish(update: Update, context: ContextTypes.DEFAULT_TYP
                             context,
                             worker_user['telegram_id'],
                             worker_dict['user_id'],
-                            order_dict
+                            order_dict,
+                            notifications_enabled=notifications_enabled
                         )
                         notified_count += 1
 
@@ -9120,6 +9551,8 @@ async def create_order_publish(update: Update, context: ContextTypes.DEFAULT_TYP
             media_info += f"📸 Фото: {photos_count}\n"
         if videos_count > 0:
             media_info += f"🎥 Видео: {videos_count}\n"
+        if order_deadline:
+            media_info += f"⏳ Актуален до: {order_deadline.strftime('%d.%m.%Y %H:%M')}\n"
 
         await message.reply_text(
             "🎉 <b>Заказ опубликован!</b>\n\n"
@@ -9485,39 +9918,80 @@ async def cancel_review(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return ConversationHandler.END
 
 
+# Ширина полосы гистограммы оценок в символах
+RATING_HISTOGRAM_BAR_WIDTH = 8
+
+
+def format_rating_histogram(profile, compact=False):
+    """
+    НОВОЕ: Распределение оценок по гистограмме stars_1..stars_5 из строки профиля.
+    Строится без чтения отзывов. compact - одна строка для карточки мастера.
+
+    Returns:
+        str: Текст гистограммы или "" если отзывов нет
+    """
+    counts = {stars: profile.get(f"stars_{stars}") or 0 for stars in db.RATING_STARS}
+    top = max(counts.values())
+    if not top:
+        return ""
+
+    if compact:
+        return " · ".join(f"{stars}⭐ {counts[stars]}" for stars in reversed(db.RATING_STARS) if counts[stars])
+
+    lines = []
+    for stars in reversed(db.RATING_STARS):
+        filled = round(counts[stars] / top * RATING_HISTOGRAM_BAR_WIDTH)
+        bar = "█" * filled + "░" * (RATING_HISTOGRAM_BAR_WIDTH - filled)
+        lines.append(f"{stars}⭐ {bar} {counts[stars]}")
+    return "\n".join(lines)
+
+
 async def show_reviews(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Показывает все отзывы о пользователе"""
+    """
+    Показывает отзывы о пользователе.
+
+    ИСПРАВЛЕНО: Постранично (keyset по последнему показанному отзыву) вместо
+    загрузки всех отзывов; сводка оценок берётся из гистограммы профиля.
+    """
     query = update.callback_query
     await query.answer()
 
     try:
-        # Извлекаем user_id из callback_data (формат: show_reviews_worker_123 или show_reviews_client_123)
+        # Формат: show_reviews_worker_123 или show_reviews_client_123,
+        # следующая страница - show_reviews_worker_123_<id последнего отзыва>
         parts = query.data.split("_")
         role = parts[2]  # worker или client
         profile_user_id = int(parts[3])
+        after_review_id = int(parts[4]) if len(parts) > 4 else None
 
-        logger.info(f"Показываю отзывы для user_id={profile_user_id}, role={role}")
+        logger.info(f"Показываю отзывы для user_id={profile_user_id}, role={role}, после отзыва {after_review_id}")
 
         # Получаем текущего пользователя для проверки, смотрит ли он свой профиль
-        current_user = db.get_user(query.from_user.id)
+        current_user = context.loader.get_user(query.from_user.id)
         is_own_profile = False
         if current_user:
             current_user_dict = dict(current_user)
             is_own_profile = (current_user_dict['id'] == profile_user_id)
 
-        # Получаем отзывы
-        reviews = db.get_reviews_for_user(profile_user_id, role)
-        logger.info(f"Найдено {len(reviews) if reviews else 0} отзывов")
+        # Определяем callback для кнопки "Назад"
+        if is_own_profile:
+            # Если смотрим свой профиль - возврат в меню
+            back_callback = "show_worker_menu" if role == "worker" else "show_client_menu"
+        else:
+            # Если смотрим чужой профиль - возврат в профиль
+            back_callback = "worker_profile" if role == "worker" else "show_client_menu"
+
+        # Страница + 1 отзыв: признак, что есть следующая страница
+        reviews = db.get_reviews_for_user(
+            profile_user_id, role,
+            limit=db.REVIEWS_PAGE_SIZE + 1,
+            after_review_id=after_review_id,
+        )
+        has_more = len(reviews) > db.REVIEWS_PAGE_SIZE
+        reviews = reviews[:db.REVIEWS_PAGE_SIZE]
+        logger.info(f"Загружено {len(reviews)} отзывов, есть ещё: {has_more}")
 
         if not reviews:
-            # Определяем callback для кнопки "Назад"
-            if is_own_profile:
-                # Если смотрим свой профиль - возврат в меню
-                back_callback = "show_worker_menu" if role == "worker" else "show_client_menu"
-            else:
-                # Если смотрим чужой профиль - возврат в профиль
-                back_callback = "worker_profile" if role == "worker" else "show_client_menu"
-
             await safe_edit_message(
                 query,
                 "📊 <b>Отзывы</b>\n\n"
@@ -9529,43 +10003,54 @@ async def show_reviews(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
             return
 
+        # Сводка по оценкам - из агрегатов профиля, без подсчёта отзывов
+        if role == "worker":
+            profile = context.loader.get_worker_profile(profile_user_id)
+        else:
+            profile = context.loader.get_client_profile(profile_user_id)
+        profile_dict = dict(profile) if profile else {}
+        total_reviews = sum(profile_dict.get(f"stars_{stars}") or 0 for stars in db.RATING_STARS)
+
         # Формируем текст с отзывами
         message_text = "📊 <b>Отзывы</b>\n\n"
+        if total_reviews:
+            message_text += f"⭐ {profile_dict.get('rating') or 0:.1f}/5.0 · всего отзывов: {total_reviews}\n"
+            message_text += f"{format_rating_histogram(profile_dict)}\n\n"
 
-        for review in reviews[:10]:  # Показываем первые 10 отзывов
+        for review in reviews:
             review_dict = dict(review)
             rating = review_dict['rating']
             stars = "⭐" * rating
-            reviewer_name = review_dict.get('reviewer_name', 'Аноним')
+            reviewer_name = review_dict.get('reviewer_name') or 'Аноним'
             comment = review_dict.get('comment', '')
 
-            message_text += f"👤 <b>{reviewer_name}</b>\n"
+            message_text += f"👤 <b>{html.escape(reviewer_name)}</b>\n"
             message_text += f"{stars} ({rating}/5)\n"
             if comment:
                 # Обрезаем длинные комментарии
                 if len(comment) > 150:
                     comment = comment[:150] + "..."
-                message_text += f"💬 {comment}\n"
+                message_text += f"💬 {html.escape(comment)}\n"
             message_text += "\n"
 
-        if len(reviews) > 10:
-            message_text += f"<i>Показано 10 из {len(reviews)} отзывов</i>\n"
-
-        # Определяем callback для кнопки "Назад"
-        if is_own_profile:
-            # Если смотрим свой профиль - возврат в меню
-            back_callback = "show_worker_menu" if role == "worker" else "show_client_menu"
-        else:
-            # Если смотрим чужой профиль - возврат в профиль
-            back_callback = "worker_profile" if role == "worker" else "show_client_menu"
+        keyboard = []
+        navigation = []
+        if after_review_id is not None:
+            navigation.append(InlineKeyboardButton("⏮ В начало", callback_data=f"show_reviews_{role}_{profile_user_id}"))
+        if has_more:
+            last_review_id = dict(reviews[-1])['id']
+            navigation.append(InlineKeyboardButton(
+                "➡️ Ещё отзывы", callback_data=f"show_reviews_{role}_{profile_user_id}_{last_review_id}"
+            ))
+        if navigation:
+            keyboard.append(navigation)
+        keyboard.append([InlineKeyboardButton("⬅️ Назад", callback_data=back_callback)])
 
         await safe_edit_message(
             query,
             message_text,
             parse_mode="HTML",
-            reply_markup=InlineKeyboardMarkup([[
-                InlineKeyboardButton("⬅️ Назад", callback_data=back_callback)
-            ]])
+            reply_markup=InlineKeyboardMarkup(keyboard)
         )
 
     except Exception as e:
@@ -9613,19 +10098,22 @@ def declension_bids(count):
         return "новых откликов"
 
 
-async def notify_worker_new_order(context, worker_telegram_id, worker_user_id, order_dict):
+async def notify_worker_new_order(context, worker_telegram_id, worker_user_id, order_dict, notifications_enabled=None):
     """
     Уведомление мастеру о новом заказе - ОБНОВЛЯЕТ существующее сообщение.
     Вместо спама отдельными сообщениями показывает одно обновляемое сообщение с количеством.
+    notifications_enabled - уже известный флаг мастера (None - прочитать из БД).
     """
     try:
         # Проверяем включены ли уведомления у мастера
-        if not db.are_notifications_enabled(worker_user_id):
+        if notifications_enabled is None:
+            notifications_enabled = db.are_notifications_enabled(worker_user_id)
+        if not notifications_enabled:
             logger.info(f"Уведомления отключены для мастера {worker_user_id}, пропускаем отправку")
             return False
 
-        # Подсчитываем все доступные заказы для этого мастера
-        available_orders_count = db.count_available_orders_for_worker(worker_user_id)
+        # ИСПРАВЛЕНО: Берём готовый счётчик вместо пересчёта JOIN на каждое уведомление
+        available_orders_count = db.get_available_orders_count(worker_user_id)
 
         text = (
             f"🔔 <b>У вас {available_orders_count} {declension_orders(available_orders_count)}!</b>\n\n"
@@ -9673,6 +10161,245 @@ async def notify_worker_new_order(context, worker_telegram_id, worker_user_id, o
         return False
 
 
+async def notify_expired_orders(context, expired_orders):
+    """
+    НОВОЕ: Уведомляет клиентов и откликнувшихся мастеров об истёкших заказах.
+    telegram_id получателей приходят из db.check_expired_orders - без доп. запросов.
+    """
+    for order_data in expired_orders:
+        order_id = order_data['order_id']
+        title = order_data['title']
+
+        # Уведомляем клиента
+        try:
+            await context.bot.send_message(
+                chat_id=order_data['client_telegram_id'],
+                text=f"⏰ Заказ #{order_id} истёк по дедлайну\n\n"
+                     f"📝 {title}\n\n"
+                     f"Заказ автоматически закрыт, так как прошёл указанный срок выполнения."
+            )
+            logger.info(f"✅ Уведомление клиента {order_data['client_user_id']} отправлено")
+        except Exception as e:
+            logger.error(f"❌ Ошибка отправки уведомления клиенту {order_data['client_user_id']}: {e}")
+
+        # Уведомляем мастеров
+        for worker_user_id, worker_telegram_id in zip(order_data['worker_user_ids'], order_data['worker_telegram_ids']):
+            try:
+                await context.bot.send_message(
+                    chat_id=worker_telegram_id,
+                    text=f"⏰ Заказ #{order_id} истёк по дедлайну\n\n"
+                         f"📝 {title}\n\n"
+                         f"Заказ автоматически закрыт."
+                )
+            except Exception as e:
+                logger.error(f"❌ Ошибка отправки уведомления мастеру {worker_user_id}: {e}")
+
+
+class DeadlineScheduler:
+    """
+    НОВОЕ: In-process планировщик дедлайнов заказов на куче (heapq).
+
+    Вместо ежечасного полного сканирования держит один отложенный job JobQueue
+    на ближайший дедлайн. При срабатывании истекает пачку наступивших дедлайнов
+    (db.check_expired_orders) и перевзводится на следующий. При старте бота
+    куча восстанавливается из БД; просроченные за время простоя заказы
+    обрабатываются сразу.
+    """
+
+    JOB_NAME = "order_deadlines"
+
+    def __init__(self):
+        self._heap = []  # [(deadline: datetime, order_id)]
+        self._job = None
+        self._job_due = None
+        self._job_queue = None
+
+    def start(self, job_queue):
+        """Восстанавливает кучу из БД и взводит таймер. Возвращает число дедлайнов."""
+        self._job_queue = job_queue
+        self._heap = [(deadline, order_id) for order_id, deadline in db.get_pending_order_deadlines()]
+        heapq.heapify(self._heap)
+        self._arm()
+        return len(self._heap)
+
+    def add(self, order_id, deadline):
+        """Добавляет дедлайн заказа; перевзводит таймер, если он стал ближайшим"""
+        heapq.heappush(self._heap, (deadline, order_id))
+        if self._job_due is None or deadline < self._job_due:
+            self._arm()
+
+    def _arm(self):
+        if self._job_queue is None:
+            return
+
+        if self._job is not None:
+            self._job.schedule_removal()
+            self._job = None
+            self._job_due = None
+
+        if not self._heap:
+            return
+
+        due = self._heap[0][0]
+        delay = max((due - datetime.now()).total_seconds(), 0)
+        self._job = self._job_queue.run_once(self._fire, when=delay, name=self.JOB_NAME)
+        self._job_due = due
+
+    @metrics.timed_job("order_deadlines")
+    async def _fire(self, context):
+        self._job = None
+        self._job_due = None
+
+        now = datetime.now()
+        due_entries = []
+        while self._heap and self._heap[0][0] <= now:
+            due_entries.append(heapq.heappop(self._heap))
+
+        if due_entries:
+            try:
+                expired_orders = db.check_expired_orders(order_ids=[order_id for _, order_id in due_entries])
+                if expired_orders:
+                    logger.info(f"📋 Истекло заказов по дедлайну: {len(expired_orders)}")
+                    await notify_expired_orders(context, expired_orders)
+            except Exception as e:
+                logger.error(f"❌ Ошибка обработки дедлайнов заказов: {e}", exc_info=True)
+                # Возвращаем дедлайны в кучу - повторим через минуту
+                retry_at = now + timedelta(minutes=1)
+                for _, order_id in due_entries:
+                    heapq.heappush(self._heap, (retry_at, order_id))
+
+        self._arm()
+
+
+# Глобальный планировщик дедлайнов заказов
+deadline_scheduler = DeadlineScheduler()
+
+
+# Лимит отправки фоновых уведомлений (Telegram допускает ~30 сообщений/сек на бота)
+NOTIFICATION_QUEUE_RATE_PER_SECOND = 20
+
+
+class NotificationQueue:
+    """
+    НОВОЕ: Очередь фоновых уведомлений с ограничением скорости отправки.
+
+    Фоновые задачи кладут сообщения в очередь и не ждут отправки; одна
+    корутина-отправщик разбирает очередь не быстрее rate_per_second,
+    чтобы массовая рассылка не упиралась в flood-лимиты Telegram.
+    """
+
+    def __init__(self, rate_per_second=NOTIFICATION_QUEUE_RATE_PER_SECOND):
+        self._interval = 1.0 / rate_per_second
+        self._queue = asyncio.Queue()
+        self._worker = None
+
+    def enqueue(self, application, chat_id, text, **kwargs):
+        """Ставит сообщение в очередь и при необходимости запускает отправщика"""
+        self._queue.put_nowait((chat_id, text, kwargs))
+        if self._worker is None or self._worker.done():
+            self._worker = application.create_task(self._drain(application.bot))
+
+    @property
+    def pending(self):
+        return self._queue.qsize()
+
+    async def _drain(self, bot):
+        while not self._queue.empty():
+            chat_id, text, kwargs = self._queue.get_nowait()
+            try:
+                await bot.send_message(chat_id=chat_id, text=text, **kwargs)
+            except Exception as e:
+                logger.warning(f"Не удалось отправить уведомление {chat_id}: {e}")
+            await asyncio.sleep(self._interval)
+
+
+# Глобальная очередь фоновых уведомлений
+notification_queue = NotificationQueue()
+
+# Параметры фоновой очистки чатов, где мастер не ответил
+EXPIRED_CHATS_HOURS = 24
+EXPIRED_CHATS_BATCH_SIZE = 100
+EXPIRED_CHATS_MAX_BATCHES = 10  # Не более 1000 чатов за один запуск, остальное - в следующий
+
+
+def _enqueue_expired_chat_notifications(application, chat):
+    """Ставит в очередь уведомления клиенту и мастеру об истёкшем чате"""
+    notification_queue.enqueue(
+        application,
+        chat['client_telegram_id'],
+        f"⚠️ <b>Мастер не ответил в течение 24 часов</b>\n\n"
+        f"📋 Заказ: {chat['order_title']}\n\n"
+        f"Ваш заказ снова открыт для выбора другого мастера.\n"
+        f"💰 Дополнительная оплата НЕ требуется - ваша предыдущая оплата остается активной.\n\n"
+        f"Просто выберите другого мастера из списка откликов.",
+        parse_mode="HTML",
+        reply_markup=InlineKeyboardMarkup([[
+            InlineKeyboardButton("📋 Мои заказы", callback_data="client_my_orders")
+        ]])
+    )
+    notification_queue.enqueue(
+        application,
+        chat['worker_telegram_id'],
+        f"⚠️ <b>Ваш рейтинг снижен!</b>\n\n"
+        f"📋 Заказ: {chat['order_title']}\n\n"
+        f"Вы не ответили клиенту в течение 24 часов после того, как ваш отклик был выбран.\n"
+        f"📉 Ваш рейтинг был снижен.\n\n"
+        f"⚡ <b>Совет:</b> Отвечайте клиентам быстрее, чтобы поддерживать высокий рейтинг!",
+        parse_mode="HTML"
+    )
+
+
+async def sweep_expired_chats(application):
+    """
+    НОВОЕ: Обрабатывает чаты, где мастер не ответил, ограниченными пачками.
+
+    Каждая пачка - один SELECT с telegram_id участников и одна транзакция
+    mark_chat_as_expired; уведомления уходят через notification_queue.
+
+    Returns:
+        dict: {'processed', 'batches', 'backlog', 'duration'}
+    """
+    started_at = datetime.now()
+    processed = 0
+    batches = 0
+
+    while batches < EXPIRED_CHATS_MAX_BATCHES:
+        chats = db.get_expired_chats(hours=EXPIRED_CHATS_HOURS, limit=EXPIRED_CHATS_BATCH_SIZE)
+        if not chats:
+            break
+        batches += 1
+
+        expired_ids = set(db.mark_chat_as_expired([chat['id'] for chat in chats]))
+        for chat in chats:
+            if chat['id'] in expired_ids:
+                _enqueue_expired_chat_notifications(application, chat)
+                logger.info(f"Обработан просроченный чат {chat['id']} (заказ {chat['order_id']})")
+        processed += len(expired_ids)
+
+        if len(chats) < EXPIRED_CHATS_BATCH_SIZE:
+            break
+
+    backlog = db.count_expired_chats(hours=EXPIRED_CHATS_HOURS)
+    duration = (datetime.now() - started_at).total_seconds()
+
+    stats = {'processed': processed, 'batches': batches, 'backlog': backlog, 'duration': duration}
+    if processed or backlog:
+        logger.info(
+            f"🧹 Очистка просроченных чатов: обработано {processed} за {batches} пачек, "
+            f"{duration:.2f} сек, осталось {backlog}, в очереди уведомлений {notification_queue.pending}"
+        )
+    return stats
+
+
+@metrics.timed_job("sweep_expired_chats")
+async def sweep_expired_chats_job(context):
+    """НОВОЕ: Периодическая фоновая очистка просроченных чатов"""
+    try:
+        await sweep_expired_chats(context.application)
+    except Exception as e:
+        logger.error(f"❌ Ошибка фоновой очистки просроченных чатов: {e}", exc_info=True)
+
+
 async def notify_client_new_bid(context, client_telegram_id, client_user_id, order_id, worker_name, price, currency):
     """
     Уведомление клиенту о новом отклике - ОБНОВЛЯЕТ существующее сообщение.
@@ -10181,104 +10908,97 @@ async def check_expired_chats_command(update: Update, context: ContextTypes.DEFA
         await update.message.reply_text("❌ У вас нет прав администратора.")
         return
 
-    # Получаем все просроченные чаты (где мастер не ответил в течение 24 часов)
-    expired_chats = db.get_expired_chats(hours=24)
+    # ИСПРАВЛЕНО: Та же пакетная обработка, что и в фоновой задаче sweep_expired_chats_job
+    backlog = db.count_expired_chats(hours=EXPIRED_CHATS_HOURS)
 
-    if not expired_chats:
+    if not backlog:
         await update.message.reply_text("✅ Нет просроченных чатов (все мастера отвечают вовремя).")
         return
 
     await update.message.reply_text(
-        f"🔍 Найдено просроченных чатов: {len(expired_chats)}\n"
+        f"🔍 Найдено просроченных чатов: {backlog}\n"
         f"Начинаю обработку...",
         parse_mode="HTML"
     )
 
-    processed_count = 0
-    error_count = 0
+    stats = await sweep_expired_chats(context.application)
 
-    for chat in expired_chats:
-        try:
-            chat_id = chat['id']
-            order_id = chat['order_id']
-            client_user_id = chat['client_user_id']
-            worker_user_id = chat['worker_user_id']
-            bid_id = chat['bid_id']
-
-            # Получаем информацию о заказе
-            order = db.get_order_by_id(order_id)
-            if not order:
-                logger.warning(f"Заказ {order_id} не найден для чата {chat_id}")
-                error_count += 1
-                continue
+    # Отчет о проверке
+    await update.message.reply_text(
+        f"✅ <b>Проверка завершена!</b>\n\n"
+        f"✅ Обработано: {stats['processed']}\n"
+        f"⏱ Время: {stats['duration']:.2f} сек\n"
+        f"📬 Уведомлений в очереди: {notification_queue.pending}\n"
+        f"📊 Осталось необработанных: {stats['backlog']}",
+        parse_mode="HTML"
+    )
 
-            # Получаем информацию о клиенте и мастере
-            client = db.get_user_by_id(client_user_id)
-            worker_user = db.get_user_by_id(worker_user_id)
 
-            if not client or not worker_user:
-                logger.warning(f"Пользователи не найдены для чата {chat_id}")
-                error_count += 1
-                continue
+# Максимальная длина одного сообщения отчёта /slow_queries (лимит Telegram - 4096)
+SLOW_QUERIES_MESSAGE_LIMIT = 4000
 
-            # 1. Снижаем рейтинг мастера (добавляем негативную оценку 1.0 из 5.0)
-            db.update_user_rating(worker_user_id, 1.0, "worker")
 
-            # 2. Возвращаем заказ в статус "open" (клиент может выбрать другого мастера)
-            db.update_order_status(order_id, "open")
+async def slow_queries_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    НОВОЕ: Команда /slow_queries [N] [reset] - топ-N SQL-запросов по суммарному времени.
+    Помогает находить регрессии в тяжёлых выборках (get_all_workers и т.п.).
+    """
+    if not db.is_admin(update.effective_user.id):
+        await update.message.reply_text("❌ У вас нет прав администратора.")
+        return
 
-            # 3. Отмечаем отклик как отклоненный (чтобы не показывался как выбранный)
-            # Но НЕ удаляем его - клиент может увидеть, что этот мастер не ответил
-            db.update_bid_status(bid_id, "rejected")
+    args = context.args or []
+    if "reset" in args:
+        db.reset_query_stats()
+        await update.message.reply_text("✅ Статистика запросов сброшена.")
+        return
 
-            # 4. Уведомляем клиента что мастер не ответил и он может выбрать другого БЕЗ доп. оплаты
-            try:
-                await context.bot.send_message(
-                    chat_id=client['telegram_id'],
-                    text=(
-                        f"⚠️ <b>Мастер не ответил в течение 24 часов</b>\n\n"
-                        f"📋 Заказ: {order['title']}\n\n"
-                        f"Ваш заказ снова открыт для выбора другого мастера.\n"
-                        f"💰 Дополнительная оплата НЕ требуется - ваша предыдущая оплата остается активной.\n\n"
-                        f"Просто выберите другого мастера из списка откликов."
-                    ),
-                    parse_mode="HTML",
-                    reply_markup=InlineKeyboardMarkup([[
-                        InlineKeyboardButton("📋 Мои заказы", callback_data="client_my_orders")
-                    ]])
-                )
-            except Exception as e:
-                logger.warning(f"Не удалось отправить уведомление клиенту {client['telegram_id']}: {e}")
+    limit = 10
+    if args and args[0].isdigit():
+        limit = max(1, min(int(args[0]), 30))
 
-            # 5. Уведомляем мастера о снижении рейтинга
-            try:
-                await context.bot.send_message(
-                    chat_id=worker_user['telegram_id'],
-                    text=(
-                        f"⚠️ <b>Ваш рейтинг снижен!</b>\n\n"
-                        f"📋 Заказ: {order['title']}\n\n"
-                        f"Вы не ответили клиенту в течение 24 часов после того, как ваш отклик был выбран.\n"
-                        f"📉 Ваш рейтинг был снижен.\n\n"
-                        f"⚡ <b>Совет:</b> Отвечайте клиентам быстрее, чтобы поддерживать высокий рейтинг!"
-                    ),
-                    parse_mode="HTML"
-                )
-            except Exception as e:
-                logger.warning(f"Не удалось отправить уведомление мастеру {worker_user['telegram_id']}: {e}")
+    report = db.get_slow_query_report(limit)
+    if not report:
+        await update.message.reply_text("📊 Статистика запросов пока пуста.")
+        return
 
-            processed_count += 1
-            logger.info(f"Обработан просроченный чат {chat_id} (заказ {order_id})")
+    lines = [f"📊 <b>Топ-{len(report)} запросов по суммарному времени</b>\n"]
+    for i, item in enumerate(report, 1):
+        avg_ms = item['total_time'] / item['calls'] * 1000
+        lines.append(
+            f"{i}. <b>{item['total_time']:.2f} сек</b> | {item['calls']} вызовов | "
+            f"сред. {avg_ms:.1f} мс | макс. {item['max_time'] * 1000:.1f} мс | медленных: {item['slow_calls']}"
+            f"{' | 📋 есть план' if item['plan'] else ''}\n"
+            f"<code>{html.escape(item['fingerprint'][:300])}</code>\n"
+        )
 
-        except Exception as e:
-            logger.error(f"Ошибка при обработке чата {chat.get('id', 'unknown')}: {e}")
-            error_count += 1
+    # ИСПРАВЛЕНО: Делим отчёт на сообщения по целым записям - обрезка посреди
+    # <code> или HTML-сущности ломает parse_mode="HTML"
+    chunks = [""]
+    for line in lines:
+        if chunks[-1] and len(chunks[-1]) + len(line) + 1 > SLOW_QUERIES_MESSAGE_LIMIT:
+            chunks.append("")
+        chunks[-1] += line + "\n"
 
-    # Отчет о проверке
+    for chunk in chunks:
+        await update.message.reply_text(chunk, parse_mode="HTML")
+
+
+async def rebuild_ratings_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    НОВОЕ: Команда /rebuild_ratings - пересчёт рейтингов всех мастеров и клиентов по отзывам.
+    Штрафы за просроченные чаты в отзывах не хранятся и после пересчёта сбрасываются.
+    """
+    if not db.is_admin(update.effective_user.id):
+        await update.message.reply_text("❌ У вас нет прав администратора.")
+        return
+
+    await update.message.reply_text("🔄 Пересчитываю рейтинги по отзывам...")
+    fixed = db.rebuild_all_ratings()
     await update.message.reply_text(
-        f"✅ <b>Проверка завершена!</b>\n\n"
-        f"✅ Обработано: {processed_count}\n"
-        f"❌ Ошибок: {error_count}\n"
-        f"📊 Всего найдено: {len(expired_chats)}",
+        f"✅ <b>Рейтинги пересчитаны!</b>\n\n"
+        f"🔧 Мастеров исправлено: {fixed['workers']}\n"
+        f"👤 Клиентов исправлено: {fixed['clients']}",
         parse_mode="HTML"
     )
 
@@ -10655,6 +11375,13 @@ async def admin_broadcast_send(update: Update, context: ContextTypes.DEFAULT_TYP
     sent_count = 0
     failed_count = 0
 
+    # Профили аудитории одним запросом вместо запроса на каждого пользователя
+    audience_profiles = None
+    if audience == 'workers':
+        audience_profiles = db.get_workers_by_ids([user['id'] for user in users], by_user_id=True)
+    elif audience == 'clients':
+        audience_profiles = db.get_clients_by_ids([user['id'] for user in users], by_user_id=True)
+
     # Фильтруем по аудитории и отправляем
     for user in users:
         user_dict = dict(user)
@@ -10664,14 +11391,8 @@ async def admin_broadcast_send(update: Update, context: ContextTypes.DEFAULT_TYP
             continue
 
         # Проверяем аудиторию
-        if audience == 'workers':
-            worker = db.get_worker_profile(user_dict['id'])
-            if not worker:
-                continue
-        elif audience == 'clients':
-            client = db.get_client_profile(user_dict['id'])
-            if not client:
-                continue
+        if audience_profiles is not None and user_dict['id'] not in audience_profiles:
+            continue
 
         # Отправляем сообщение
         try:
@@ -11573,7 +12294,7 @@ async def admin_users_list(update: Update, context: ContextTypes.DEFAULT_TYPE):
     keyboard = []
     for user in users:
         user_dict = dict(user)
-        name = user_dict.get('full_name', 'Без имени')
+        name = user_dict.get('full_name') or 'Без имени'
         telegram_id = user_dict['telegram_id']
 
         # Эмодзи статуса
@@ -11798,9 +12519,8 @@ async def admin_user_search_start(update: Update, context: ContextTypes.DEFAULT_
 
     text = "🔍 <b>ПОИСК ПОЛЬЗОВАТЕЛЯ</b>\n\n"
     text += "Введите для поиска:\n"
-    text += "• Telegram ID\n"
-    text += "• Имя пользователя\n"
-    text += "• Username (без @)\n\n"
+    text += "• Telegram ID (можно начало)\n"
+    text += "• Имя из профиля мастера или заказчика (можно начало слова)\n\n"
     text += "Или нажмите \"Отмена\":"
 
     keyboard = [[InlineKeyboardButton("❌ Отмена", callback_data="admin_users")]]
@@ -11821,7 +12541,7 @@ async def admin_user_search_execute(update: Update, context: ContextTypes.DEFAUL
     users = db.search_users(query_text, limit=10)
 
     if not users:
-        text = f"🔍 По запросу '<code>{query_text}</code>' ничего не найдено."
+        text = f"🔍 По запросу '<code>{html.escape(query_text)}</code>' ничего не найдено."
         keyboard = [[InlineKeyboardButton("🔍 Новый поиск", callback_data="admin_user_search_start")],
                     [InlineKeyboardButton("⬅️ Назад", callback_data="admin_users")]]
 
@@ -11832,13 +12552,13 @@ async def admin_user_search_execute(update: Update, context: ContextTypes.DEFAUL
         )
         return ADMIN_MENU
 
-    text = f"🔍 <b>Результаты поиска:</b> '<code>{query_text}</code>'\n\n"
+    text = f"🔍 <b>Результаты поиска:</b> '<code>{html.escape(query_text)}</code>'\n\n"
     text += f"Найдено пользователей: {len(users)}\n\n"
 
     keyboard = []
     for user in users:
         user_dict = dict(user)
-        name = user_dict.get('full_name', 'Без имени')
+        name = user_dict.get('full_name') or 'Без имени'
         telegram_id = user_dict['telegram_id']
 
         # Эмодзи статуса
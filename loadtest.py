@@ -0,0 +1,473 @@
+#!/usr/bin/env python3
+"""
+Нагрузочный тест бота без сети.
+
+Собирает то же Application, что и bot.main() (bot.build_application), но вместо
+Telegram Bot API подставляет FakeTelegramRequest: он отвечает на вызовы
+in-process, считает их и добавляет настраиваемую задержку. Синтетические
+пользователи проходят реальные сценарии через application.process_update:
+
+1. Регистрация мастеров и заказчиков
+2. Создание заказов (до create_order_publish)
+3. Отклики мастеров (до worker_bid_publish)
+4. Переписка в чате (handle_chat_message)
+5. Просмотр анкет мастеров (browse)
+
+В конце печатается p50/p95/p99 по обработчикам и апдейты в секунду.
+
+Запуск:
+    python loadtest.py --workers 200 --clients 200
+    DATABASE_URL=postgresql://localhost/remont_bench python loadtest.py --workers 1000 --clients 1000
+
+По умолчанию (SQLite) используется отдельный файл loadtest.db, который
+пересоздаётся при каждом запуске. Ключи: python loadtest.py --help
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import random
+import re
+import time
+from collections import defaultdict
+
+from telegram import Update
+from telegram.request import BaseRequest
+
+import bot
+import db
+import tracing
+
+logger = logging.getLogger("loadtest")
+
+FAKE_BOT_TOKEN = "123456:LOADTEST"
+FAKE_BOT_USER = {"id": 123456, "is_bot": True, "first_name": "LoadTest", "username": "loadtest_bot"}
+
+# Методы Bot API, которые возвращают Message
+MESSAGE_METHODS = {
+    "sendMessage", "sendPhoto", "sendVideo", "sendDocument", "sendAnimation",
+    "editMessageText", "editMessageCaption", "editMessageMedia", "editMessageReplyMarkup",
+    "forwardMessage",
+}
+
+# Все заказы и мастера в одном разделе, чтобы мастерам было на что откликаться
+LOADTEST_MAIN_CATEGORY = "urgent"
+
+# Первый telegram_id синтетических пользователей (далеко от реальных ID)
+FIRST_SYNTHETIC_TELEGRAM_ID = 9_000_000_000
+
+
+class FakeTelegramRequest(BaseRequest):
+    """
+    Транспорт Bot API без сети.
+
+    Отвечает на вызовы как Telegram, записывает их количество по методам и
+    запоминает inline-клавиатуры последних сообщений каждого чата, чтобы
+    синтетический пользователь мог «нажать» кнопку.
+    """
+
+    KEYBOARDS_PER_CHAT = 5
+
+    def __init__(self, latency=0.0, jitter=0.0):
+        self._latency = latency
+        self._jitter = jitter
+        self._message_ids = itertools.count(1)
+        self.calls = defaultdict(int)
+        self.keyboards = defaultdict(list)  # {chat_id: [(message_id, [callback_data, ...])]}
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None):
+        api_method = url.rsplit("/", 1)[-1]
+        params = request_data.parameters if request_data else {}
+        self.calls[api_method] += 1
+
+        started_at = time.perf_counter()
+        delay = self._latency + random.uniform(0, self._jitter)
+        if delay:
+            await asyncio.sleep(delay)
+        tracing.record_api_call(time.perf_counter() - started_at)
+
+        return 200, json.dumps({"ok": True, "result": self._result(api_method, params)}).encode()
+
+    def _result(self, api_method, params):
+        if api_method == "getMe":
+            return FAKE_BOT_USER
+        if api_method == "copyMessage":
+            return {"message_id": next(self._message_ids)}
+        if api_method == "sendMediaGroup":
+            return [self._message(params, media) for media in params.get("media", [])]
+        if api_method in MESSAGE_METHODS and "chat_id" in params:
+            return self._message(params)
+        return True
+
+    def _message(self, params, media=None):
+        chat_id = int(params["chat_id"])
+        message_id = int(params.get("message_id") or next(self._message_ids))
+        self._remember_keyboard(chat_id, message_id, params.get("reply_markup"))
+        text = params.get("text") or params.get("caption") or (media or {}).get("caption") or ""
+        return {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": FAKE_BOT_USER,
+            "text": text,
+        }
+
+    def _remember_keyboard(self, chat_id, message_id, reply_markup):
+        if isinstance(reply_markup, str):
+            reply_markup = json.loads(reply_markup)
+        buttons = [
+            button["callback_data"]
+            for row in (reply_markup or {}).get("inline_keyboard", [])
+            for button in row
+            if button.get("callback_data")
+        ]
+        keyboards = [entry for entry in self.keyboards[chat_id] if entry[0] != message_id]
+        if buttons:
+            keyboards.append((message_id, buttons))
+        self.keyboards[chat_id] = keyboards[-self.KEYBOARDS_PER_CHAT:]
+
+    def find_button(self, chat_id, pattern, pick_random=False):
+        """Ищет кнопку по регулярному выражению в последних сообщениях чата: (message_id, data) или None"""
+        regex = re.compile(pattern)
+        for message_id, buttons in reversed(self.keyboards[chat_id]):
+            matches = [data for data in buttons if regex.search(data)]
+            if matches:
+                return message_id, random.choice(matches) if pick_random else matches[0]
+        return None
+
+
+class FlowError(Exception):
+    """Сценарий не может продолжиться (нет нужной кнопки и т.п.)"""
+
+
+class SyntheticUser:
+    """Синтетический пользователь: отправляет апдейты в Application от своего имени"""
+
+    _update_ids = itertools.count(1)
+    _message_ids = itertools.count(1_000_000)
+
+    def __init__(self, application, request, telegram_id, name):
+        self.application = application
+        self.request = request
+        self.telegram_id = telegram_id
+        self.name = name
+
+    @property
+    def _user(self):
+        return {"id": self.telegram_id, "is_bot": False, "first_name": self.name}
+
+    def _message(self, text, message_id=None, from_user=None):
+        message = {
+            "message_id": message_id or next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": self.telegram_id, "type": "private"},
+            "from": from_user or self._user,
+            "text": text,
+        }
+        if text.startswith("/"):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        return message
+
+    async def _process(self, payload):
+        payload["update_id"] = next(self._update_ids)
+        await self.application.process_update(Update.de_json(payload, self.application.bot))
+
+    async def send_text(self, text):
+        await self._process({"message": self._message(text)})
+
+    async def press(self, data, message_id=None):
+        """Нажимает кнопку с заданным callback_data"""
+        await self._process({
+            "callback_query": {
+                "id": str(next(self._update_ids)),
+                "from": self._user,
+                "chat_instance": str(self.telegram_id),
+                "data": data,
+                "message": self._message("", message_id=message_id, from_user=FAKE_BOT_USER),
+            }
+        })
+
+    async def tap(self, pattern, pick_random=False):
+        """Нажимает кнопку, подходящую под pattern, из последних сообщений бота. Возвращает callback_data"""
+        found = self.request.find_button(self.telegram_id, pattern, pick_random)
+        if found is None:
+            raise FlowError(f"нет кнопки {pattern!r}")
+        message_id, data = found
+        await self.press(data, message_id=message_id)
+        return data
+
+
+# ------- СЦЕНАРИИ -------
+
+async def flow_register_worker(user, subcategory=None):
+    """subcategory - индекс подкатегории; по умолчанию случайная"""
+    await user.send_text("/start")
+    await user.tap(r"^select_role_worker$")
+    await user.send_text(user.name)
+    await user.send_text("+375 29 123 45 67")
+    await user.tap(r"^masterregion_Минск$")
+    await user.tap(r"^finish_cities$")
+    await user.tap(rf"^maincat_{LOADTEST_MAIN_CATEGORY}$")
+    if subcategory is None:
+        await user.tap(r"^subcat_\w+:\d+$", pick_random=True)
+    else:
+        await user.tap(rf"^subcat_\w+:{subcategory}$")
+    await user.tap(r"^subcat_done$")
+    await user.tap(r"^more_no$")
+    await user.tap(r"^exp_", pick_random=True)
+    await user.send_text("Работаю аккуратно, выезжаю в день обращения")
+    await user.tap(r"^add_photos_no$")
+
+
+async def flow_register_client(user):
+    await user.send_text("/start")
+    await user.tap(r"^select_role_client$")
+    await user.send_text(user.name)
+    await user.send_text("+375 33 765 43 21")
+    await user.tap(r"^clientregion_Минск$")
+
+
+async def flow_create_orders(user, count):
+    # Сценарии одного пользователя идут последовательно: у него один user_data
+    for _ in range(count):
+        await flow_create_order(user)
+
+
+async def flow_place_bids(user, count):
+    for _ in range(count):
+        await flow_place_bid(user)
+
+
+async def flow_create_order(user, subcategory=None):
+    """subcategory - индекс подкатегории; по умолчанию случайная"""
+    await user.press("client_create_order")
+    await user.tap(r"^orderregion_Минск$")
+    await user.tap(rf"^order_maincat_{LOADTEST_MAIN_CATEGORY}$")
+    if subcategory is None:
+        await user.tap(r"^order_subcat_", pick_random=True)
+    else:
+        await user.tap(rf"^order_subcat_\w+:{subcategory}$")
+    await user.send_text("Нужно заменить смеситель и проверить проводку на кухне")
+    await user.tap(r"^order_skip_photos$")
+    await user.tap(r"^order_deadline_", pick_random=True)
+
+
+async def flow_place_bid(user, order_id=None):
+    """order_id - заказ для отклика; по умолчанию случайный из доступных мастеру"""
+    await user.press("worker_view_orders")
+    if order_id is None:
+        await user.tap(r"^view_order_\d+$", pick_random=True)
+    else:
+        await user.press(f"view_order_{order_id}")
+    await user.tap(r"^bid_on_order_\d+$")
+    await user.tap(r"^bid_currency_BYN$")
+    await user.send_text(str(random.randint(30, 500)))
+    await user.tap(r"^ready_days_", pick_random=True)
+    await user.tap(r"^bid_skip_comment$")
+
+
+async def flow_chat(client, worker, chat_id, messages):
+    await client.press(f"open_chat_{chat_id}")
+    await worker.press(f"open_chat_{chat_id}")
+    for i in range(messages):
+        await client.send_text(f"Когда сможете приехать? ({i})")
+        await worker.send_text(f"Завтра после обеда ({i})")
+
+
+async def flow_browse(user, pages):
+    await user.press("client_browse_workers")
+    await user.tap(r"^browse_start_now$")
+    for _ in range(pages):
+        await user.tap(r"^browse_next_worker$")
+
+
+def prepare_chats(clients, workers_by_telegram_id):
+    """Открывает чат по первому отклику на заказы каждого клиента: [(client, worker, chat_id)]"""
+    pairs = []
+    for client in clients:
+        user = db.get_user(client.telegram_id)
+        profile = user and db.get_client_profile(user["id"])
+        if not profile:
+            continue
+        orders, _, _ = db.get_client_orders(profile["id"])
+        order, bids = None, None
+        for candidate in orders:
+            bids = db.get_bids_for_order(candidate["id"])
+            if bids:
+                order = dict(candidate)
+                break
+        if order is None:
+            continue
+        bid = dict(bids[0])
+        worker = workers_by_telegram_id.get(bid["worker_telegram_id"])
+        if worker is None:
+            continue
+        worker_user = db.get_user(worker.telegram_id)
+        chat_id = db.create_chat(order["id"], user["id"], worker_user["id"], bid["id"])
+        pairs.append((client, worker, chat_id))
+    return pairs
+
+
+# ------- ЗАПУСК -------
+
+# Обработчики-маршрутизаторы из bot.py: срабатывают на каждый текст и не описывают сценарий
+PASS_THROUGH_HANDLERS = {"direct_routing", "catch_all_messages"}
+
+
+class LatencyCollector:
+    """Собирает время обработки апдейтов по обработчикам из span трассировки"""
+
+    def __init__(self):
+        self.samples = defaultdict(list)  # {handler: [seconds]}
+        self.updates = 0
+
+    def __call__(self, span):
+        self.updates += 1
+        # Ключ - цепочка сработавших обработчиков (по одному на группу) без маршрутизаторов
+        names = [name for name in span.handlers if name.rsplit(".", 1)[-1] not in PASS_THROUGH_HANDLERS]
+        handler = " → ".join(names or span.handlers) or "<не обработан>"
+        self.samples[handler].append(span.total_time)
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(int(round(fraction * (len(sorted_values) - 1))), len(sorted_values) - 1)
+    return sorted_values[index]
+
+
+async def run_phase(name, coroutines, concurrency, stats):
+    """Выполняет сценарии с ограничением параллельности, считает успешные и прерванные"""
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def guarded(coroutine):
+        async with semaphore:
+            try:
+                await coroutine
+                stats[name]["ok"] += 1
+            except FlowError as e:
+                stats[name]["failed"] += 1
+                logger.debug(f"{name}: сценарий прерван: {e}")
+
+    started_at = time.perf_counter()
+    await asyncio.gather(*(guarded(coroutine) for coroutine in coroutines))
+    duration = time.perf_counter() - started_at
+    print(f"  {name:<16} ok={stats[name]['ok']:<6} прервано={stats[name]['failed']:<6} {duration:.1f} сек")
+
+
+async def run(args):
+    request = FakeTelegramRequest(latency=args.latency_ms / 1000, jitter=args.jitter_ms / 1000)
+    application = bot.build_application(FAKE_BOT_TOKEN, request=request)
+
+    collector = LatencyCollector()
+    tracing.add_span_listener(collector)
+
+    handler_errors = []
+
+    async def count_errors(update, context):
+        handler_errors.append(repr(context.error))
+
+    application.add_error_handler(count_errors)
+
+    await application.initialize()
+
+    random.seed(args.seed)
+    telegram_ids = itertools.count(FIRST_SYNTHETIC_TELEGRAM_ID)
+    workers = [SyntheticUser(application, request, next(telegram_ids), f"Мастер {i}") for i in range(args.workers)]
+    clients = [SyntheticUser(application, request, next(telegram_ids), f"Заказчик {i}") for i in range(args.clients)]
+    stats = defaultdict(lambda: {"ok": 0, "failed": 0})
+
+    print(f"🚀 Нагрузочный тест: мастеров={args.workers}, заказчиков={args.clients}, "
+          f"задержка API={args.latency_ms}±{args.jitter_ms} мс, параллельно={args.concurrency}")
+    started_at = time.perf_counter()
+
+    await run_phase("registration", [flow_register_worker(u) for u in workers]
+                    + [flow_register_client(u) for u in clients], args.concurrency, stats)
+    await run_phase("create_order", [flow_create_orders(u, args.orders_per_client) for u in clients],
+                    args.concurrency, stats)
+    await run_phase("place_bid", [flow_place_bids(u, args.bids_per_worker) for u in workers],
+                    args.concurrency, stats)
+
+    chat_pairs = prepare_chats(clients, {u.telegram_id: u for u in workers})
+    await run_phase("chat", [flow_chat(c, w, chat_id, args.messages) for c, w, chat_id in chat_pairs],
+                    args.concurrency, stats)
+    await run_phase("browse", [flow_browse(u, args.browse_pages) for u in clients], args.concurrency, stats)
+
+    duration = time.perf_counter() - started_at
+
+    # Отправка фоновых уведомлений из очереди не входит в замер
+    await application.shutdown()
+
+    print_report(collector, request, handler_errors, duration)
+
+
+def print_report(collector, request, handler_errors, duration):
+    print()
+    print(f"{'Обработчик':<60} {'N':>7} {'p50 мс':>9} {'p95 мс':>9} {'p99 мс':>9} {'max мс':>9}")
+    print("-" * 107)
+    ordered = sorted(collector.samples.items(), key=lambda item: -sum(item[1]))
+    for handler, samples in ordered:
+        samples.sort()
+        print(
+            f"{handler[:60]:<60} {len(samples):>7} "
+            f"{percentile(samples, 0.50) * 1000:>9.1f} {percentile(samples, 0.95) * 1000:>9.1f} "
+            f"{percentile(samples, 0.99) * 1000:>9.1f} {samples[-1] * 1000:>9.1f}"
+        )
+    print("-" * 107)
+    print(f"Апдейтов: {collector.updates} за {duration:.1f} сек = {collector.updates / duration:.1f} апдейтов/сек")
+    print(f"Вызовы Bot API: " + ", ".join(f"{m}={n}" for m, n in sorted(request.calls.items(), key=lambda i: -i[1])))
+    if handler_errors:
+        print(f"⚠️ Ошибок в обработчиках: {len(handler_errors)} (первая: {handler_errors[0]})")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест бота с фейковым Bot API")
+    parser.add_argument("--workers", type=int, default=100, help="количество мастеров")
+    parser.add_argument("--clients", type=int, default=100, help="количество заказчиков")
+    parser.add_argument("--orders-per-client", type=int, default=2)
+    parser.add_argument("--bids-per-worker", type=int, default=3)
+    parser.add_argument("--messages", type=int, default=5, help="сообщений с каждой стороны в чате")
+    parser.add_argument("--browse-pages", type=int, default=5, help="анкет мастеров при просмотре")
+    parser.add_argument("--concurrency", type=int, default=50, help="одновременно активных пользователей")
+    parser.add_argument("--latency-ms", type=float, default=30.0, help="задержка ответа Bot API")
+    parser.add_argument("--jitter-ms", type=float, default=20.0, help="случайная добавка к задержке")
+    parser.add_argument("--db", default="loadtest.db", help="файл SQLite (пересоздаётся; без DATABASE_URL)")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--verbose", action="store_true", help="логи бота уровня INFO")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    logging.getLogger().setLevel(logging.INFO if args.verbose else logging.WARNING)
+    logging.getLogger("slow_updates").setLevel(logging.ERROR)
+    logging.getLogger("slow_queries").setLevel(logging.ERROR)
+
+    if not db.USE_POSTGRES:
+        if os.path.exists(args.db):
+            os.remove(args.db)
+        db.DATABASE_NAME = args.db
+
+    bot.run_migrations()
+    try:
+        asyncio.run(run(args))
+    finally:
+        db.close_connection_pool()
+
+
+if __name__ == "__main__":
+    main()
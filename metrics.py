@@ -0,0 +1,190 @@
+"""
+Метрики бота в текстовом формате Prometheus.
+
+Включается переменной окружения METRICS_PORT: bot.main() поднимает HTTP-сервер
+в отдельном потоке, GET /metrics отдаёт:
+- bot_updates_total - количество обработанных апдейтов
+- bot_handler_latency_seconds - гистограмма времени обработчиков
+- bot_job_duration_seconds - гистограмма времени фоновых задач
+- bot_db_pool_connections - соединения пула PostgreSQL (in_use/idle/max)
+- bot_notification_queue_depth - очередь фоновых уведомлений
+- bot_rate_limiter_keys - количество ключей RateLimiter
+- bot_ad_events_pending - события рекламы, ещё не записанные в БД
+- bot_cache_lookups_total - попадания/промахи in-memory кэшей
+
+Без внешних зависимостей: формат простой, prometheus_client не нужен.
+"""
+import functools
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+METRICS_PORT = os.getenv("METRICS_PORT")
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+JOB_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+_lock = threading.Lock()
+
+
+class Histogram:
+    """Гистограмма с фиксированными бакетами и меткой name"""
+
+    def __init__(self, metric, help_text, label, buckets):
+        self.metric = metric
+        self.help_text = help_text
+        self.label = label
+        self.buckets = buckets
+        self._series = {}  # {label_value: [bucket_counts, sum, count]}
+
+    def observe(self, label_value, value):
+        with _lock:
+            series = self._series.get(label_value)
+            if series is None:
+                series = self._series[label_value] = [[0] * len(self.buckets), 0.0, 0]
+            index = bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.metric} {self.help_text}", f"# TYPE {self.metric} histogram"]
+        with _lock:
+            for label_value, (bucket_counts, total, count) in sorted(self._series.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, bucket_counts):
+                    cumulative += bucket_count
+                    lines.append(f'{self.metric}_bucket{{{self.label}="{label_value}",le="{bound}"}} {cumulative}')
+                lines.append(f'{self.metric}_bucket{{{self.label}="{label_value}",le="+Inf"}} {count}')
+                lines.append(f'{self.metric}_sum{{{self.label}="{label_value}"}} {total:.6f}')
+                lines.append(f'{self.metric}_count{{{self.label}="{label_value}"}} {count}')
+        return lines
+
+
+handler_latency = Histogram(
+    "bot_handler_latency_seconds", "Время выполнения обработчиков", "handler", LATENCY_BUCKETS
+)
+job_duration = Histogram(
+    "bot_job_duration_seconds", "Время выполнения фоновых задач", "job", JOB_BUCKETS
+)
+_updates_total = 0
+
+
+def observe_update():
+    global _updates_total
+    with _lock:
+        _updates_total += 1
+
+
+def observe_handler(name, duration):
+    handler_latency.observe(name, duration)
+
+
+def timed_job(name):
+    """Декоратор async job-функции: пишет её длительность в bot_job_duration_seconds"""
+
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            started_at = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                job_duration.observe(name, time.perf_counter() - started_at)
+
+        return wrapper
+
+    return decorator
+
+
+def _gauge(metric, help_text, samples, metric_type="gauge"):
+    lines = [f"# HELP {metric} {help_text}", f"# TYPE {metric} {metric_type}"]
+    for labels, value in samples:
+        label_text = ",".join(f'{key}="{val}"' for key, val in labels.items())
+        lines.append(f"{metric}{{{label_text}}} {value}" if label_text else f"{metric} {value}")
+    return lines
+
+
+def render():
+    """Собирает все метрики в текст формата Prometheus"""
+    import db
+    import handlers
+
+    lines = _gauge("bot_updates_total", "Количество обработанных апдейтов", [({}, _updates_total)], "counter")
+    lines += handler_latency.render()
+    lines += job_duration.render()
+
+    pool_stats = db.get_pool_stats()
+    if pool_stats:
+        lines += _gauge(
+            "bot_db_pool_connections", "Соединения пула PostgreSQL",
+            [({"state": state}, value) for state, value in pool_stats.items()],
+        )
+
+    lines += _gauge(
+        "bot_notification_queue_depth", "Сообщений в очереди фоновых уведомлений",
+        [({}, handlers.notification_queue.pending)],
+    )
+    lines += _gauge("bot_rate_limiter_keys", "Ключей в RateLimiter", [({}, db._rate_limiter.key_count)])
+    lines += _gauge(
+        "bot_ad_events_pending", "Показов/кликов рекламы в буфере записи", [({}, db.get_pending_ad_events())]
+    )
+
+    cache_samples = []
+    for cache_name, stats in sorted(db.get_cache_stats().items()):
+        for result in ("hits", "misses"):
+            cache_samples.append(({"cache": cache_name, "result": result}, stats[result]))
+    lines += _gauge("bot_cache_lookups_total", "Обращения к in-memory кэшам", cache_samples, "counter")
+
+    return "\n".join(lines) + "\n"
+
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        try:
+            body = render().encode("utf-8")
+        except Exception as e:
+            logger.error(f"❌ Ошибка сбора метрик: {e}", exc_info=True)
+            self.send_error(500)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Не засоряем лог бота запросами скрейпера
+        pass
+
+
+def start_metrics_server(port=None, host=None):
+    """
+    Запускает HTTP-сервер метрик в фоновом потоке.
+    Без METRICS_PORT (и без явного port) ничего не делает. Возвращает сервер или None.
+    """
+    port = port or METRICS_PORT
+    if not port:
+        return None
+
+    host = host or METRICS_HOST
+    try:
+        server = ThreadingHTTPServer((host, int(port)), _MetricsRequestHandler)
+    except OSError as e:
+        logger.error(f"❌ Не удалось запустить сервер метрик на {host}:{port}: {e}")
+        return None
+
+    thread = threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True)
+    thread.start()
+    logger.info(f"📊 Метрики доступны на http://{host}:{port}/metrics")
+    return server
@@ -0,0 +1,405 @@
+#!/usr/bin/env python3
+"""
+Генератор синтетических данных для замеров производительности.
+
+В отличие от db.add_test_orders/add_test_workers (десяток строк для одного
+telegram_id) генерирует реалистичный объём: мастера, заказчики, заказы,
+отклики, чаты и сообщения с городами из BELARUS_REGIONS и категориями из
+WORK_CATEGORIES. Загрузка идёт пачками через DBCursor.copy_rows
+(COPY на PostgreSQL, executemany на SQLite) в одной транзакции.
+
+Запуск:
+    python seed_dataset.py --workers 1000 --clients 5000 --orders 20000 --bids 100000
+    DATABASE_URL=postgresql://localhost/remont_bench python seed_dataset.py \\
+        --workers 100000 --clients 300000 --orders 1000000 --bids 5000000 --messages 5000000
+
+Данные добавляются к существующим (ID продолжают текущие), поэтому запускать
+стоит на отдельной базе, а не на боевой.
+"""
+
+import argparse
+import logging
+import random
+import time
+from array import array
+from datetime import datetime, timedelta
+
+import bot
+import db
+from handlers import BELARUS_REGIONS, WORK_CATEGORIES
+
+logger = logging.getLogger("seed_dataset")
+
+# Первый telegram_id синтетических пользователей (далеко от реальных ID)
+FIRST_SYNTHETIC_TELEGRAM_ID = 8_000_000_000
+
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# Распределение статусов заказов: (статус, вес)
+ORDER_STATUSES = [
+    ("open", 40),
+    ("waiting_master_confirmation", 3),
+    ("master_selected", 10),
+    ("done", 32),
+    ("cancelled", 10),
+    ("expired", 5),
+]
+# Статусы, для которых у заказа есть выбранный мастер и чат
+ORDER_STATUSES_WITH_CHAT = {"waiting_master_confirmation", "master_selected", "done"}
+
+CITIES = ["Минск"] + [
+    city for region in BELARUS_REGIONS.values() for city in region.get("cities", [])
+]
+SUBCATEGORIES = [sub for category in WORK_CATEGORIES.values() for sub in category["subcategories"]]
+EXPERIENCE_LEVELS = ["Начинающий мастер", "Опытный мастер", "Профессионал"]
+FIRST_NAMES = ["Александр", "Сергей", "Андрей", "Дмитрий", "Иван", "Павел", "Ольга", "Наталья", "Елена", "Мария"]
+LAST_NAMES = ["Иванов", "Петров", "Сидоров", "Козлов", "Новик", "Ковалёв", "Шевчук", "Мельник", "Бондарь", "Лис"]
+ORDER_TEXTS = [
+    "Нужно заменить смеситель на кухне",
+    "Собрать шкаф и две тумбы",
+    "Поменять розетки и выключатели в квартире",
+    "Уложить ламинат в комнате",
+    "Отрегулировать пластиковые окна",
+    "Починить стиральную машину, не сливает воду",
+    "Покрасить стены в спальне",
+    "Повесить люстру и карниз",
+]
+CHAT_TEXTS = [
+    "Добрый день! Когда сможете приехать?",
+    "Завтра после обеда подойдёт?",
+    "Да, подходит. Адрес пришлю.",
+    "Материалы брать с собой?",
+    "Спасибо, всё отлично!",
+]
+
+
+class DatasetGenerator:
+    """
+    Генерирует строки таблиц потоково: в памяти держатся только компактные
+    массивы по заказам (статус, дата, первый отклик), сами строки уходят
+    в БД пачками по chunk_size.
+    """
+
+    def __init__(self, args, id_base, telegram_base):
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.now = datetime.now()
+        self.id_base = id_base  # {table: первый свободный id}
+        self.telegram_base = telegram_base
+
+        self.order_status = bytearray()  # индекс в ORDER_STATUSES
+        self.order_created = array("q")  # unix time создания заказа
+        self.order_category = array("H")  # индекс в SUBCATEGORIES
+        self.order_client = array("q")  # client_id
+        self.order_first_bid = array("q")  # id первого отклика или 0
+        self.order_first_bid_worker = array("q")  # worker_id первого отклика или 0
+        self.chat_message_counts = array("l")
+        # Категории и города мастеров (плоские массивы индексов + количество на мастера)
+        self.worker_category_indexes = array("H")
+        self.worker_category_counts = bytearray()
+        self.worker_city_indexes = array("H")
+        self.worker_city_counts = bytearray()
+
+    # --- идентификаторы ---
+
+    def worker_user_id(self, index):
+        return self.id_base["users"] + index
+
+    def client_user_id(self, index):
+        return self.id_base["users"] + self.args.workers + index
+
+    def worker_id(self, index):
+        return self.id_base["workers"] + index
+
+    def client_id(self, index):
+        return self.id_base["clients"] + index
+
+    def _random_past(self, days):
+        return self.now - timedelta(seconds=self.rng.randint(0, days * 86400))
+
+    def _random_city_index(self):
+        # Около трети заказов и мастеров - в Минске
+        return 0 if self.rng.random() < 0.35 else self.rng.randrange(len(CITIES))
+
+    def _name(self):
+        return f"{self.rng.choice(FIRST_NAMES)} {self.rng.choice(LAST_NAMES)}"
+
+    # --- таблицы ---
+
+    def users(self):
+        created_at = self.now.isoformat()
+        for index in range(self.args.workers):
+            yield (self.worker_user_id(index), self.telegram_base + index, "worker", created_at)
+        for index in range(self.args.clients):
+            yield (self.client_user_id(index), self.telegram_base + self.args.workers + index, "client", created_at)
+
+    def workers(self):
+        for index in range(self.args.workers):
+            rng = self.rng
+            category_indexes = rng.sample(range(len(SUBCATEGORIES)), rng.randint(1, 3))
+            self.worker_category_indexes.extend(category_indexes)
+            self.worker_category_counts.append(len(category_indexes))
+            city_indexes = sorted({self._random_city_index() for _ in range(rng.randint(1, 2))})
+            self.worker_city_indexes.extend(city_indexes)
+            self.worker_city_counts.append(len(city_indexes))
+
+            categories = [SUBCATEGORIES[i] for i in category_indexes]
+            city = CITIES[city_indexes[0]]
+            rating_count = rng.randint(0, 60)
+            rating = round(rng.uniform(3.5, 5.0), 2) if rating_count else 0.0
+            yield (
+                self.worker_id(index), self.worker_user_id(index), self._name(), "+375291234567",
+                city, city, ", ".join(categories), rng.choice(EXPERIENCE_LEVELS),
+                "Выполняю работы качественно и в срок", "", rating, rating_count,
+                rating * rating_count, rng.randint(0, rating_count),
+            )
+
+    def worker_categories(self):
+        offset = 0
+        for index, count in enumerate(self.worker_category_counts):
+            for category_index in self.worker_category_indexes[offset:offset + count]:
+                yield (self.worker_id(index), SUBCATEGORIES[category_index])
+            offset += count
+
+    def worker_cities(self):
+        offset = 0
+        for index, count in enumerate(self.worker_city_counts):
+            for city_index in self.worker_city_indexes[offset:offset + count]:
+                yield (self.worker_id(index), CITIES[city_index])
+            offset += count
+
+    def clients(self):
+        for index in range(self.args.clients):
+            city = CITIES[self._random_city_index()]
+            yield (self.client_id(index), self.client_user_id(index), self._name(), "+375331234567", city, "", city)
+
+    def orders(self):
+        statuses = [status for status, _ in ORDER_STATUSES]
+        weights = [weight for _, weight in ORDER_STATUSES]
+        for index in range(self.args.orders):
+            rng = self.rng
+            status_index = rng.choices(range(len(statuses)), weights)[0]
+            created = self._random_past(self.args.days)
+            city_index = self._random_city_index()
+            category_index = rng.randrange(len(SUBCATEGORIES))
+            client_id = self.client_id(rng.randrange(self.args.clients))
+
+            self.order_status.append(status_index)
+            self.order_created.append(int(created.timestamp()))
+            self.order_category.append(category_index)
+            self.order_client.append(client_id)
+
+            deadline = None
+            if statuses[status_index] == "open" and rng.random() < 0.5:
+                deadline = (created + timedelta(days=rng.choice([1, 3, 7, 14]))).strftime(DATE_FORMAT)
+
+            yield (
+                self.id_base["orders"] + index, client_id, rng.choice(ORDER_TEXTS), CITIES[city_index],
+                SUBCATEGORIES[category_index], "none", 0, deadline, "", "", statuses[status_index],
+                created.strftime(DATE_FORMAT),
+            )
+
+    def order_categories(self):
+        for index in range(self.args.orders):
+            yield (self.id_base["orders"] + index, SUBCATEGORIES[self.order_category[index]])
+
+    def bids(self):
+        """Откликов на заказ в среднем bids/orders; мастера внутри заказа не повторяются"""
+        average = self.args.bids / max(self.args.orders, 1)
+        bid_id = self.id_base["bids"]
+        produced = 0
+        for index in range(self.args.orders):
+            rng = self.rng
+            remaining = self.args.bids - produced
+            count = min(int(rng.expovariate(1 / average)) if average else 0, remaining, self.args.workers)
+            status = ORDER_STATUSES[self.order_status[index]][0]
+            has_chat = status in ORDER_STATUSES_WITH_CHAT
+            if has_chat:
+                count = max(count, 1)
+
+            self.order_first_bid.append(bid_id if count else 0)
+            worker_indexes = rng.sample(range(self.args.workers), count) if count else []
+            self.order_first_bid_worker.append(self.worker_id(worker_indexes[0]) if count else 0)
+
+            order_created = datetime.fromtimestamp(self.order_created[index])
+            for position, worker_index in enumerate(worker_indexes):
+                if status == "open":
+                    bid_status = "active"
+                elif has_chat:
+                    bid_status = "selected" if position == 0 else "rejected"
+                else:
+                    bid_status = "rejected"
+                created = order_created + timedelta(minutes=rng.randint(1, 48 * 60))
+                yield (
+                    bid_id, self.id_base["orders"] + index, self.worker_id(worker_index),
+                    rng.randint(20, 800), "BYN", "", created.strftime(DATE_FORMAT), bid_status,
+                    rng.choice([0, 1, 3, 7]),
+                )
+                bid_id += 1
+            produced += count
+
+    def chats(self):
+        eligible = [
+            index for index in range(self.args.orders)
+            if ORDER_STATUSES[self.order_status[index]][0] in ORDER_STATUSES_WITH_CHAT and self.order_first_bid[index]
+        ]
+        if self.args.chats is not None:
+            eligible = eligible[:self.args.chats]
+
+        average = self.args.messages / max(len(eligible), 1)
+        message_id = self.id_base["messages"]
+        remaining = self.args.messages
+        for position, index in enumerate(eligible):
+            rng = self.rng
+            count = remaining if position == len(eligible) - 1 else min(int(rng.expovariate(1 / average)) if average else 0, remaining)
+            remaining -= count
+            self.chat_message_counts.append(count)
+
+            client_user_id = self.order_client[index] - self.id_base["clients"] + self.client_user_id(0)
+            worker_user_id = self.order_first_bid_worker[index] - self.id_base["workers"] + self.worker_user_id(0)
+            created = datetime.fromtimestamp(self.order_created[index]) + timedelta(days=1)
+            last_message_id = message_id + count - 1 if count else 0
+            # Около 20% чатов с непрочитанным последним сообщением у заказчика
+            client_read = last_message_id - 1 if count and rng.random() < 0.2 else last_message_id
+            yield (
+                self.id_base["chats"] + position, self.id_base["orders"] + index, client_user_id, worker_user_id,
+                self.order_first_bid[index], "active", created.strftime(DATE_FORMAT),
+                created.strftime(DATE_FORMAT) if count else None, True,
+                last_message_id, client_read, last_message_id,
+            )
+            message_id += count
+
+        self._chat_orders = eligible
+
+    def messages(self):
+        message_id = self.id_base["messages"]
+        for position, index in enumerate(self._chat_orders):
+            count = self.chat_message_counts[position]
+            chat_id = self.id_base["chats"] + position
+            client_user_id = self.order_client[index] - self.id_base["clients"] + self.client_user_id(0)
+            worker_user_id = self.order_first_bid_worker[index] - self.id_base["workers"] + self.worker_user_id(0)
+            created = datetime.fromtimestamp(self.order_created[index]) + timedelta(days=1)
+            for number in range(count):
+                from_client = number % 2 == 0
+                yield (
+                    message_id, chat_id, client_user_id if from_client else worker_user_id,
+                    "client" if from_client else "worker", CHAT_TEXTS[number % len(CHAT_TEXTS)],
+                    (created + timedelta(minutes=number * 7)).strftime(DATE_FORMAT), True,
+                )
+                message_id += 1
+
+
+# Порядок загрузки соблюдает внешние ключи: (таблица, колонки, метод генератора)
+TABLES = [
+    ("users", ["id", "telegram_id", "role", "created_at"], "users"),
+    ("workers", ["id", "user_id", "name", "phone", "city", "regions", "categories", "experience",
+                 "description", "portfolio_photos", "rating", "rating_count", "rating_sum", "verified_reviews"], "workers"),
+    ("worker_categories", ["worker_id", "category"], "worker_categories"),
+    ("worker_cities", ["worker_id", "city"], "worker_cities"),
+    ("clients", ["id", "user_id", "name", "phone", "city", "description", "regions"], "clients"),
+    ("orders", ["id", "client_id", "description", "city", "category", "budget_type", "budget_value",
+                "deadline", "photos", "videos", "status", "created_at"], "orders"),
+    ("order_categories", ["order_id", "category"], "order_categories"),
+    ("bids", ["id", "order_id", "worker_id", "proposed_price", "currency", "comment", "created_at",
+              "status", "ready_in_days"], "bids"),
+    ("chats", ["id", "order_id", "client_user_id", "worker_user_id", "bid_id", "status", "created_at",
+               "last_message_at", "worker_confirmed", "last_message_id", "client_last_read_message_id",
+               "worker_last_read_message_id"], "chats"),
+    ("messages", ["id", "chat_id", "sender_user_id", "sender_role", "message_text", "created_at",
+                  "is_read"], "messages"),
+]
+TABLES_WITH_EXPLICIT_IDS = ["users", "workers", "clients", "orders", "bids", "chats", "messages"]
+
+
+def _scalar(cursor, sql):
+    cursor.execute(sql)
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    return list(row.values())[0] if isinstance(row, dict) else row[0]
+
+
+def load(args):
+    with db.get_db_connection() as conn:
+        cursor = db.get_cursor(conn)
+
+        id_base = {
+            table: (_scalar(cursor, f"SELECT MAX(id) FROM {table}") or 0) + 1
+            for table in TABLES_WITH_EXPLICIT_IDS
+        }
+        telegram_base = max(FIRST_SYNTHETIC_TELEGRAM_ID, (_scalar(cursor, "SELECT MAX(telegram_id) FROM users") or 0) + 1)
+        generator = DatasetGenerator(args, id_base, telegram_base)
+
+        started_at = time.perf_counter()
+        for table, columns, method in TABLES:
+            table_started_at = time.perf_counter()
+            total = 0
+            chunk = []
+            for row in getattr(generator, method)():
+                chunk.append(row)
+                if len(chunk) >= args.chunk_size:
+                    cursor.copy_rows(table, columns, chunk)
+                    total += len(chunk)
+                    chunk = []
+            if chunk:
+                cursor.copy_rows(table, columns, chunk)
+                total += len(chunk)
+            elapsed = time.perf_counter() - table_started_at
+            print(f"  {table:<18} {total:>10} строк  {elapsed:6.1f} сек  ({total / max(elapsed, 1e-6):,.0f} строк/сек)")
+
+        if db.USE_POSTGRES:
+            # Явные ID не двигают последовательности SERIAL - выравниваем их
+            for table in TABLES_WITH_EXPLICIT_IDS:
+                cursor.execute(
+                    f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), (SELECT MAX(id) FROM {table}))"
+                )
+
+        conn.commit()
+        print(f"✅ Загрузка завершена за {time.perf_counter() - started_at:.1f} сек")
+
+    # Мастера загружены в обход бота - счёт ранжирования считаем одним проходом
+    ranked = db.rebuild_ranking_scores()
+    print(f"📊 Счёт ранжирования пересчитан: мастеров {ranked}")
+
+    # Статистика планировщика и счётчики доступных заказов мастеров
+    with db.get_db_connection() as conn:
+        db.get_cursor(conn).execute("ANALYZE")
+        conn.commit()
+
+    fixed = db.reconcile_available_orders_counters()
+    print(f"📊 ANALYZE выполнен, счётчиков доступных заказов пересчитано: {fixed}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Генерация синтетических данных для замеров")
+    parser.add_argument("--workers", type=int, default=1000)
+    parser.add_argument("--clients", type=int, default=3000)
+    parser.add_argument("--orders", type=int, default=10000)
+    parser.add_argument("--bids", type=int, default=50000)
+    parser.add_argument("--chats", type=int, default=None, help="максимум чатов (по умолчанию - все подходящие заказы)")
+    parser.add_argument("--messages", type=int, default=50000)
+    parser.add_argument("--days", type=int, default=180, help="за сколько дней распределять даты")
+    parser.add_argument("--chunk-size", type=int, default=50000, help="строк в одной пачке COPY/executemany")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+    if args.workers < 1 or args.clients < 1:
+        parser.error("нужен хотя бы один мастер и один заказчик")
+    return args
+
+
+def main():
+    args = parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+    logging.getLogger("slow_queries").setLevel(logging.ERROR)
+
+    bot.run_migrations()
+    print(f"🚀 Генерация: мастеров={args.workers}, заказчиков={args.clients}, заказов={args.orders}, "
+          f"откликов={args.bids}, сообщений={args.messages} ({'PostgreSQL' if db.USE_POSTGRES else 'SQLite'})")
+    try:
+        load(args)
+    finally:
+        db.close_connection_pool()
+
+
+if __name__ == "__main__":
+    main()
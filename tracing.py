@@ -0,0 +1,196 @@
+"""
+Трассировка обработки апдейтов.
+
+На каждый апдейт создаётся UpdateSpan: какие обработчики сработали, общее время,
+количество и время SQL-запросов (DBCursor.execute), ожидание соединения из пула
+и время вызовов Telegram Bot API. Апдейты дольше SLOW_UPDATE_THRESHOLD_MS
+пишутся в отдельный лог медленных апдейтов (logger "slow_updates").
+
+Span хранится в ContextVar, поэтому задачи asyncio, созданные при обработке
+апдейта, пишут в тот же span, а фоновые задачи (JobQueue) - никуда.
+"""
+import functools
+import logging
+import os
+import time
+from collections import Counter
+from contextvars import ContextVar
+
+from telegram.ext import Application, ConversationHandler
+from telegram.request import HTTPXRequest
+
+import metrics
+
+logger = logging.getLogger(__name__)
+slow_update_logger = logging.getLogger("slow_updates")
+
+# Порог медленного апдейта (мс), настраивается переменной окружения
+SLOW_UPDATE_THRESHOLD_MS = int(os.getenv("SLOW_UPDATE_THRESHOLD_MS", "1000"))
+# Файл лога медленных апдейтов (если не задан - пишем в общий лог)
+SLOW_UPDATE_LOG_FILE = os.getenv("SLOW_UPDATE_LOG_FILE")
+
+_current_span = ContextVar("update_span", default=None)
+
+# Подписчики на завершённые span (например, loadtest.py собирает по ним перцентили)
+_span_listeners = []
+
+
+class UpdateSpan:
+    """Статистика обработки одного апдейта"""
+
+    def __init__(self, update_id, update_type):
+        self.update_id = update_id
+        self.update_type = update_type
+        self.handlers = []
+        self.db_queries = 0
+        self.db_time = 0.0
+        self.db_statements = Counter()  # {отпечаток SQL: количество} - для поиска N+1
+        self.pool_wait_time = 0.0
+        self.api_calls = 0
+        self.api_time = 0.0
+        self.started_at = time.perf_counter()
+        self.total_time = 0.0
+
+    def summary(self):
+        handlers = ",".join(self.handlers) or "-"
+        return (
+            f"update={self.update_id} type={self.update_type} handlers={handlers} "
+            f"total={self.total_time * 1000:.1f}ms "
+            f"db={self.db_queries}q/{self.db_time * 1000:.1f}ms "
+            f"pool_wait={self.pool_wait_time * 1000:.1f}ms "
+            f"api={self.api_calls}c/{self.api_time * 1000:.1f}ms"
+        )
+
+
+def add_span_listener(listener):
+    """Регистрирует listener(span), вызываемый после обработки каждого апдейта"""
+    _span_listeners.append(listener)
+
+
+def current_span():
+    """Текущий span или None вне обработки апдейта"""
+    return _current_span.get()
+
+
+def record_db_query(duration, fingerprint=None):
+    span = _current_span.get()
+    if span is not None:
+        span.db_queries += 1
+        span.db_time += duration
+        if fingerprint:
+            span.db_statements[fingerprint] += 1
+
+
+def record_pool_wait(duration):
+    span = _current_span.get()
+    if span is not None:
+        span.pool_wait_time += duration
+
+
+def record_api_call(duration):
+    span = _current_span.get()
+    if span is not None:
+        span.api_calls += 1
+        span.api_time += duration
+
+
+def record_handler(name):
+    span = _current_span.get()
+    if span is not None:
+        span.handlers.append(name)
+
+
+def _update_type(update):
+    for attr in ("callback_query", "message", "edited_message", "inline_query", "my_chat_member"):
+        if getattr(update, attr, None) is not None:
+            return attr
+    return type(update).__name__
+
+
+class TracedApplication(Application):
+    """Application, который оборачивает обработку каждого апдейта в UpdateSpan"""
+
+    async def process_update(self, update):
+        span = UpdateSpan(getattr(update, "update_id", None), _update_type(update))
+        token = _current_span.set(span)
+        metrics.observe_update()
+        try:
+            await super().process_update(update)
+        finally:
+            span.total_time = time.perf_counter() - span.started_at
+            _current_span.reset(token)
+            if span.total_time * 1000 >= SLOW_UPDATE_THRESHOLD_MS:
+                slow_update_logger.warning(f"🐢 Медленный апдейт: {span.summary()}")
+            else:
+                logger.debug(f"⏱ {span.summary()}")
+            for listener in _span_listeners:
+                listener(span)
+
+
+# Пул соединений для вызовов Bot API - как у HTTPXRequest, который ApplicationBuilder
+# создаёт сам (у голого HTTPXRequest по умолчанию одно соединение на все вызовы)
+BOT_API_CONNECTION_POOL_SIZE = 256
+
+
+class TracedRequest(HTTPXRequest):
+    """HTTPXRequest, который учитывает время вызовов Bot API в текущем span"""
+
+    def __init__(self, connection_pool_size=BOT_API_CONNECTION_POOL_SIZE, **kwargs):
+        super().__init__(connection_pool_size=connection_pool_size, **kwargs)
+
+    async def do_request(self, *args, **kwargs):
+        started_at = time.perf_counter()
+        try:
+            return await super().do_request(*args, **kwargs)
+        finally:
+            record_api_call(time.perf_counter() - started_at)
+
+
+def _trace_callback(callback):
+    if getattr(callback, "_traced", False):
+        return callback
+
+    name = getattr(callback, "__qualname__", repr(callback))
+
+    @functools.wraps(callback)
+    async def traced(update, context, *args, **kwargs):
+        record_handler(name)
+        started_at = time.perf_counter()
+        try:
+            return await callback(update, context, *args, **kwargs)
+        finally:
+            metrics.observe_handler(name, time.perf_counter() - started_at)
+
+    traced._traced = True
+    return traced
+
+
+def _instrument_handler(handler):
+    if isinstance(handler, ConversationHandler):
+        nested = list(handler.entry_points) + list(handler.fallbacks)
+        for state_handlers in handler.states.values():
+            nested.extend(state_handlers)
+        for nested_handler in nested:
+            _instrument_handler(nested_handler)
+    elif hasattr(handler, "callback"):
+        handler.callback = _trace_callback(handler.callback)
+
+
+def instrument_application(application):
+    """
+    Подключает имена обработчиков к трассировке: оборачивает callback всех
+    зарегистрированных обработчиков (включая вложенные в ConversationHandler).
+    Вызывать после регистрации всех обработчиков.
+    """
+    count = 0
+    for group_handlers in application.handlers.values():
+        for handler in group_handlers:
+            _instrument_handler(handler)
+            count += 1
+
+    if SLOW_UPDATE_LOG_FILE:
+        file_handler = logging.FileHandler(SLOW_UPDATE_LOG_FILE, encoding="utf-8")
+        file_handler.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+        slow_update_logger.addHandler(file_handler)
+
+    logger.info(f"⏱ Трассировка апдейтов включена: {count} обработчиков, порог {SLOW_UPDATE_THRESHOLD_MS} мс")